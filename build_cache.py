@@ -0,0 +1,197 @@
+# Python module for a content-addressed cache of build products shared between runs
+#
+# Entries live at <root>/entries/<key> where the key is a hash of whatever
+# identifies the build (e.g. commit hash, configure args, toolchain). Builds
+# which bake their install location into the output (like an ocaml --prefix)
+# are done in place inside the entry directory while holding the entry lock.
+# An entry only becomes visible once its completion marker is os.replace'd
+# into place, so a crashed build is never picked up by a later run.
+#
+# A directory which keeps links into an entry after the build (e.g. an
+# outdir with bin -> <entry>/bin) holds a lease on it at
+# <root>/leases/<key>/, and eviction skips leased entries. Leases whose
+# holder no longer links into the entry (removed, relinked or crashed
+# before releasing) are dropped when eviction next looks at them.
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import time
+
+from contextlib import contextmanager
+
+COMPLETE_MARKER = '.complete'
+ENTRY_INFO = 'cache_entry.json'
+TOOLCHAIN_CMDS = ['cc --version', 'make --version', 'uname -m']
+
+def toolchain_fingerprint(cmds=TOOLCHAIN_CMDS):
+    # first line of each tool's version output
+    lines = []
+    for cmd in cmds:
+        proc_output = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        lines.append(proc_output.stdout.decode('utf-8').split('\n')[0].strip())
+    return '\n'.join(lines)
+
+def dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            fname = os.path.join(root, f)
+            if not os.path.islink(fname):
+                total += os.path.getsize(fname)
+    return total
+
+def write_atomic(fname, contents):
+    tmp_fname = '%s.tmp.%d'%(fname, os.getpid())
+    with open(tmp_fname, 'w') as f:
+        f.write(contents)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fname, fname)
+
+class BuildCache:
+    def __init__(self, root, max_bytes=None, verbose=False):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.verbose = verbose
+        self.entries_dir = os.path.join(self.root, 'entries')
+        self.locks_dir = os.path.join(self.root, 'locks')
+        self.leases_dir = os.path.join(self.root, 'leases')
+        os.makedirs(self.entries_dir, exist_ok=True)
+        os.makedirs(self.locks_dir, exist_ok=True)
+        os.makedirs(self.leases_dir, exist_ok=True)
+
+    def key(self, *parts):
+        return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.entries_dir, key)
+
+    def is_complete(self, key):
+        return os.path.exists(os.path.join(self.entry_path(key), COMPLETE_MARKER))
+
+    @contextmanager
+    def lock(self, key, blocking=True):
+        # yields False if blocking=False and someone else holds the lock
+        with open(os.path.join(self.locks_dir, '%s.lock'%key), 'w') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def lookup(self, key):
+        # returns the entry path on a hit, refreshing its LRU time
+        if not self.is_complete(key):
+            return None
+        os.utime(os.path.join(self.entry_path(key), COMPLETE_MARKER))
+        if self.verbose: print('build cache hit for %s'%key)
+        return self.entry_path(key)
+
+    def prepare(self, key):
+        # clear out anything left from a failed build; caller must hold the lock
+        path = self.entry_path(key)
+        if os.path.exists(path):
+            if self.verbose: print('removing incomplete build cache entry %s'%path)
+            shutil.rmtree(path)
+        os.makedirs(path)
+        return path
+
+    def publish(self, key, info=None):
+        # caller must hold the lock
+        path = self.entry_path(key)
+        info = dict(info or {})
+        info['size_bytes'] = dir_size(path)
+        info['published'] = time.time()
+        write_atomic(os.path.join(path, ENTRY_INFO), json.dumps(info, indent=2))
+        write_atomic(os.path.join(path, COMPLETE_MARKER), '')
+        if self.verbose: print('published build cache entry %s (%d bytes)'%(path, info['size_bytes']))
+        self.evict(keep=key)
+        return path
+
+    def discard(self, key):
+        # caller must hold the lock
+        shutil.rmtree(self.entry_path(key), ignore_errors=True)
+
+    def _lease_fname(self, key, holder):
+        return os.path.join(self.leases_dir, key, '%s.lease'%hashlib.sha256(os.path.abspath(holder).encode('utf-8')).hexdigest()[:16])
+
+    def lease(self, key, holder):
+        # holder directory links into the entry until released; caller must hold the lock
+        os.makedirs(os.path.join(self.leases_dir, key), exist_ok=True)
+        write_atomic(self._lease_fname(key, holder), json.dumps({'holder': os.path.abspath(holder), 'pid': os.getpid(), 'time': time.time()}))
+        if self.verbose: print('leased build cache entry %s to %s'%(key, holder))
+
+    def release(self, holder):
+        # drop the leases of holder on any entry
+        for key in os.listdir(self.leases_dir):
+            fname = self._lease_fname(key, holder)
+            if os.path.exists(fname):
+                os.remove(fname)
+                if self.verbose: print('released build cache entry %s from %s'%(key, holder))
+
+    def _holder_links_into(self, holder, key):
+        entry = self.entry_path(key) + os.sep
+        try:
+            names = os.listdir(holder)
+        except OSError:
+            return False
+        return any(os.path.realpath(os.path.join(holder, d)).startswith(entry) for d in names if os.path.islink(os.path.join(holder, d)))
+
+    def is_leased(self, key):
+        # True if a holder still uses the entry, dropping stale leases; caller must hold the lock
+        leased = False
+        lease_dir = os.path.join(self.leases_dir, key)
+        for fname in (os.listdir(lease_dir) if os.path.isdir(lease_dir) else []):
+            fname = os.path.join(lease_dir, fname)
+            try:
+                with open(fname) as f:
+                    holder = json.load(f)['holder']
+            except (OSError, ValueError, KeyError):
+                continue
+            if self._holder_links_into(holder, key):
+                leased = True
+            else:
+                if self.verbose: print('dropping stale lease of build cache entry %s by %s'%(key, holder))
+                os.remove(fname)
+        return leased
+
+    def entries(self):
+        # list of (last_used, size_bytes, key) for completed entries
+        res = []
+        for key in os.listdir(self.entries_dir):
+            marker = os.path.join(self.entries_dir, key, COMPLETE_MARKER)
+            try:
+                last_used = os.path.getmtime(marker)
+                with open(os.path.join(self.entries_dir, key, ENTRY_INFO)) as f:
+                    size_bytes = json.load(f)['size_bytes']
+            except (OSError, ValueError, KeyError):
+                continue
+            res.append((last_used, size_bytes, key))
+        return res
+
+    def evict(self, keep=None):
+        if self.max_bytes is None:
+            return
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        for _, size_bytes, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            ## skip anything being built or restored right now
+            with self.lock(key, blocking=False) as locked:
+                if not locked or self.is_leased(key):
+                    continue
+                if self.verbose: print('evicting build cache entry %s (%d bytes)'%(key, size_bytes))
+                os.remove(os.path.join(self.entry_path(key), COMPLETE_MARKER))
+                self.discard(key)
+            total -= size_bytes
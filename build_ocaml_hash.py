@@ -2,8 +2,12 @@
 
 import argparse
 import os
+import re
+import shutil
 import subprocess
 
+import build_cache
+
 REPO='https://github.com/ocaml/ocaml'
 
 parser = argparse.ArgumentParser(description='Build a given ocaml compiler repo hash')
@@ -13,6 +17,8 @@ parser.add_argument('--configure_args', type=str, help='additional configure arg
 parser.add_argument('--repo', type=str, help='alternate URL for the repo', default=REPO)
 parser.add_argument('--use_reference', action='store_true', help='use reference to clone the source (only works on local repos)', default=False)
 parser.add_argument('--no_clean', action='store_true', default=False)
+parser.add_argument('--cache_dir', type=str, help='build cache shared between runs; the install is linked into basedir from there', default=None)
+parser.add_argument('--cache_max_gb', type=float, help='size bound of the build cache in GB, least recently used entries are evicted', default=None)
 parser.add_argument('-j', '--jobs', type=int, help='number of jobs for make in build', default=1)
 parser.add_argument('-v', '--verbose', action='store_true', default=False)
 
@@ -23,31 +29,78 @@ def shell_exec(cmd, verbose=args.verbose, check=True):
 		print('+ %s'%cmd)
 	subprocess.run(cmd, shell=True, check=check)
 
+def build(srcdir, prefix):
+	if args.use_reference:
+		shell_exec('git clone --reference %s %s %s'%(args.repo, args.repo, srcdir))
+	else:
+		shell_exec('git clone %s %s'%(args.repo, srcdir))
+
+	os.chdir(srcdir)
+	shell_exec('git checkout %s'%args.hash)
+	shell_exec('git clean -f -d -x')
+
+	# build the source
+	shell_exec('./configure --prefix %s %s'%(prefix, xtra_args))
+	shell_exec('make world -j %d'%args.jobs)
+	shell_exec('make world.opt -j %d'%args.jobs)
+	shell_exec('make install')
+	if not args.no_clean:
+		shell_exec('make clean')
+
+def full_hash(h):
+	# cache keys need the full commit hash, resolve anything else against a local repo
+	if re.match('^[0-9a-f]{40}$', h) or not os.path.isdir(args.repo):
+		return h
+	proc_output = subprocess.run('git rev-parse --verify %s^{commit}'%h, shell=True, cwd=args.repo, stdout=subprocess.PIPE, check=True)
+	return proc_output.stdout.decode('utf-8').strip()
+
+xtra_args = "" if args.configure_args is None else args.configure_args
+
 # setup the directories
 basedir = os.path.abspath(args.basedir)
-
-if args.verbose: print('making directory: %s'%basedir)
-os.mkdir(basedir)
 srcdir = os.path.join(basedir, 'src')
 
-if args.verbose: print('making directory: %s'%basedir)
-os.mkdir(srcdir)
+if args.cache_dir is None:
+	if args.verbose: print('making directory: %s'%basedir)
+	os.mkdir(basedir)
 
+	if args.verbose: print('making directory: %s'%srcdir)
+	os.mkdir(srcdir)
 
-if args.use_reference:
-	shell_exec('git clone --reference %s %s %s'%(args.repo, args.repo, srcdir))
+	build(srcdir, basedir)
 else:
-	shell_exec('git clone %s %s'%(args.repo, srcdir))
+	## NB: basedir can already be there with links to an evicted cache entry
+	max_bytes = None if args.cache_max_gb is None else int(args.cache_max_gb * 1024**3)
+	cache = build_cache.BuildCache(args.cache_dir, max_bytes=max_bytes, verbose=args.verbose)
+	key = cache.key(full_hash(args.hash), xtra_args, build_cache.toolchain_fingerprint())
+	if args.verbose: print('build cache key for %s is %s'%(args.hash, key))
+	os.makedirs(basedir, exist_ok=True)
 
-os.chdir(srcdir)
-shell_exec('git checkout %s'%args.hash)
-shell_exec('git clean -f -d -x')
+	## whatever basedir linked to before is about to be replaced
+	cache.release(basedir)
+	with cache.lock(key):
+		prefix = cache.lookup(key)
+		if prefix is None:
+			prefix = cache.prepare(key)
+			if os.path.exists(srcdir):
+				shutil.rmtree(srcdir)
+			os.mkdir(srcdir)
+			try:
+				build(srcdir, prefix)
+			except:
+				cache.discard(key)
+				raise
+			cache.publish(key, info={'hash': args.hash, 'configure_args': xtra_args})
 
-# build the source
-xtra_args = "" if args.configure_args is None else args.configure_args
-shell_exec('./configure --prefix %s %s'%(basedir, xtra_args))
-shell_exec('make world -j %d'%args.jobs)
-shell_exec('make world.opt -j %d'%args.jobs)
-shell_exec('make install')
-if not args.no_clean:
-	shell_exec('make clean')
+		## basedir uses the entry after we exit, so lease it until the links are cleaned up
+		cache.lease(key, basedir)
+
+		# link the installed compiler into basedir
+		for d in os.listdir(prefix):
+			if d in (build_cache.COMPLETE_MARKER, build_cache.ENTRY_INFO):
+				continue
+			link = os.path.join(basedir, d)
+			if os.path.islink(link):
+				os.remove(link)
+			if args.verbose: print('linking %s -> %s'%(link, os.path.join(prefix, d)))
+			os.symlink(os.path.join(prefix, d), link)
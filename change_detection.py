@@ -0,0 +1,331 @@
+# Python module for incremental change-point detection over benchmark result series
+#
+# A series is the results of one (project, branch, executable, environment,
+# benchmark) in commit order. Each series runs a two-sided CUSUM against the
+# mean/std of its current segment (the points since the last change). When
+# either sum crosses the threshold, the change is placed at the commit where
+# that sum last left zero, the segment restarts from there and, if the shift
+# is at least min_rel_change of the old mean (or, for time series, the
+# benchmark's noise floor from stability_example/noise_calibration.py, if
+# larger), the change is reported.
+#
+# The per-series detector state lives in a sqlite database next to the
+# points, so adding a commit only does O(1) work per series. The state also
+# keeps the state before its last point, and the state after every segment
+# restart is checkpointed, so a rerun of a commit or a point landing before
+# the end of its series (e.g. a backfill of older commits) only redoes the
+# series from that point on: a rerun of the last commit is a single step,
+# otherwise the state before the point is recomputed from the nearest
+# checkpoint. The changes table always holds the series' current changes,
+# so the report is rewritten from it rather than appended to.
+
+import datetime
+import json
+import math
+import os
+import sqlite3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS series (
+    id INTEGER PRIMARY KEY,
+    project TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    executable TEXT NOT NULL,
+    environment TEXT NOT NULL,
+    benchmark TEXT NOT NULL,
+    state TEXT,
+    UNIQUE (project, branch, executable, environment, benchmark)
+);
+CREATE TABLE IF NOT EXISTS points (
+    series_id INTEGER NOT NULL,
+    commitid TEXT NOT NULL,
+    order_key TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (series_id, commitid)
+);
+CREATE INDEX IF NOT EXISTS points_seq ON points (series_id, seq);
+CREATE TABLE IF NOT EXISTS changes (
+    series_id INTEGER NOT NULL,
+    commitid TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    before_mean REAL,
+    after_mean REAL,
+    rel_change REAL,
+    detected TEXT,
+    detected_with TEXT,
+    direction TEXT,
+    units TEXT,
+    PRIMARY KEY (series_id, commitid)
+);
+CREATE TABLE IF NOT EXISTS restarts (
+    series_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (series_id, seq)
+);
+'''
+
+## columns added to the changes table after its first version
+CHANGES_REPORT_COLUMNS = ['detected_with', 'direction', 'units']
+
+SERIES_KEY = ('project', 'branch', 'executable', 'environment', 'benchmark')
+
+# noise_calibration.py measures run times, so its floors only apply to series in these units
+NOISE_FLOOR_UNITS = ('seconds',)
+
+def now_str():
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+def initial_state():
+    return {
+        'seq': -1,          # seq of the last point seen
+        'last_order': '',   # order_key of the last point seen
+        'seg_start': 0,     # seq of the first point of the current segment
+        'n': 0, 'mean': 0., 'm2': 0.,  # Welford over the segment's baseline points
+        'pos': 0., 'pos_start': None,  # upward CUSUM and the seq where it left zero
+        'neg': 0., 'neg_start': None,  # downward CUSUM
+    }
+
+def checkpoint(state):
+    # a copy of the detector part of state to restart it from
+    return {k: v for k, v in state.items() if k not in ('prev', 'last_order')}
+
+class ChangeDetector:
+    def __init__(self, db_path, threshold=5.0, drift=0.5, min_segment=5, min_rel_change=0.02,
+                 noise_floor=0.005, noise_floors=None, default_noise_floor=0., verbose=False):
+        # threshold and drift are in units of the segment std, which is
+        # floored at noise_floor (relative to the mean) so very stable series
+        # don't alarm on jitter; noise_floors (benchmark -> relative shift)
+        # raise min_rel_change for time series of benchmarks known to move
+        # that much anyway, default_noise_floor for those not calibrated
+        self.db_path = db_path
+        self.threshold = threshold
+        self.drift = drift
+        self.min_segment = min_segment
+        self.min_rel_change = min_rel_change
+        self.noise_floor = noise_floor
+        self.noise_floors = noise_floors or {}
+        self.default_noise_floor = default_noise_floor
+        self.verbose = verbose
+        self.conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        self.conn.executescript(SCHEMA)
+        columns = set(r[1] for r in self.conn.execute('PRAGMA table_info(changes)'))
+        for c in CHANGES_REPORT_COLUMNS:
+            if c not in columns:
+                self.conn.execute('ALTER TABLE changes ADD COLUMN %s TEXT'%c)
+
+    def close(self):
+        self.conn.close()
+
+    def _series(self, r):
+        key = [r[k] for k in SERIES_KEY]
+        row = self.conn.execute('SELECT id, state FROM series WHERE %s'%' AND '.join('%s = ?'%k for k in SERIES_KEY), key).fetchone()
+        if row is None:
+            ## 'checkpoints' marks series whose restarts are all in the restarts table
+            state = dict(initial_state(), checkpoints=True)
+            cur = self.conn.execute('INSERT INTO series (%s, state) VALUES (?, ?, ?, ?, ?, ?)'%','.join(SERIES_KEY), key + [json.dumps(state)])
+            return cur.lastrowid, state
+        return row[0], json.loads(row[1])
+
+    def _segment_points(self, series_id, start_seq, end_seq):
+        return self.conn.execute('SELECT seq, commitid, value FROM points WHERE series_id = ? AND seq >= ? AND seq <= ? ORDER BY seq', (series_id, start_seq, end_seq)).fetchall()
+
+    def _min_change(self, r):
+        # smallest relative shift reported for the series of result r
+        if r.get('units', 'seconds') not in NOISE_FLOOR_UNITS:
+            return self.min_rel_change
+        return max(self.min_rel_change, self.noise_floors.get(r['benchmark'], self.default_noise_floor))
+
+    def _step(self, series_id, min_change, state, seq, value):
+        # feed one point through the detector, returns a change dict or None
+        state['seq'] = seq
+        if state['n'] < self.min_segment:
+            self._add_baseline(state, value)
+            return None
+
+        sigma = max(math.sqrt(state['m2'] / (state['n'] - 1)), self.noise_floor * abs(state['mean']))
+        if sigma == 0:
+            self._add_baseline(state, value)
+            return None
+        z = (value - state['mean']) / sigma
+
+        if state['pos'] == 0 and z - self.drift > 0:
+            state['pos_start'] = seq
+        if state['neg'] == 0 and -z - self.drift > 0:
+            state['neg_start'] = seq
+        state['pos'] = max(0., state['pos'] + z - self.drift)
+        state['neg'] = max(0., state['neg'] - z - self.drift)
+        if state['pos'] == 0: state['pos_start'] = None
+        if state['neg'] == 0: state['neg_start'] = None
+
+        if state['pos'] > self.threshold or state['neg'] > self.threshold:
+            change_seq = state['pos_start'] if state['pos'] > self.threshold else state['neg_start']
+            return self._restart_segment(series_id, min_change, state, change_seq)
+
+        if state['pos'] == 0 and state['neg'] == 0:
+            ## only points that aren't part of an excursion update the baseline
+            self._add_baseline(state, value)
+        return None
+
+    def _add_baseline(self, state, value):
+        state['n'] += 1
+        delta = value - state['mean']
+        state['mean'] += delta / state['n']
+        state['m2'] += delta * (value - state['mean'])
+
+    def _restart_segment(self, series_id, min_change, state, change_seq):
+        ## NB: only the points seen so far, so a replay sees what an incremental run saw
+        points = self._segment_points(series_id, change_seq, state['seq'])
+        before_mean = state['mean']
+        after_mean = sum(p[2] for p in points) / len(points)
+        rel_change = (after_mean - before_mean) / before_mean if before_mean else math.inf
+
+        ## the new segment's baseline is the points after the change
+        seq, last_order = state['seq'], state.get('last_order', '')
+        state.update(initial_state())
+        state['seq'], state['last_order'] = seq, last_order
+        state['seg_start'] = change_seq
+        for p in points:
+            self._add_baseline(state, p[2])
+
+        if abs(rel_change) < min_change:
+            return None
+        return {'commitid': points[0][1], 'seq': change_seq, 'before_mean': before_mean, 'after_mean': after_mean, 'rel_change': rel_change}
+
+    def _advance(self, series_id, min_change, state, seq, value):
+        # _step keeping the state before the point and checkpointing segment restarts
+        prev = checkpoint(state)
+        seg_start = state['seg_start']
+        change = self._step(series_id, min_change, state, seq, value)
+        state['prev'] = prev
+        if state['seg_start'] != seg_start:
+            self.conn.execute('INSERT OR REPLACE INTO restarts VALUES (?, ?, ?)', (series_id, seq, json.dumps(checkpoint(state))))
+        return change
+
+    def _state_before(self, series_id, min_change, state, seq):
+        # the detector state after the point before seq
+        if seq == state['seq'] and state.get('prev') is not None:
+            return dict(state['prev'])
+        row = self.conn.execute('SELECT seq, state FROM restarts WHERE series_id = ? AND seq < ? ORDER BY seq DESC LIMIT 1', (series_id, seq)).fetchone()
+        before, start = (json.loads(row[1]), row[0] + 1) if row else (initial_state(), 0)
+        ## no segment restarts between the checkpoint and seq, so this only rebuilds the state
+        for p in self._segment_points(series_id, start, seq - 1):
+            self._step(series_id, min_change, before, p[0], p[2])
+        return before
+
+    def _rewrite(self, series_id, min_change, state, commitid, order_key, value):
+        # put a rerun or out of order point into the series and run the
+        # detector again from there; returns the new state and the changes found
+        row = self.conn.execute('SELECT seq, order_key FROM points WHERE series_id = ? AND commitid = ?', (series_id, commitid)).fetchone()
+        if row is not None:
+            self.conn.execute('UPDATE points SET value = ?, order_key = ? WHERE series_id = ? AND commitid = ?', (value, order_key, series_id, commitid))
+        else:
+            self.conn.execute('INSERT INTO points VALUES (?, ?, ?, ?, ?)', (series_id, commitid, order_key, state['seq'] + 1, value))
+
+        if row is not None and row[1] == order_key:
+            from_seq = row[0]
+        else:
+            ## renumber the series in order_key order
+            rows = self.conn.execute('SELECT commitid, seq FROM points WHERE series_id = ? ORDER BY order_key, rowid', (series_id,)).fetchall()
+            self.conn.executemany('UPDATE points SET seq = ? WHERE series_id = ? AND commitid = ?', [(i, series_id, c) for i, (c, seq) in enumerate(rows) if seq != i])
+            from_seq = min(i for i, (c, seq) in enumerate(rows) if c == commitid)
+            if row is not None:
+                from_seq = min(from_seq, row[0])
+        if not state.get('checkpoints'):
+            ## a series from before the restarts were checkpointed
+            from_seq = 0
+
+        n_points = self.conn.execute('SELECT COUNT(*) FROM points WHERE series_id = ?', (series_id,)).fetchone()[0]
+        if self.verbose: print('rerunning change detection over %d of %d points of series %d'%(n_points - from_seq, n_points, series_id))
+        new_state = self._state_before(series_id, min_change, state, from_seq) if from_seq > 0 else initial_state()
+        new_state['checkpoints'] = True
+        ## changes and restarts found from from_seq on are found again (or not)
+        self.conn.execute('DELETE FROM changes WHERE series_id = ? AND seq > ?', (series_id, new_state['seg_start']))
+        self.conn.execute('DELETE FROM restarts WHERE series_id = ? AND seq >= ?', (series_id, from_seq))
+
+        changes = []
+        for seq, c, v in self._segment_points(series_id, from_seq, n_points - 1):
+            change = self._advance(series_id, min_change, new_state, seq, v)
+            if change:
+                changes.append(change)
+        new_state['last_order'] = self.conn.execute('SELECT MAX(order_key) FROM points WHERE series_id = ?', (series_id,)).fetchone()[0] or ''
+        return new_state, changes
+
+    def add(self, results, order_key=''):
+        # add one commit's results (dicts as made for codespeed upload), where
+        # order_key sorts commits into series order (e.g. the commit date);
+        # returns the changes found, as report records
+        new_changes = []
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            for r in results:
+                series_id, state = self._series(r)
+                commitid = r.get('commitid_long', r['commitid'])
+                exists = self.conn.execute('SELECT 1 FROM points WHERE series_id = ? AND commitid = ?', (series_id, commitid)).fetchone()
+                if exists or order_key < state['last_order']:
+                    ## a rerun of a commit or an older commit, so the series history changed
+                    known = {c[0]: (c[1], c[2]) for c in self.conn.execute('SELECT commitid, detected, detected_with FROM changes WHERE series_id = ?', (series_id,))}
+                    state, changes = self._rewrite(series_id, self._min_change(r), state, commitid, order_key, r['result_value'])
+                    kept = set(c[0] for c in self.conn.execute('SELECT commitid FROM changes WHERE series_id = ?', (series_id,)))
+                    for c in set(known) - kept - set(c['commitid'] for c in changes):
+                        print('WARN: change at %s in %s is no longer detected after rerunning its series'%(c[:7], r['benchmark']))
+                else:
+                    known = {}
+                    seq = state['seq'] + 1
+                    self.conn.execute('INSERT INTO points VALUES (?, ?, ?, ?, ?)', (series_id, commitid, order_key, seq, r['result_value']))
+                    state['last_order'] = order_key
+                    change = self._advance(series_id, self._min_change(r), state, seq, r['result_value'])
+                    changes = [change] if change else []
+
+                self.conn.execute('UPDATE series SET state = ? WHERE id = ?', (json.dumps(state), series_id))
+                for c in changes:
+                    ## a change found again by a replay keeps when it was first detected
+                    detected, detected_with = known.get(c['commitid'], (now_str(), commitid))
+                    direction = 'regression' if (c['rel_change'] > 0) == r.get('lessisbetter', True) else 'improvement'
+                    self.conn.execute('INSERT OR REPLACE INTO changes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                      (series_id, c['commitid'], c['seq'], c['before_mean'], c['after_mean'], c['rel_change'],
+                                       detected, detected_with, direction, r.get('units', '')))
+                    if c['commitid'] in known:
+                        continue
+                    record = {k: r[k] for k in SERIES_KEY}
+                    record.update({
+                        'commitid': c['commitid'],
+                        'detected_with': detected_with,
+                        'before_mean': c['before_mean'],
+                        'after_mean': c['after_mean'],
+                        'rel_change': c['rel_change'],
+                        'direction': direction,
+                        'units': r.get('units', ''),
+                        'detected': detected,
+                    })
+                    new_changes.append(record)
+            self.conn.execute('COMMIT')
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
+
+        for c in new_changes:
+            print('%s: %s %+.1f%% at %s (%s/%s/%s)'%(c['direction'].upper(), c['benchmark'], 100*c['rel_change'], c['commitid'][:7], c['project'], c['executable'], c['environment']))
+        return new_changes
+
+    def report_records(self):
+        # the report record of every current change, in series then commit order
+        cols = ['s.%s'%k for k in SERIES_KEY] + ['c.commitid', 'c.detected_with', 'c.before_mean', 'c.after_mean', 'c.rel_change', 'c.direction', 'c.units', 'c.detected']
+        rows = self.conn.execute('SELECT %s FROM changes c JOIN series s ON c.series_id = s.id ORDER BY s.id, c.seq'%','.join(cols))
+        return [dict(zip([c[2:] for c in cols], row)) for row in rows]
+
+    def write_report(self, fname):
+        # rewrite the report from the changes table, so changes a replay withdrew or moved are updated
+        tmp_fname = '%s.tmp.%d'%(fname, os.getpid())
+        with open(tmp_fname, 'w') as f:
+            for c in self.report_records():
+                f.write(json.dumps(c, sort_keys=True) + '\n')
+        os.replace(tmp_fname, fname)
+
+def load_noise_floors(fname):
+    # (benchmark -> noise floor, default noise floor) from a noise_calibration.py json
+    with open(fname) as f:
+        calibration = json.load(f)
+    noise_floors = {name: b['noise_floor'] for name, b in calibration['benchmarks'].items()}
+    return noise_floors, calibration.get('default_noise_floor', 0.)
@@ -0,0 +1,153 @@
+# Python module for bulk loading results straight into a codespeed sqlite database
+#
+# Takes the same result dicts as codespeed_upload and writes them with the
+# same get-or-create rules as codespeed's result/add/json/ view, but in one
+# transaction per load. Loading is idempotent: a result for an existing
+# (revision, executable, benchmark, environment) is updated in place.
+#
+# NB: codespeed builds its 'changes' reports when results arrive over HTTP;
+#     these are not generated here.
+
+import datetime
+import sqlite3
+
+# values for NOT NULL columns django doesn't give a database default
+COLUMN_DEFAULTS = {
+    'codespeed_project': {'repo_type': 'N', 'repo_path': '', 'repo_user': '', 'repo_pass': '', 'commit_browsing_url': '', 'track': 1, 'default_branch': ''},
+    'codespeed_branch': {'display_on_comparison_page': 1},
+    'codespeed_revision': {'tag': '', 'message': '', 'author': ''},
+    'codespeed_executable': {'description': ''},
+    'codespeed_benchmark': {'benchmark_type': 'C', 'data_type': 'U', 'description': '', 'units_title': 'Time', 'units': 'seconds', 'lessisbetter': 1, 'default_on_comparison': 1},
+}
+
+RESULT_KEY = ('revision_id', 'executable_id', 'benchmark_id', 'environment_id')
+
+def now_str():
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+class CodespeedDB:
+    def __init__(self, db_path, timeout=60, verbose=False):
+        self.db_path = db_path
+        self.verbose = verbose
+        self.conn = sqlite3.connect(db_path, timeout=timeout, isolation_level=None)
+        self.columns = {}
+        self.ids = {}
+        self.has_result_key = self._has_unique_index('codespeed_result', RESULT_KEY)
+
+    def close(self):
+        self.conn.close()
+
+    def _table_columns(self, table):
+        if table not in self.columns:
+            self.columns[table] = [r[1] for r in self.conn.execute('PRAGMA table_info(%s)'%table)]
+        return self.columns[table]
+
+    def _has_unique_index(self, table, cols):
+        for index in self.conn.execute('PRAGMA index_list(%s)'%table):
+            # (seq, name, unique, origin, partial)
+            if index[2]:
+                index_cols = [r[2] for r in self.conn.execute('PRAGMA index_info(%s)'%index[1])]
+                if sorted(index_cols) == sorted(cols):
+                    return True
+        return False
+
+    def _get_or_create(self, table, keys, values={}):
+        # id of the row matching keys, inserting it (with values and defaults) if needed
+        cache_key = (table, tuple(sorted(keys.items())))
+        if cache_key in self.ids:
+            return self.ids[cache_key]
+
+        where = ' AND '.join('%s = ?'%k for k in keys)
+        row = self.conn.execute('SELECT id FROM %s WHERE %s'%(table, where), list(keys.values())).fetchone()
+        if row is None:
+            row_values = {c: v for c, v in COLUMN_DEFAULTS.get(table, {}).items() if c in self._table_columns(table)}
+            row_values.update({c: v for c, v in values.items() if c in self._table_columns(table)})
+            row_values.update(keys)
+            cols = list(row_values)
+            cur = self.conn.execute('INSERT INTO %s (%s) VALUES (%s)'%(table, ','.join(cols), ','.join('?'*len(cols))), [row_values[c] for c in cols])
+            if self.verbose: print('created %s %s'%(table, keys))
+            row = (cur.lastrowid,)
+
+        self.ids[cache_key] = row[0]
+        return row[0]
+
+    def _environment_id(self, name):
+        cache_key = ('codespeed_environment', name)
+        if cache_key not in self.ids:
+            row = self.conn.execute('SELECT id FROM codespeed_environment WHERE name = ?', (name,)).fetchone()
+            if row is None:
+                # codespeed's own upload refuses unknown environments too
+                raise ValueError('environment "%s" not found in %s'%(name, self.db_path))
+            self.ids[cache_key] = row[0]
+        return self.ids[cache_key]
+
+    def _result_row(self, r):
+        project_id = self._get_or_create('codespeed_project', {'name': r['project']})
+        branch_id = self._get_or_create('codespeed_branch', {'name': r['branch'], 'project_id': project_id})
+        ## keyed on commitid as codespeed's result/add does, so both paths share revisions
+        revision_id = self._get_or_create('codespeed_revision', {'commitid': r['commitid'], 'branch_id': branch_id},
+                                          {'project_id': project_id, 'date': r.get('revision_date') or now_str()})
+        executable_id = self._get_or_create('codespeed_executable', {'name': r['executable'], 'project_id': project_id},
+                                            {'description': r.get('executable_description', '')})
+        benchmark_id = self._get_or_create('codespeed_benchmark', {'name': r['benchmark']},
+                                           {'units': r.get('units', 'seconds'), 'units_title': r.get('units_title', 'Time'), 'lessisbetter': int(r.get('lessisbetter', True))})
+        environment_id = self._environment_id(r['environment'])
+        return {
+            'value': r['result_value'],
+            'std_dev': r.get('std_dev'),
+            'val_min': r.get('min'),
+            'val_max': r.get('max'),
+            'date': r.get('result_date') or now_str(),
+            'revision_id': revision_id,
+            'executable_id': executable_id,
+            'benchmark_id': benchmark_id,
+            'environment_id': environment_id,
+        }
+
+    def has_results(self, project, branch, commitid, executable, environment):
+        # True if any result is stored for the commit (given as full or short hash);
+        # NB: loads from before revisions were keyed on the short hash used the full one
+        row = self.conn.execute('''SELECT 1 FROM codespeed_result r
+            JOIN codespeed_revision rev ON r.revision_id = rev.id
+            JOIN codespeed_branch b ON rev.branch_id = b.id
+            JOIN codespeed_project p ON b.project_id = p.id
+            JOIN codespeed_executable e ON r.executable_id = e.id
+            JOIN codespeed_environment env ON r.environment_id = env.id
+            WHERE p.name = ? AND b.name = ? AND rev.commitid IN (?, ?) AND e.name = ? AND env.name = ? LIMIT 1''',
+            (project, branch, commitid, commitid[:7], executable, environment)).fetchone()
+        return row is not None
+
+    def load(self, results):
+        # write all results in one transaction, returns the number written
+        if not results:
+            return 0
+
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = [self._result_row(r) for r in results]
+            cols = list(rows[0])
+            insert = 'INSERT INTO codespeed_result (%s) VALUES (%s)'%(','.join(cols), ','.join('?'*len(cols)))
+            if self.has_result_key:
+                update_cols = [c for c in cols if c not in RESULT_KEY]
+                self.conn.executemany(insert + ' ON CONFLICT(%s) DO UPDATE SET %s'%(','.join(RESULT_KEY), ','.join('%s=excluded.%s'%(c, c) for c in update_cols)),
+                                      [[row[c] for c in cols] for row in rows])
+            else:
+                where = ' AND '.join('%s = ?'%k for k in RESULT_KEY)
+                self.conn.executemany('DELETE FROM codespeed_result WHERE %s'%where, [[row[k] for k in RESULT_KEY] for row in rows])
+                self.conn.executemany(insert, [[row[c] for c in cols] for row in rows])
+            self.conn.execute('COMMIT')
+        except:
+            self.conn.execute('ROLLBACK')
+            ## ids created in the rolled back transaction are no longer valid
+            self.ids = {}
+            raise
+
+        if self.verbose: print('loaded %d results into %s'%(len(rows), self.db_path))
+        return len(rows)
+
+def load_data_to_db(db_path, data, verbose=False):
+    db = CodespeedDB(db_path, verbose=verbose)
+    try:
+        return db.load(data)
+    finally:
+        db.close()
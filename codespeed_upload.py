@@ -1,34 +1,231 @@
 
+import collections
+import fcntl
+import glob
+import http.client
 import json
-import urllib.error
+import os
+import threading
+import time
 import urllib.parse
-import urllib.request
+import uuid
 
 
-def post_data_to_server(codespeed_url, data, dry_run=False, max_chunk=8, verbose=False):
-    for chunk in [data[i:(i+max_chunk)] for i in range(0, len(data), max_chunk)]:
-        json_data = {'json': json.dumps(chunk)}
-        url = '%sresult/add/json/' % codespeed_url
-        data_payload = urllib.parse.urlencode(json_data).encode('ascii')
+class CodespeedUploader:
+    # Uploads results to codespeed's result/add/json/ endpoint:
+    #  - each worker thread keeps its own keep-alive connection
+    #  - chunk size doubles on success and halves on failure, up to max_chunk
+    #  - failed chunks are retried with exponential backoff
+    #  - a rejected chunk is split in half and resent until the results
+    #    codespeed won't take are on their own
+    #  - with a spool_dir, results are written to disk before sending and
+    #    only removed once codespeed has accepted them; anything left over
+    #    (e.g. codespeed was down) is replayed by the next upload
+    def __init__(self, codespeed_url, spool_dir=None, initial_chunk=8, max_chunk=64, max_workers=4,
+                 max_retries=5, backoff_secs=1.0, timeout=120, verbose=False):
+        url = urllib.parse.urlsplit(codespeed_url)
+        self.codespeed_url = codespeed_url
+        self.connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = url.netloc
+        self.path = '%sresult/add/json/' % (url.path if url.path.endswith('/') else url.path + '/')
+        self.spool_dir = spool_dir
+        self.chunk_size = min(initial_chunk, max_chunk)
+        self.max_chunk = max_chunk
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_secs = backoff_secs
+        self.timeout = timeout
+        self.verbose = verbose
+        self.local = threading.local()
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.in_flight = 0
+        self.all_sent = True
+        if self.spool_dir:
+            os.makedirs(self.spool_dir, exist_ok=True)
 
-        if dry_run:
-            print('DRY_RUN would have sent request: ')
-            print(' url: %s'%url)
-            print(' data: %s'%data_payload)
-            return
+    def _connection(self):
+        if getattr(self.local, 'conn', None) is None:
+            self.local.conn = self.connection_class(self.netloc, timeout=self.timeout)
+        return self.local.conn
 
-        if verbose:
-            print('requesting url=%s  data=%s'%(url, data_payload))
+    def _reset_connection(self):
+        if getattr(self.local, 'conn', None) is not None:
+            self.local.conn.close()
+            self.local.conn = None
 
-        response = "None"
+    def _post(self, chunk):
+        # returns (sent, retriable)
+        data_payload = urllib.parse.urlencode({'json': json.dumps(chunk)}).encode('ascii')
+        if self.verbose:
+            print('requesting url=%s%s  data=%s'%(self.netloc, self.path, data_payload))
         try:
-            f = urllib.request.urlopen(url, data_payload)
-        except urllib.error.HTTPError as e:
-            print(str(e))
-            print(e.read())
-            return
-        response = f.read()
-        f.close()
+            conn = self._connection()
+            conn.request('POST', self.path, body=data_payload, headers={'Content-Type': 'application/x-www-form-urlencoded'})
+            response = conn.getresponse()
+            body = response.read()
+        except (http.client.HTTPException, OSError) as e:
+            print('WARN: upload of %d results to %s failed: %s'%(len(chunk), self.codespeed_url, e))
+            self._reset_connection()
+            return False, True
+
+        if response.status in (200, 202):
+            print("Server (%s) response: %s\n" % (self.codespeed_url, body))
+            return True, False
+
+        print('WARN: upload of %d results to %s gave HTTP %d: %s'%(len(chunk), self.codespeed_url, response.status, body))
+        if response.will_close:
+            self._reset_connection()
+        return False, response.status >= 500 or response.status in (408, 413, 429)
+
+    def _spool(self, data):
+        fname = os.path.join(self.spool_dir, '%s_%d_%s.json'%(time.strftime('%Y%m%d_%H%M%S'), os.getpid(), uuid.uuid4().hex[:8]))
+        tmp_fname = fname + '.tmp'
+        with open(tmp_fname, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fname, fname)
+        return fname
+
+    def _claim_spool_files(self):
+        # take a lock on every spool file, skipping ones another process is sending
+        batches = []
+        for fname in sorted(glob.glob(os.path.join(self.spool_dir, '*.json'))):
+            try:
+                lock_file = open(fname, 'r')
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            if not os.path.exists(fname):
+                ## finished by someone else between the glob and the lock
+                lock_file.close()
+                continue
+            try:
+                results = json.load(lock_file)
+            except ValueError:
+                print('ERROR: could not read upload spool file %s'%fname)
+                lock_file.close()
+                continue
+            batches.append(_Batch(results, fname, lock_file))
+        return batches
+
+    def _finish(self, batch):
+        # called with self.cond held once every result in the batch is sent or given up on
+        if batch.unsent:
+            self.all_sent = False
+            print('ERROR: failed to upload %d results to %s%s'%(len(batch.unsent), self.codespeed_url,
+                  ' (kept in %s for the next run)'%batch.fname if batch.fname else ''))
+        if batch.rejected:
+            self.all_sent = False
+            print('ERROR: %s rejected %d results%s'%(self.codespeed_url, len(batch.rejected),
+                  ' (written to %s.rejected)'%batch.fname if batch.fname else ''))
+        if batch.fname:
+            if batch.rejected:
+                with open(batch.fname + '.rejected', 'a') as f:
+                    json.dump(batch.rejected, f)
+                    f.write('\n')
+            if batch.unsent:
+                tmp_fname = batch.fname + '.tmp'
+                with open(tmp_fname, 'w') as f:
+                    json.dump(batch.unsent, f)
+                os.replace(tmp_fname, batch.fname)
+            else:
+                os.remove(batch.fname)
+            batch.lock_file.close()
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.queue and self.in_flight > 0:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                batch, results, attempt = self.queue.popleft()
+                n = min(self.chunk_size, len(results))
+                chunk, rest = results[:n], results[n:]
+                if rest:
+                    self.queue.appendleft((batch, rest, attempt))
+                self.in_flight += 1
+
+            sent, retriable = self._post(chunk)
+
+            if not sent and retriable and attempt < self.max_retries:
+                with self.cond:
+                    self.chunk_size = max(1, self.chunk_size // 2)
+                time.sleep(self.backoff_secs * 2**attempt)
 
-        print("Server (%s) response: %s\n" % (codespeed_url, response))
+            with self.cond:
+                self.in_flight -= 1
+                if sent:
+                    self.chunk_size = min(self.max_chunk, self.chunk_size * 2)
+                    batch.outstanding -= len(chunk)
+                elif retriable and attempt < self.max_retries:
+                    self.queue.append((batch, chunk, attempt + 1))
+                elif not retriable and len(chunk) > 1:
+                    ## a bad result rejects its whole chunk, so narrow it down
+                    half = len(chunk) // 2
+                    self.queue.appendleft((batch, chunk[half:], attempt))
+                    self.queue.appendleft((batch, chunk[:half], attempt))
+                else:
+                    (batch.unsent if retriable else batch.rejected).extend(chunk)
+                    batch.outstanding -= len(chunk)
+                if batch.outstanding == 0:
+                    self._finish(batch)
+                self.cond.notify_all()
+
+    def upload(self, data):
+        # True if everything (including replayed spool files) reached codespeed
+        self.all_sent = True
+        if self.spool_dir:
+            if data:
+                self._spool(data)
+            batches = self._claim_spool_files()
+        else:
+            batches = [_Batch(data)] if data else []
+
+        for batch in batches:
+            if batch.fname and self.verbose:
+                print('uploading %d results from spool file %s'%(len(batch.results), batch.fname))
+            if batch.outstanding == 0:
+                with self.cond:
+                    self._finish(batch)
+            else:
+                self.queue.append((batch, batch.results, 0))
+
+        n_workers = min(self.max_workers, max(sum(len(b.results) for b in batches), 1))
+        workers = [threading.Thread(target=self._worker) for _ in range(n_workers)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        return self.all_sent
+
+
+class _Batch:
+    def __init__(self, results, fname=None, lock_file=None):
+        self.results = results
+        self.fname = fname
+        self.lock_file = lock_file
+        self.outstanding = len(results)
+        self.unsent = []
+        self.rejected = []
+
+
+def post_data_to_server(codespeed_url, data, dry_run=False, max_chunk=64, verbose=False, spool_dir=None, max_workers=4):
+    if dry_run:
+        url = '%sresult/add/json/' % codespeed_url
+        for chunk in [data[i:(i+max_chunk)] for i in range(0, len(data), max_chunk)]:
+            data_payload = urllib.parse.urlencode({'json': json.dumps(chunk)}).encode('ascii')
+            print('DRY_RUN would have sent request: ')
+            print(' url: %s'%url)
+            print(' data: %s'%data_payload)
+        return True
 
+    uploader = CodespeedUploader(codespeed_url, spool_dir=spool_dir, max_chunk=max_chunk, max_workers=max_workers, verbose=verbose)
+    return uploader.upload(data)
@@ -1,26 +1,117 @@
 # Python module for getting git commits from the command line args
 
 import datetime
+import functools
 import os
 import subprocess
 import sys
+import threading
+
+import github_status
+import pipeline
 
 def parseISO8601Likedatetime(s):
 	return datetime.datetime.strptime(s, "%Y-%m-%d %H:%M:%S %z")
 
+class GitVersionResolver:
+	# Reads the VERSION file of many commits through two long running
+	# 'git cat-file' processes rather than a shell per commit. Contents are
+	# memoized per blob id, so commits that don't touch VERSION cost one
+	# --batch-check lookup.
+	def __init__(self, repo_path):
+		self.repo_path = os.path.abspath(repo_path)
+		self.lock = threading.Lock()
+		self.blob_versions = {}
+		self.check_proc = self._start('--batch-check')
+		self.batch_proc = None
+
+	def _start(self, mode):
+		return subprocess.Popen(['git', 'cat-file', mode], cwd=self.repo_path, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+	def _object_id(self, spec):
+		self.check_proc.stdin.write(('%s\n'%spec).encode('utf-8'))
+		self.check_proc.stdin.flush()
+		# '<oid> <type> <size>' or '<spec> missing'
+		header = self.check_proc.stdout.readline().decode('utf-8').split()
+		if len(header) != 3:
+			return None
+		return header[0]
+
+	def _contents(self, oid):
+		if self.batch_proc is None:
+			self.batch_proc = self._start('--batch')
+		self.batch_proc.stdin.write(('%s\n'%oid).encode('utf-8'))
+		self.batch_proc.stdin.flush()
+		header = self.batch_proc.stdout.readline().decode('utf-8').split()
+		if len(header) != 3:
+			return None
+		contents = self.batch_proc.stdout.read(int(header[2]))
+		self.batch_proc.stdout.read(1) # trailing newline
+		return contents.decode('utf-8')
+
+	def version(self, h):
+		# first line of VERSION at commit h ('' if there is no VERSION file)
+		with self.lock:
+			oid = self._object_id('%s:VERSION'%h)
+			if oid is None:
+				return ''
+			if oid not in self.blob_versions:
+				contents = self._contents(oid)
+				self.blob_versions[oid] = contents.split('\n')[0] if contents else ''
+			return self.blob_versions[oid]
+
+	def commit_date(self, h):
+		# committer date of commit h as 'YYYY-MM-DD HH:MM:SS' UTC (None if not found)
+		with self.lock:
+			contents = self._contents(h)
+		if not contents:
+			return None
+		for l in contents.split('\n'):
+			if l.startswith('committer '):
+				# 'committer <name> <<email>> <unix time> <tz>'
+				timestamp = int(l.rsplit(' ', 2)[1])
+				return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+			if not l:
+				break
+		return None
+
+	def close(self):
+		for proc in [self.check_proc, self.batch_proc]:
+			if proc is not None:
+				proc.stdin.close()
+				proc.wait()
+
+_version_resolvers = {}
+_version_resolvers_lock = threading.Lock()
+
+def get_version_resolver(repo_path):
+	# resolvers are shared per repo for the life of the process
+	repo_path = os.path.abspath(repo_path)
+	with _version_resolvers_lock:
+		if repo_path not in _version_resolvers:
+			_version_resolvers[repo_path] = GitVersionResolver(repo_path)
+		return _version_resolvers[repo_path]
+
+def parse_bisect_spec(s):
+	# 'bisect=<good>..<bad>:<benchmark>[:threshold]' -> (good, bad, benchmark, threshold)
+	spec = s.split('=', 1)[1]
+	parts = spec.split(':')
+	if '..' not in parts[0] or len(parts) not in (2, 3) or not parts[1]:
+		raise ValueError('bisect needs the form bisect=<good>..<bad>:<benchmark>[:threshold] (got "%s")'%s)
+	good, bad = parts[0].split('..', 1)
+	threshold = float(parts[2]) if len(parts) == 3 else 0.02
+	return good, bad, parts[1], threshold
+
 def get_git_hashes(args):
-	def shell_exec(cmd, verbose=args.verbose, check=False, stdout=None, stderr=None):
-		if verbose:
-			print('+ %s'%cmd)
-		return subprocess.run(cmd, shell=True, check=check, stdout=stdout, stderr=stderr)
+	shell_exec = functools.partial(pipeline.shell_exec, verbose=args.verbose)
 
 	def get_major_minor_patch(i):                     # "4.09.2+dev0-2020-03-13"
 		n = i.split('+')[0].split('.')            # ['4', '09', '2']
 		return (int(n[0]), int(n[1]), int(n[2]))  # 4, 9, 2
 
 	def check_ocaml_version_mismatch(user_input, git_hash):
-		proc_output = shell_exec('git show %s:VERSION | head -1' % (git_hash), stdout=subprocess.PIPE)
-		version = proc_output.stdout.decode('utf-8').split('\n')[0]
+		version = get_version_resolver(repo_path).version(git_hash)
+		if args.verbose: print('%s has VERSION %s'%(git_hash, version))
 
 		major1, minor1, patch1 = get_major_minor_patch(user_input)
 		major2, minor2, patch2 = get_major_minor_patch(version)
@@ -70,16 +161,11 @@ def get_git_hashes(args):
 		all_hashes = proc_output.stdout.decode('utf-8').split('\n')[::-1]
 		all_hashes = filter(bool, all_hashes) # remove empty strings
 
-		def get_hash_status(h):
-			curl_xtra_args = '-s'
-			if args.github_oauth_token is not None:
-				curl_xtra_args = curl_xtra_args + ' -H "Authorization: token %s"'%args.github_oauth_token
-			proc_output = shell_exec('curl %s https://api.github.com/repos/ocaml/ocaml/commits/%s/status | jq .state'%(curl_xtra_args, h), stdout=subprocess.PIPE)
-			return proc_output.stdout.decode('utf-8').strip().strip('"')
+		fetcher = github_status.StatusFetcher(api_url=args.github_api_url, oauth_token=args.github_oauth_token, cache_file=args.github_status_cache, verbose=args.verbose)
+		states = fetcher.states(all_hashes)
 
 		hashes = []
-		for h in all_hashes:
-			state = get_hash_status(h)
+		for h, state in states.items():
 			if args.verbose: print('%s is state of %s'%(state, h))
 			if state == 'success':
 				hashes.append(h)
@@ -94,6 +180,13 @@ def get_git_hashes(args):
 		all_hashes = filter(bool, all_hashes) # remove empty strings
 		hashes = [hc.split(' ')[0] for hc in all_hashes]
 
+	elif args.commit_choice_method.startswith('bisect='):
+		# the good commit followed by the first parent line up to the bad commit
+		good, bad, _, _ = parse_bisect_spec(args.commit_choice_method)
+		proc_output = shell_exec('git rev-list --first-parent %s..%s'%(good, bad), stdout=subprocess.PIPE)
+		good_hash = shell_exec('git rev-parse %s'%good, stdout=subprocess.PIPE).stdout.decode('utf-8').strip()
+		hashes = [good_hash] + proc_output.stdout.decode('utf-8').split('\n')[::-1]
+
 	elif args.commit_choice_method.startswith('hash='):
 		hashes = args.commit_choice_method.split('=')[1]
 		hashes = hashes.split(',')
@@ -0,0 +1,147 @@
+# Python module for looking up github commit statuses concurrently with an on-disk cache
+
+import http.client
+import json
+import os
+import threading
+import time
+import urllib.parse
+
+from concurrent.futures import ThreadPoolExecutor
+
+GITHUB_API_URL = 'https://api.github.com'
+GITHUB_REPO = 'ocaml/ocaml'
+
+# states which can't change once a commit has them
+TERMINAL_STATES = ['success', 'failure']
+
+class StatusFetcher:
+    def __init__(self, repo=GITHUB_REPO, api_url=GITHUB_API_URL, oauth_token=None, cache_file=None,
+                 max_workers=8, max_retries=5, backoff_secs=1.0, max_rate_limit_wait_secs=3600, timeout=30, verbose=False):
+        url = urllib.parse.urlsplit(api_url)
+        self.connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = url.netloc
+        self.path_prefix = url.path.rstrip('/')
+        self.repo = repo
+        self.oauth_token = oauth_token
+        self.cache_file = cache_file
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_secs = backoff_secs
+        self.max_rate_limit_wait_secs = max_rate_limit_wait_secs
+        self.timeout = timeout
+        self.verbose = verbose
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.resume_at = 0.
+        self.forbidden = False
+
+    def _connection(self):
+        # one keep-alive connection per worker thread
+        if getattr(self.local, 'conn', None) is None:
+            self.local.conn = self.connection_class(self.netloc, timeout=self.timeout)
+        return self.local.conn
+
+    def _reset_connection(self):
+        if getattr(self.local, 'conn', None) is not None:
+            self.local.conn.close()
+            self.local.conn = None
+
+    def _wait_for_rate_limit(self):
+        with self.lock:
+            delay = self.resume_at - time.time()
+        if delay > 0:
+            if self.verbose: print('github rate limited, waiting %.0fs'%delay)
+            time.sleep(delay)
+
+    def _rate_limit_delay(self, response):
+        if response.getheader('Retry-After'):
+            return float(response.getheader('Retry-After'))
+        if response.getheader('X-RateLimit-Remaining') == '0' and response.getheader('X-RateLimit-Reset'):
+            return float(response.getheader('X-RateLimit-Reset')) - time.time() + 1
+        return None
+
+    def fetch_state(self, h):
+        # the combined status of commit h, or None if it couldn't be found
+        headers = {'Accept': 'application/vnd.github.v3+json', 'User-Agent': 'ocaml_bench_scripts'}
+        if self.oauth_token is not None:
+            headers['Authorization'] = 'token %s'%self.oauth_token
+        path = '%s/repos/%s/commits/%s/status'%(self.path_prefix, self.repo, h)
+
+        for attempt in range(self.max_retries + 1):
+            if self.forbidden:
+                return None
+            self._wait_for_rate_limit()
+            try:
+                conn = self._connection()
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                if self.verbose: print('WARN: github status request for %s failed: %s'%(h, e))
+                self._reset_connection()
+                time.sleep(self.backoff_secs * 2**attempt)
+                continue
+
+            if response.status == 200:
+                return json.loads(body.decode('utf-8')).get('state')
+
+            if response.status in (403, 429):
+                delay = self._rate_limit_delay(response)
+                if delay is not None:
+                    delay = min(max(delay, self.backoff_secs), self.max_rate_limit_wait_secs)
+                    with self.lock:
+                        self.resume_at = max(self.resume_at, time.time() + delay)
+                    continue
+
+            ## a 403 that isn't a rate limit is a bad or under-scoped token (or an abuse block),
+            ## which no retry will fix, so stop asking for the rest of the commits too
+            if response.status == 403:
+                with self.lock:
+                    first = not self.forbidden
+                    self.forbidden = True
+                if first:
+                    print('ERROR: github refused the status request for %s (HTTP 403: %s), check --github_oauth_token'%(h, body.decode('utf-8', 'replace').strip()))
+                return None
+
+            if response.status >= 500 or response.status == 429:
+                time.sleep(self.backoff_secs * 2**attempt)
+                continue
+
+            print('WARN: github status for %s gave HTTP %d'%(h, response.status))
+            return None
+
+        print('ERROR: giving up on github status for %s after %d attempts'%(h, self.max_retries + 1))
+        return None
+
+    def load_cache(self):
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return {}
+        with open(self.cache_file) as f:
+            return json.load(f)
+
+    def save_cache(self, cache):
+        if self.cache_file is None:
+            return
+        tmp_fname = '%s.tmp.%d'%(self.cache_file, os.getpid())
+        with open(tmp_fname, 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.replace(tmp_fname, self.cache_file)
+
+    def states(self, hashes):
+        # dict of hash -> state, only asking github for hashes without a terminal state
+        hashes = list(hashes)
+        cache = self.load_cache()
+        to_fetch = [h for h in hashes if h not in cache]
+        if self.verbose:
+            print('github status: %d cached, %d to fetch'%(len(hashes) - len(to_fetch), len(to_fetch)))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            fetched = dict(zip(to_fetch, executor.map(self.fetch_state, to_fetch)))
+
+        for h, state in fetched.items():
+            if state in TERMINAL_STATES:
+                cache[h] = state
+        self.save_cache(cache)
+
+        return {h: cache.get(h, fetched.get(h)) for h in hashes}
@@ -5,23 +5,22 @@ import datetime
 import glob
 import json
 import os
+import sys
 import yaml
 import subprocess
 
+from concurrent.futures import ProcessPoolExecutor
+
 from codespeed_upload import post_data_to_server
 
 GLOB_PATTERN = '*.summary'
 CODESPEED_URL = 'http://localhost:8000/'
 
-parser = argparse.ArgumentParser(description='Load operf-micro summary files into codespeed')
-parser.add_argument('resultdir', type=str, help='directory of results')
-parser.add_argument('--codespeed_url', type=str, help='url of codespeed server', default=CODESPEED_URL)
-parser.add_argument('--glob_pattern', type=str, help='glob pattern for summary files', default=GLOB_PATTERN)
-parser.add_argument('--halt_on_bad_parse', action='store_true', default=False)
-parser.add_argument('--dry_run', action='store_true', default=False)
-parser.add_argument('-v', '--verbose', action='store_true', default=False)
+## the libyaml loader is many times faster than the pure python one, when pyyaml was built with it
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
-args = parser.parse_args()
+def load_yaml(f, loader=YAML_LOADER):
+    return yaml.load(f, Loader=loader)
 
 def get_bench_dict(name, context, results):
     return {
@@ -39,10 +38,10 @@ def get_bench_dict(name, context, results):
         'std_dev': results['standard_error'],
     }
 
-def parse_results(fname, context):
+def parse_results(fname, context, loader=YAML_LOADER):
     bench_data = []
     with open(fname) as f:
-        dat = yaml.safe_load(f)
+        dat = load_yaml(f, loader)
 
         # first key in dat is always the bench run timestamp
         benchmarks = dat[list(dat.keys())[0]]
@@ -61,13 +60,20 @@ def parse_results(fname, context):
 
     return bench_data
 
+def try_parse_results(fname_context):
+    # parse_results for the process pool: (fname, results or None if the parse failed)
+    fname, context = fname_context
+    try:
+        return fname, parse_results(fname, context)
+    except Exception:
+        return fname, None
 
-def get_context(dir, verbose=args.verbose):
+def get_context(dir, verbose=False):
     def ld(x):
         fname = os.path.join(dir, x)
         if verbose: print('loading context info from %s'%fname)
         with open(fname) as f:
-            return yaml.safe_load(f)
+            return load_yaml(f)
 
     context = {}
     context.update(ld('build_context.conf'))
@@ -75,31 +81,75 @@ def get_context(dir, verbose=args.verbose):
 
     return context
 
-
-# load context information
-context = get_context(args.resultdir)
-if args.verbose:
-    print('got context: \n%s'%yaml.dump(context, default_flow_style=False))
-
-# get file list
-glob_str = '%s/%s'%(args.resultdir, args.glob_pattern)
-if args.verbose:
-    print('taking result files of the form: %s'%glob_str)
-
-for f in sorted(glob.glob(glob_str)):
-    if args.verbose:
-        print('processing %s'%f)
-
-    try:
-        results = parse_results(f, context)
-    except:
-        print('ERROR: failed to parse results in %s'%f)
-        if args.halt_on_bad_parse:
-            sys.exit(1)
-
-    if args.verbose:
-        print('loaded: \n%s'%yaml.dump(results, default_flow_style=False))
-
-    post_data_to_server(args.codespeed_url, results, dry_run=args.dry_run, verbose=args.verbose)
-
-
+def parse_result_dirs(resultdirs, glob_pattern=GLOB_PATTERN, jobs=1, verbose=False):
+    # yields (resultdir, [(fname, results or None)]) for each resultdir in order,
+    # with None instead of the list if the resultdir's context can't be loaded
+    work = []
+    for resultdir in resultdirs:
+        # load context information
+        try:
+            context = get_context(resultdir, verbose=verbose)
+        except Exception as e:
+            print('ERROR: failed to load the context for %s: %s'%(resultdir, e))
+            work.append((resultdir, None))
+            continue
+        if verbose:
+            print('got context for %s: %s'%(resultdir, json.dumps(context, sort_keys=True)))
+
+        # get file list
+        glob_str = '%s/%s'%(resultdir, glob_pattern)
+        if verbose:
+            print('taking result files of the form: %s'%glob_str)
+        work.append((resultdir, [(f, context) for f in sorted(glob.glob(glob_str))]))
+
+    if jobs == 1:
+        for resultdir, items in work:
+            yield resultdir, None if items is None else [try_parse_results(item) for item in items]
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        ## submit everything up front so the pool stays busy across directories
+        futures = [(resultdir, None if items is None else executor.map(try_parse_results, items, chunksize=8)) for resultdir, items in work]
+        for resultdir, parsed in futures:
+            yield resultdir, None if parsed is None else list(parsed)
+
+def main():
+    parser = argparse.ArgumentParser(description='Load operf-micro summary files into codespeed')
+    parser.add_argument('resultdirs', type=str, nargs='+', help='directories of results (each with its build_context.conf and run_context.conf)')
+    parser.add_argument('--codespeed_url', type=str, help='url of codespeed server', default=CODESPEED_URL)
+    parser.add_argument('--glob_pattern', type=str, help='glob pattern for summary files', default=GLOB_PATTERN)
+    parser.add_argument('--halt_on_bad_parse', action='store_true', default=False)
+    parser.add_argument('--spool_dir', type=str, help='where unsent uploads are kept to be replayed by the next run', default=None)
+    parser.add_argument('-j', '--jobs', type=int, help='number of processes parsing summary files (default: 1)', default=1)
+    parser.add_argument('--dry_run', action='store_true', default=False)
+    parser.add_argument('-v', '--verbose', action='store_true', default=False)
+
+    args = parser.parse_args()
+
+    if args.verbose and YAML_LOADER is yaml.SafeLoader:
+        print('WARN: pyyaml has no libyaml support here, using the slower pure python loader')
+
+    for resultdir, parsed in parse_result_dirs(args.resultdirs, args.glob_pattern, jobs=args.jobs, verbose=args.verbose):
+        if parsed is None:
+            if args.halt_on_bad_parse:
+                sys.exit(1)
+            continue
+        results = []
+        for f, file_results in parsed:
+            if file_results is None:
+                print('ERROR: failed to parse results in %s'%f)
+                if args.halt_on_bad_parse:
+                    sys.exit(1)
+                continue
+            if args.verbose:
+                print('loaded %d results from %s'%(len(file_results), f))
+            results.extend(file_results)
+
+        if not results:
+            print('WARN: no results found in %s'%resultdir)
+            continue
+        if not post_data_to_server(args.codespeed_url, results, dry_run=args.dry_run, verbose=args.verbose, spool_dir=args.spool_dir):
+            print('WARN: not all results from %s reached %s'%(resultdir, args.codespeed_url))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+# Python module for checking the benchmark machine's setup before a run
+#
+# Reads the settings the README recommends (isolcpus, rcu_nocbs,
+# irqaffinity, nohz_full, cpufreq governor, turbo boost, ASLR) from /proc and
+# /sys, plus the load average and how steady the bench core's clock is over
+# a short sample. The result is a fingerprint dict recorded next to each
+# benchmark result; problems() lists what makes the run degraded. Settings
+# which can't be read (e.g. no cpufreq in a VM) are recorded as None and not
+# counted as problems.
+
+import hashlib
+import json
+import os
+import platform
+import time
+
+PREFLIGHT_FNAME = 'preflight.json'
+
+SYS_CPU = '/sys/devices/system/cpu'
+
+# kernel command line parameters from the README
+CMDLINE_PARAMS = ['isolcpus', 'rcu_nocbs', 'rcu_nocb_poll', 'irqaffinity', 'nohz_full']
+
+# fingerprint fields which identify the machine setup rather than its current state
+STABLE_FIELDS = ['cpu_model', 'kernel', 'cmdline', 'isolated', 'nohz_full', 'governor', 'turbo', 'randomize_va_space']
+
+def read_file(fname):
+    try:
+        with open(fname) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def parse_cpu_list(s):
+    # '2-5,8' -> [2, 3, 4, 5, 8]
+    cores = []
+    for r in filter(bool, (s or '').split(',')):
+        if '-' in r:
+            lo, hi = map(int, r.split('-'))
+            cores.extend(range(lo, hi+1))
+        else:
+            cores.append(int(r))
+    return cores
+
+def parse_cmdline(cmdline):
+    # kernel command line -> {param: value or True} for CMDLINE_PARAMS
+    params = {}
+    for arg in (cmdline or '').split():
+        name, _, value = arg.partition('=')
+        if name in CMDLINE_PARAMS:
+            params[name] = value if value else True
+    return params
+
+def cmdline_cpu_list(value):
+    # isolcpus can carry flags, e.g. 'isolcpus=nohz,domain,2-5'
+    if not isinstance(value, str):
+        return []
+    return parse_cpu_list(','.join(v for v in value.split(',') if v[:1].isdigit()))
+
+def cpu_model():
+    for l in (read_file('/proc/cpuinfo') or '').split('\n'):
+        if l.startswith('model name'):
+            return l.split(':', 1)[1].strip()
+    return platform.processor() or None
+
+def turbo_state():
+    # 'on', 'off' or None if the machine has no turbo control
+    no_turbo = read_file(os.path.join(SYS_CPU, 'intel_pstate', 'no_turbo'))
+    if no_turbo is not None:
+        return 'off' if no_turbo == '1' else 'on'
+    boost = read_file(os.path.join(SYS_CPU, 'cpufreq', 'boost'))
+    if boost is not None:
+        return 'off' if boost == '0' else 'on'
+    return None
+
+def sample_frequency(core, samples=10, interval_secs=0.05):
+    # (min, max) of scaling_cur_freq in kHz over the sample, or None
+    fname = os.path.join(SYS_CPU, 'cpu%d'%core, 'cpufreq', 'scaling_cur_freq')
+    freqs = []
+    for i in range(samples):
+        f = read_file(fname)
+        if f is None:
+            return None
+        freqs.append(int(f))
+        time.sleep(interval_secs)
+    return min(freqs), max(freqs)
+
+def fingerprint(bench_core=None, pre_exec=''):
+    cmdline = read_file('/proc/cmdline')
+    loadavg = read_file('/proc/loadavg')
+    fp = {
+        'hostname': platform.node(),
+        'cpu_model': cpu_model(),
+        'kernel': platform.release(),
+        'cmdline': cmdline,
+        'cmdline_params': parse_cmdline(cmdline),
+        'isolated': read_file(os.path.join(SYS_CPU, 'isolated')),
+        'nohz_full': read_file(os.path.join(SYS_CPU, 'nohz_full')),
+        'turbo': turbo_state(),
+        'randomize_va_space': read_file('/proc/sys/kernel/randomize_va_space'),
+        'aslr_off_in_pre_exec': '--addr-no-randomize' in pre_exec or '-R' in pre_exec.split(),
+        'loadavg_1min': float(loadavg.split()[0]) if loadavg else None,
+        'bench_core': bench_core,
+        'governor': None,
+        'freq_khz': None,
+    }
+    if bench_core is not None:
+        fp['governor'] = read_file(os.path.join(SYS_CPU, 'cpu%d'%bench_core, 'cpufreq', 'scaling_governor'))
+        fp['freq_khz'] = sample_frequency(bench_core)
+    fp['fingerprint_id'] = hashlib.sha256(json.dumps([fp[k] for k in STABLE_FIELDS]).encode('utf-8')).hexdigest()[:16]
+    fp['time'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    return fp
+
+def problems(fp, max_load=1.0, max_freq_spread=0.02):
+    # list of reasons the machine isn't set up for a clean run
+    res = []
+    core = fp['bench_core']
+    if core is not None:
+        if fp['isolated'] is not None and core not in parse_cpu_list(fp['isolated']):
+            res.append('bench core %d is not isolated (isolated=%s)'%(core, fp['isolated']))
+        if fp['nohz_full'] is not None and core not in parse_cpu_list(fp['nohz_full'].replace('(null)', '')):
+            res.append('bench core %d is not nohz_full (nohz_full=%s)'%(core, fp['nohz_full']))
+        rcu_nocbs = fp['cmdline_params'].get('rcu_nocbs')
+        if fp['cmdline'] is not None and core not in cmdline_cpu_list(rcu_nocbs):
+            res.append('bench core %d does not have its RCU callbacks offloaded (rcu_nocbs=%s)'%(core, rcu_nocbs))
+        irqaffinity = fp['cmdline_params'].get('irqaffinity')
+        if irqaffinity and core in cmdline_cpu_list(irqaffinity):
+            res.append('bench core %d takes interrupts (irqaffinity=%s)'%(core, irqaffinity))
+        if fp['governor'] is not None and fp['governor'] != 'performance':
+            res.append('bench core %d has cpufreq governor %s'%(core, fp['governor']))
+        if fp['freq_khz'] is not None:
+            lo, hi = fp['freq_khz']
+            if hi > 0 and (hi - lo) / hi > max_freq_spread:
+                res.append('bench core %d clock moved between %d and %d kHz'%(core, lo, hi))
+    if fp['turbo'] == 'on':
+        res.append('turbo boost is on')
+    if fp['randomize_va_space'] not in (None, '0') and not fp['aslr_off_in_pre_exec']:
+        res.append('ASLR is on (randomize_va_space=%s) and the pre_exec does not use setarch --addr-no-randomize'%fp['randomize_va_space'])
+    if fp['loadavg_1min'] is not None and fp['loadavg_1min'] > max_load:
+        res.append('load average is %.2f (above %.2f)'%(fp['loadavg_1min'], max_load))
+    return res
+
+def run_preflight(bench_core=None, pre_exec='', max_load=1.0, max_freq_spread=0.02):
+    # fingerprint with its problems and whether the run is degraded
+    if bench_core is None:
+        print('WARN: preflight has no bench core, so the core isolation, governor and clock checks are skipped')
+    fp = fingerprint(bench_core, pre_exec)
+    fp['problems'] = problems(fp, max_load=max_load, max_freq_spread=max_freq_spread)
+    fp['degraded'] = len(fp['problems']) > 0
+    return fp
+
+def write_preflight(result_dir, fp):
+    with open(os.path.join(result_dir, PREFLIGHT_FNAME), 'w') as f:
+        json.dump(fp, f, indent=2, sort_keys=True)
+
+def read_preflight(result_dir):
+    # the preflight recorded with a result, or None for results from before preflights
+    fname = os.path.join(result_dir, PREFLIGHT_FNAME)
+    if not os.path.exists(fname):
+        return None
+    with open(fname) as f:
+        return json.load(f)
+
+def is_degraded(result_dir):
+    fp = read_preflight(result_dir)
+    return fp is not None and fp.get('degraded', False)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# Compare bulk loading results into a codespeed sqlite database against
+# posting them over http. The http side is a local stand-in for codespeed's
+# result/add/json/ view which, like a codespeed worker, keeps its database
+# connection open and writes each result with its own lookups and commit.
+
+import argparse
+import http.server
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import codespeed_db
+import codespeed_upload
+
+# the parts of the codespeed schema the results touch
+SCHEMA = '''
+CREATE TABLE codespeed_project (id integer PRIMARY KEY AUTOINCREMENT, name varchar(30) NOT NULL UNIQUE, repo_type varchar(1) NOT NULL, repo_path varchar(200) NOT NULL, repo_user varchar(100) NOT NULL, repo_pass varchar(100) NOT NULL, commit_browsing_url varchar(200) NOT NULL, track bool NOT NULL, default_branch varchar(32) NOT NULL);
+CREATE TABLE codespeed_branch (id integer PRIMARY KEY AUTOINCREMENT, name varchar(32) NOT NULL, project_id integer NOT NULL REFERENCES codespeed_project (id), display_on_comparison_page bool NOT NULL, UNIQUE (name, project_id));
+CREATE TABLE codespeed_revision (id integer PRIMARY KEY AUTOINCREMENT, commitid varchar(42) NOT NULL, tag varchar(20) NOT NULL, date datetime NULL, message text NOT NULL, author varchar(100) NOT NULL, branch_id integer NOT NULL REFERENCES codespeed_branch (id), project_id integer NULL REFERENCES codespeed_project (id), UNIQUE (commitid, branch_id));
+CREATE TABLE codespeed_executable (id integer PRIMARY KEY AUTOINCREMENT, name varchar(30) NOT NULL, description varchar(200) NOT NULL, project_id integer NOT NULL REFERENCES codespeed_project (id), UNIQUE (name, project_id));
+CREATE TABLE codespeed_benchmark (id integer PRIMARY KEY AUTOINCREMENT, name varchar(100) NOT NULL UNIQUE, benchmark_type varchar(1) NOT NULL, data_type varchar(1) NOT NULL, description text NOT NULL, units_title varchar(30) NOT NULL, units varchar(20) NOT NULL, lessisbetter bool NOT NULL, default_on_comparison bool NOT NULL, parent_id integer NULL REFERENCES codespeed_benchmark (id));
+CREATE TABLE codespeed_environment (id integer PRIMARY KEY AUTOINCREMENT, name varchar(100) NOT NULL UNIQUE, cpu varchar(100) NOT NULL, memory varchar(100) NOT NULL, os varchar(100) NOT NULL, kernel varchar(100) NOT NULL);
+CREATE TABLE codespeed_result (id integer PRIMARY KEY AUTOINCREMENT, value real NOT NULL, std_dev real NULL, val_min real NULL, val_max real NULL, q1 real NULL, q3 real NULL, date datetime NULL, benchmark_id integer NOT NULL REFERENCES codespeed_benchmark (id), environment_id integer NOT NULL REFERENCES codespeed_environment (id), executable_id integer NOT NULL REFERENCES codespeed_executable (id), revision_id integer NOT NULL REFERENCES codespeed_revision (id), UNIQUE (revision_id, executable_id, benchmark_id, environment_id));
+INSERT INTO codespeed_environment (name, cpu, memory, os, kernel) VALUES ('bench_env', '', '', '', '');
+'''
+
+parser = argparse.ArgumentParser(description='Micro-benchmark sqlite bulk load against http upload into codespeed')
+parser.add_argument('--commits', type=int, help='number of commits', default=50)
+parser.add_argument('--benchmarks', type=int, help='number of benchmarks per commit', default=100)
+parser.add_argument('--metrics', type=int, help='number of metrics per benchmark', default=3)
+args = parser.parse_args()
+
+def make_db(fname):
+    codespeed_db.sqlite3.connect(fname).executescript(SCHEMA)
+
+def make_data():
+    data = []
+    for c in range(args.commits):
+        h = ('%07x'%c).ljust(40, '0')
+        for b in range(args.benchmarks):
+            for m in range(args.metrics):
+                data.append({
+                    'commitid': h[:7], 'commitid_long': h, 'project': 'ocaml_trunk', 'branch': 'trunk',
+                    'executable': 'vanilla', 'executable_description': '4.10.0', 'environment': 'bench_env',
+                    'benchmark': 'bench%03d/metric%d'%(b, m), 'units': 'seconds', 'units_title': 'Time',
+                    'result_value': 1.0 + c * 0.01, 'min': 0.9, 'max': 1.1, 'std_dev': 0.01,
+                    'revision_date': '2020-01-01 00:%02d:%02d'%(c // 60 % 60, c % 60),
+                    })
+    return data
+
+class FakeCodespeed(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    lock = threading.Lock()
+    local = threading.local()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        results = json.loads(urllib.parse.parse_qs(body.decode('utf-8'))['json'][0])
+        ## one connection per keep-alive connection's handler thread
+        if not hasattr(self.local, 'db'):
+            self.local.db = codespeed_db.CodespeedDB(self.server.db_fname)
+        with self.lock:
+            for r in results:
+                ## NB: fresh lookups for each result, as codespeed's get_or_create does
+                self.local.db.ids = {}
+                self.local.db.load([r])
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *a):
+        pass
+
+data = make_data()
+print('%d results (%d commits x %d benchmarks x %d metrics)'%(len(data), args.commits, args.benchmarks, args.metrics))
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    bulk_db = os.path.join(tmpdir, 'bulk.db')
+    make_db(bulk_db)
+    t0 = time.perf_counter()
+    codespeed_db.load_data_to_db(bulk_db, data)
+    t_bulk = time.perf_counter() - t0
+    print('sqlite bulk load: %.2fs'%t_bulk)
+
+    t0 = time.perf_counter()
+    codespeed_db.load_data_to_db(bulk_db, data)
+    print('sqlite bulk reload (idempotent): %.2fs'%(time.perf_counter() - t0))
+
+    http_db = os.path.join(tmpdir, 'http.db')
+    make_db(http_db)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeCodespeed)
+    server.db_fname = http_db
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    t0 = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        codespeed_upload.post_data_to_server('http://127.0.0.1:%d/'%server.server_port, data)
+        sys.stdout = stdout
+    t_http = time.perf_counter() - t0
+    print('http upload: %.2fs (%.1fx slower)'%(t_http, t_http / t_bulk))
+    server.shutdown()
+    server.server_close()
+
+    for fname in [bulk_db, http_db]:
+        conn = codespeed_db.sqlite3.connect(fname)
+        print('%s: %d results'%(os.path.basename(fname), conn.execute('SELECT COUNT(*) FROM codespeed_result').fetchone()[0]))
+        conn.close()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Compare loading operf-micro summary files with the pure python yaml
+# loader (the old load_operf_data.py path) against the libyaml loader,
+# serially and in a process pool, over synthetic result directories.
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import load_operf_data
+
+parser = argparse.ArgumentParser(description='Micro-benchmark operf-micro summary loading')
+parser.add_argument('--dirs', type=int, help='number of result directories', default=20)
+parser.add_argument('--files', type=int, help='summary files per directory', default=20)
+parser.add_argument('--subbenchmarks', type=int, help='sub benchmarks per summary file', default=30)
+parser.add_argument('--jobs', type=int, help='processes for the pool run (default: cpu count)', default=os.cpu_count())
+parser.add_argument('--repeats', type=int, help='timing repeats (best is reported)', default=3)
+args = parser.parse_args()
+
+def summary(rnd, suite):
+    def stats():
+        m = rnd.uniform(1e3, 1e7)
+        return {'mean': m, 'min': m * 0.98, 'max': m * 1.03, 'standard_error': m * 0.01,
+                'r_square': rnd.uniform(0.9, 1.), 'samples': rnd.randint(100, 1000),
+                'constant': rnd.uniform(0, 1e3), 'runs': rnd.randint(10, 100)}
+    benches = {}
+    for i in range(args.subbenchmarks):
+        if i % 5 == 0:
+            benches['group g%d'%i] = {'%s_%d'%(suite, j): stats() for j in range(4)}
+        else:
+            benches['%s_%d'%(suite, i)] = stats()
+    return {'2020-01-01 00:00:00': {suite: benches}}
+
+def write_synthetic(root):
+    rnd = random.Random(42)
+    dirs = []
+    for d in range(args.dirs):
+        resultdir = os.path.join(root, 'r%03d'%d)
+        os.makedirs(resultdir)
+        with open(os.path.join(resultdir, 'build_context.conf'), 'w') as f:
+            yaml.dump({'commitid': '%07x'%d, 'commitid_long': '%040x'%d, 'branch': 'trunk', 'project': 'ocaml_trunk',
+                       'executable': 'vanilla', 'executable_description': './configure'}, f, default_flow_style=False)
+        with open(os.path.join(resultdir, 'run_context.conf'), 'w') as f:
+            yaml.dump({'environment': 'bench_env'}, f, default_flow_style=False)
+        for b in range(args.files):
+            with open(os.path.join(resultdir, 'bench%02d.summary'%b), 'w') as f:
+                yaml.dump(summary(rnd, 'bench%02d'%b), f, default_flow_style=False)
+        dirs.append(resultdir)
+    return dirs
+
+def old_path(dirs):
+    # yaml.safe_load for each context and summary file, one at a time
+    res = []
+    for resultdir in dirs:
+        context = {}
+        for conf in ['build_context.conf', 'run_context.conf']:
+            with open(os.path.join(resultdir, conf)) as f:
+                context.update(yaml.safe_load(f))
+        for fname in sorted(os.listdir(resultdir)):
+            if fname.endswith('.summary'):
+                res.extend(load_operf_data.parse_results(os.path.join(resultdir, fname), context, loader=yaml.SafeLoader))
+    return res
+
+def new_path(dirs, jobs):
+    res = []
+    for resultdir, parsed in load_operf_data.parse_result_dirs(dirs, jobs=jobs):
+        for fname, results in parsed:
+            res.extend(results)
+    return res
+
+def best_time(f, *fargs):
+    best, res = None, None
+    for _ in range(args.repeats):
+        t0 = time.perf_counter()
+        res = f(*fargs)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best, res
+
+root = tempfile.mkdtemp(prefix='operf_yaml_load_')
+try:
+    dirs = write_synthetic(root)
+    print('%d summary files in %d directories under %s'%(args.dirs * args.files, args.dirs, root))
+    print('libyaml loader: %s'%('yes' if load_operf_data.YAML_LOADER is not yaml.SafeLoader else 'no (pyyaml built without it)'))
+
+    t_old, res_old = best_time(old_path, dirs)
+    print('safe_load serial:           %.3fs (%d results)'%(t_old, len(res_old)))
+    t_serial, res_serial = best_time(new_path, dirs, 1)
+    print('load_operf_data serial:     %.3fs (%.1fx faster)'%(t_serial, t_old / t_serial))
+    t_pool, res_pool = best_time(new_path, dirs, args.jobs)
+    print('load_operf_data %2d procs:   %.3fs (%.1fx faster)'%(args.jobs, t_pool, t_old / t_pool))
+    assert res_old == res_serial == res_pool, 'results differ'
+finally:
+    shutil.rmtree(root)
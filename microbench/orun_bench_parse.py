@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Compare the streaming orun_bench aggregation against the old
+# json.loads + pandas groupby.apply(describe) upload path on a synthetic
+# .orun.bench file, and against the cost of the json decoding alone.
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import orun_bench
+
+parser = argparse.ArgumentParser(description='Micro-benchmark .orun.bench parsing for upload')
+parser.add_argument('--benchmarks', type=int, help='number of distinct benchmarks', default=100)
+parser.add_argument('--iterations', type=int, help='iterations per benchmark', default=200)
+parser.add_argument('--repeats', type=int, help='timing repeats (best is reported)', default=3)
+parser.add_argument('--keep_file', type=str, help='write the synthetic file here and keep it', default=None)
+args = parser.parse_args()
+
+def write_synthetic(fname):
+    rnd = random.Random(42)
+    with open(fname, 'w') as f:
+        for i in range(args.iterations):
+            for b in range(args.benchmarks):
+                t = (1 + b % 7) * rnd.uniform(0.95, 1.05)
+                f.write(json.dumps({
+                    'name': 'bench%03d.%d'%(b, b % 3),
+                    'command': 'taskset --cpu-list 4 ./bench%03d.exe'%b,
+                    'time_secs': t, 'user_time_secs': t * 0.98, 'sys_time_secs': t * 0.01,
+                    'maxrss_kB': rnd.randint(1000, 100000),
+                    'gc': {'allocated_words': 1e9, 'minor_words': 1e9, 'promoted_words': 1e6, 'major_words': 1e7,
+                           'minor_collections': 1000, 'major_collections': 10, 'heap_words': 1e6,
+                           'heap_chunks': 10, 'top_heap_words': 2e6, 'compactions': 0},
+                    })+'\n')
+
+def pandas_path(fname):
+    # the upload path before the streaming parser
+    import pandas
+    bench_data = []
+    with open(fname) as f:
+        for l in f:
+            raw_data = json.loads(l)
+            bench_data.append({
+                'name': raw_data['name'],
+                'time_secs': raw_data['time_secs'],
+                'user_time_secs': raw_data['user_time_secs'],
+                'gc.minor_collections': raw_data['gc']['minor_collections'],
+                'gc.major_collections': raw_data['gc']['major_collections'],
+                'gc.compactions': raw_data['gc'].get('compactions', 0),
+                })
+    bench_data = pandas.DataFrame(bench_data)
+    aggregated_data = bench_data.groupby('name').apply(lambda x: x.describe().T)
+    aggregated_data.index.set_names(['bench_name', 'bench_metric'], inplace=True)
+    return {b: aggregated_data.loc[(b, 'time_secs')]['mean'] for b in aggregated_data.index.levels[0]}
+
+def streaming_path(fname):
+    return {b: s['time_secs'].mean for b, s in orun_bench.aggregate_orun_bench(fname).items()}
+
+def decode_only(fname):
+    # the json decoding alone, which bounds any parse in pure python
+    return sum(len(chunk) for chunk in orun_bench.iter_record_chunks(fname))
+
+def best_time(f, fname):
+    best, res = None, None
+    for _ in range(args.repeats):
+        t0 = time.perf_counter()
+        res = f(fname)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best, res
+
+fname = args.keep_file if args.keep_file else tempfile.mkstemp(suffix='.orun.bench')[1]
+write_synthetic(fname)
+print('%d records (%.1f MB) in %s'%(args.benchmarks * args.iterations, os.path.getsize(fname) / 1e6, fname))
+
+t_stream, res_stream = best_time(streaming_path, fname)
+print('streaming: %.3fs'%t_stream)
+t_decode, _ = best_time(decode_only, fname)
+print('decode:    %.3fs (json decoding alone, %.0f%% of streaming)'%(t_decode, 100 * t_decode / t_stream))
+try:
+    t_pandas, res_pandas = best_time(pandas_path, fname)
+    print('pandas:    %.3fs (%.1fx slower)'%(t_pandas, t_pandas / t_stream))
+    assert all(abs(res_pandas[b] - res_stream[b]) < 1e-9 for b in res_stream), 'results differ'
+except ImportError:
+    print('pandas not installed, skipping the old path')
+
+if not args.keep_file:
+    os.remove(fname)
@@ -0,0 +1,234 @@
+# Python module for streaming aggregation of sandmark .orun.bench results
+#
+# A .orun.bench file has one JSON record per benchmark iteration. We read it
+# in chunks of lines, decode each chunk with a single json.loads and fold the
+# per-benchmark columns of the chunk into running statistics, so memory is
+# bounded by the chunk size and the number of benchmarks rather than the
+# number of iterations.
+
+import itertools
+import json
+import math
+import operator
+
+# fields which older orun versions may not write
+FIELD_DEFAULTS = {
+    'gc.compactions': 0,
+}
+
+# orun field -> (codespeed units, codespeed units_title)
+METRICS = {
+    'time_secs': ('seconds', 'Time'),
+    'user_time_secs': ('seconds', 'User time'),
+    'sys_time_secs': ('seconds', 'System time'),
+    'maxrss_kB': ('kB', 'Max RSS'),
+    'gc.allocated_words': ('words', 'Allocated words'),
+    'gc.minor_words': ('words', 'Minor words'),
+    'gc.promoted_words': ('words', 'Promoted words'),
+    'gc.major_words': ('words', 'Major words'),
+    'gc.minor_collections': ('collections', 'Minor collections'),
+    'gc.major_collections': ('collections', 'Major collections'),
+    'gc.heap_words': ('words', 'Heap words'),
+    'gc.heap_chunks': ('chunks', 'Heap chunks'),
+    'gc.top_heap_words': ('words', 'Top heap words'),
+    'gc.compactions': ('compactions', 'Compactions'),
+}
+
+# uploaded under the plain benchmark name, other metrics get a '/<field>' suffix
+PRIMARY_METRIC = 'time_secs'
+
+# records decoded and aggregated at a time
+CHUNK_RECORDS = 8192
+
+# counters added to the records by perf_stat_wrapper.py
+PERF_PREFIX = 'perf.'
+
+def perf_counter_key(event):
+    # the key perf_stat_wrapper.py records an event under, so it reads as one orun field
+    return event.replace('.', '_').replace(':', '_').replace('/', '_')
+
+def metric_field(field):
+    # 'perf.<event>' as given by the user -> the orun field the counter is recorded in
+    if field.startswith(PERF_PREFIX):
+        return PERF_PREFIX + perf_counter_key(field[len(PERF_PREFIX):])
+    return field
+
+def is_metric_field(field):
+    return field in METRICS or field.startswith(PERF_PREFIX)
+
+def parse_metrics(s):
+    # 'time_secs,maxrss_kB,gc.foo:words:Foo words' -> [(field, units, units_title)]
+    #   fields not in METRICS need their units and units_title given
+    #   'all' selects everything in METRICS
+    #   'perf.<event>' is a perf counter, in units of events (e.g. perf.idq_uops_not_delivered.core
+    #   is read from, and uploaded as, perf.idq_uops_not_delivered_core)
+    metrics = []
+    for spec in filter(bool, s.split(',')):
+        if spec == 'all':
+            metrics.extend((f, u, t) for f, (u, t) in METRICS.items())
+            continue
+        parts = spec.split(':')
+        if len(parts) == 3:
+            metrics.append((metric_field(parts[0]), parts[1], parts[2]))
+        elif len(parts) == 1 and spec in METRICS:
+            metrics.append((spec,) + METRICS[spec])
+        elif len(parts) == 1 and spec.startswith(PERF_PREFIX):
+            metrics.append((metric_field(spec), 'events', spec[len(PERF_PREFIX):]))
+        else:
+            raise ValueError('unknown metric "%s" (known metrics: %s, or give field:units:units_title)'%(spec, ','.join(METRICS)))
+    return metrics
+
+def metric_benchmark_name(bench_name, field):
+    return bench_name if field == PRIMARY_METRIC else '%s/%s'%(bench_name, field)
+
+# two-sided 95% student t quantiles by degrees of freedom, normal beyond the table
+T_95 = [(1, 12.706), (2, 4.303), (3, 3.182), (4, 2.776), (5, 2.571), (6, 2.447), (7, 2.365), (8, 2.306),
+        (9, 2.262), (10, 2.228), (12, 2.179), (15, 2.131), (20, 2.086), (25, 2.060), (30, 2.042)]
+
+def t_quantile_95(df):
+    # rounds df down to the table, so errs on the wide side
+    t = 1.960
+    for table_df, table_t in reversed(T_95):
+        if df >= table_df:
+            return t if df > 30 else table_t
+    return math.inf
+
+class RunningStats:
+    # Welford's online mean/variance, std matches pandas describe (ddof=1)
+    #   add_values folds in a whole column at once (Chan et al's pairwise update)
+    __slots__ = ('count', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        if x < self.min: self.min = x
+        if x > self.max: self.max = x
+
+    def add_values(self, xs):
+        n = len(xs)
+        if n == 0:
+            return
+        mean = math.fsum(xs) / n
+        d = [x - mean for x in xs]
+        m2 = math.fsum(map(operator.mul, d, d))
+        count = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / count
+        self.m2 += m2 + delta * delta * self.count * n / count
+        self.count = count
+        self.min = min(self.min, min(xs))
+        self.max = max(self.max, max(xs))
+
+    @property
+    def std(self):
+        if self.count < 2:
+            return math.nan
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def relative_ci_width(self):
+        # full width of the 95% confidence interval of the mean relative to the mean
+        if self.count < 2 or self.mean == 0:
+            return math.inf
+        return 2 * t_quantile_95(self.count - 1) * self.std / math.sqrt(self.count) / abs(self.mean)
+
+def get_field(record, field):
+    # 'gc.minor_words' -> record['gc']['minor_words']
+    v = record
+    for k in field.split('.'):
+        if not isinstance(v, dict) or k not in v:
+            return FIELD_DEFAULTS.get(field)
+        v = v[k]
+    return v
+
+def iter_record_chunks(fname):
+    # lists of up to CHUNK_RECORDS records, each list decoded with one json.loads
+    with open(fname) as f:
+        while True:
+            lines = list(itertools.islice(f, CHUNK_RECORDS))
+            if not lines:
+                return
+            lines = [l for l in lines if l.strip()]
+            if lines:
+                yield json.loads('[%s]'%','.join(lines))
+
+def iter_records(fname):
+    for chunk in iter_record_chunks(fname):
+        yield from chunk
+
+def field_getter(field):
+    # get_field for one field, without splitting the field per record
+    keys = field.split('.')
+    default = FIELD_DEFAULTS.get(field)
+    if len(keys) == 1:
+        return lambda record: record.get(field, default)
+    def get(record):
+        v = record
+        for k in keys:
+            if not isinstance(v, dict) or k not in v:
+                return default
+            v = v[k]
+        return v
+    return get
+
+def add_chunk(aggregated, records, getters):
+    # fold a list of records into aggregated, one column per (benchmark, field)
+    by_name = {}
+    for record in records:
+        by_name.setdefault(record['name'], []).append(record)
+    for name, bench_records in by_name.items():
+        bench_stats = aggregated.get(name)
+        if bench_stats is None:
+            bench_stats = aggregated[name] = {f: RunningStats() for f in getters}
+        for f, get in getters.items():
+            column = [v for v in map(get, bench_records) if v is not None]
+            bench_stats[f].add_values(column)
+
+def aggregate_chunks(chunks, fields=('time_secs',)):
+    # {bench_name: {field: RunningStats}} in bench_name order
+    getters = {f: field_getter(f) for f in fields}
+    aggregated = {}
+    for records in chunks:
+        add_chunk(aggregated, records, getters)
+    return {k: aggregated[k] for k in sorted(aggregated)}
+
+def aggregate_records(records, fields=('time_secs',)):
+    records = iter(records)
+    return aggregate_chunks(iter(lambda: list(itertools.islice(records, CHUNK_RECORDS)), []), fields)
+
+def aggregate_orun_bench(fname, fields=('time_secs',)):
+    return aggregate_chunks(iter_record_chunks(fname), fields)
+
+def format_for_upload(aggregated_data, metrics, base, artifacts_location, verbose=False):
+    # codespeed result dicts for aggregate_orun_bench output, one per (benchmark, metric)
+    #   base: the commit, project, branch, executable and environment fields
+    #   artifacts_location: archive path of the run, '<env>/<project>__<branch>/<hash>/<exe>/<timestamp>'
+    upload_data = []
+    for bench_name, bench_stats in aggregated_data.items():
+        for metric_name, metric_units, metric_units_title in metrics:
+            results = bench_stats[metric_name]
+            if results.count == 0:
+                if verbose: print('WARN: no %s data for %s in %s'%(metric_name, bench_name, artifacts_location))
+                continue
+
+            r = dict(base)
+            r.update({
+                'benchmark': metric_benchmark_name(bench_name, metric_name),
+                'units': metric_units,
+                'units_title': metric_units_title,
+                'result_value': results.mean,
+                'min': results.min,
+                'max': results.max,
+                'std_dev': results.std,
+                'metadata': {'artifacts_location': '%s/%s/'%(artifacts_location, bench_name)},
+                })
+            upload_data.append(r)
+    return upload_data
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# Run a benchmark command under 'perf stat' and add the counters to its orun record.
+#
+#   perf_stat_wrapper.py --events cycles,instructions --orun_output x.orun.bench -- orun -o x.orun.bench -- ./x
+#
+# The counters go into the last record of the orun output as
+# {"perf": {"<event>": value}} (event names with '.', ':' or '/' get '_'
+# so they can be read as orun fields like 'perf.cycles'). If perf is
+# missing or not permitted the command still runs and the counters are left
+# out; events perf doesn't support (e.g. in a VM) are dropped and left null
+# while the others are still counted. The exit code is always the command's.
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from orun_bench import perf_counter_key as counter_key
+
+parser = argparse.ArgumentParser(description='Run a command under perf stat and record the counters with its orun result')
+parser.add_argument('--events', type=str, help='comma seperated perf events', required=True)
+parser.add_argument('--orun_output', type=str, help='orun output file of the command to add the counters to', default=None)
+parser.add_argument('--log', type=str, help='also append the counters as a json line to this file', default=None)
+parser.add_argument('--perf', type=str, help='perf binary (default: perf)', default='perf')
+parser.add_argument('cmd', nargs=argparse.REMAINDER, help='-- command to run')
+
+args = parser.parse_args()
+
+def perf_works(events):
+    # a perf stat of 'true' fails if perf is missing, not permitted or an event is unknown
+    proc = subprocess.run([args.perf, 'stat', '-x,', '-e', ','.join(events), '--', 'true'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return proc.returncode == 0
+
+def supported_events(events):
+    # the events perf can count here, probing them one by one if not all of them can
+    if shutil.which(args.perf) is None:
+        return []
+    if perf_works(events):
+        return events
+    supported = []
+    for e in events:
+        if perf_works([e]):
+            supported.append(e)
+        else:
+            print('WARN: perf stat can not count %s, dropping it'%e, file=sys.stderr)
+    return supported
+
+def parse_perf_csv(fname, events):
+    # perf stat -x, lines are 'value,unit,event,...'
+    counters = {counter_key(e): None for e in events}
+    with open(fname) as f:
+        for l in f:
+            fields = l.strip().split(',')
+            if len(fields) < 3 or l.startswith('#'):
+                continue
+            value, event = fields[0], fields[2]
+            ## NB: perf can add modifiers, e.g. 'cycles:u'
+            for e in events:
+                if event == e or event.split(':')[0] == e:
+                    try:
+                        counters[counter_key(e)] = float(value)
+                    except ValueError:
+                        ## '<not supported>' or '<not counted>'
+                        pass
+    return counters
+
+def add_to_orun_record(fname, counters):
+    with open(fname) as f:
+        lines = [l for l in f.read().split('\n') if l.strip()]
+    if not lines:
+        return
+    record = json.loads(lines[-1])
+    record['perf'] = counters
+    lines[-1] = json.dumps(record)
+    tmp_fname = '%s.tmp.%d'%(fname, os.getpid())
+    with open(tmp_fname, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_fname, fname)
+
+cmd = args.cmd[1:] if args.cmd[:1] == ['--'] else args.cmd
+if not cmd:
+    parser.error('no command given')
+events = list(filter(bool, args.events.split(',')))
+
+perf_events = supported_events(events)
+if perf_events:
+    with tempfile.NamedTemporaryFile(prefix='perf_stat_', suffix='.csv', delete=False) as f:
+        perf_fname = f.name
+    try:
+        returncode = subprocess.run([args.perf, 'stat', '-x,', '-e', ','.join(perf_events), '-o', perf_fname, '--'] + cmd).returncode
+        counters = parse_perf_csv(perf_fname, events)
+    finally:
+        os.remove(perf_fname)
+    if args.orun_output and os.path.exists(args.orun_output):
+        add_to_orun_record(args.orun_output, counters)
+else:
+    print('WARN: perf stat of %s not available, running without counters'%args.events, file=sys.stderr)
+    returncode = subprocess.run(cmd).returncode
+    counters = None
+
+if args.log:
+    with open(args.log, 'a') as f:
+        f.write(json.dumps({'cwd': os.getcwd(), 'cmd': cmd, 'orun_output': args.orun_output, 'perf': counters}) + '\n')
+
+sys.exit(returncode)
@@ -0,0 +1,395 @@
+# Python module for running the per-hash stages of a backfill
+#
+# A front end (run_backfill.py, run_sandmark_backfill.py) describes its
+# stages as Stage objects in the order they run for a hash, and the
+# Pipeline runs the ones asked for on every hash:
+#  - each stage run is recorded in the outdir's RunManifest, so reruns
+#    can skip what is done (resume) and later stages can find artifacts
+#  - a stage is skipped for a hash if a stage it depends on failed for
+#    that hash in this run
+#  - hashes run concurrently with a pool of resources (e.g. isolated
+#    cores), one resource per in-flight hash
+#  - 'ordered' stages run after all hashes are through the other stages,
+#    one hash at a time in the order given (e.g. so series see commits in
+#    commit order)
+#  - every stage run and every shell_exec is profiled (wall time, CPU
+#    time, peak RSS and bytes written) into a JSONL trace and a summary
+#
+# run_pipelined() overlaps the hashes instead of running each hash start to
+# finish: the 'build' lane stages of later hashes run ahead (up to a
+# lookahead) while the 'bench' lane takes the built hashes in commit order
+# on the resources, and the 'post' lane (uploads, archives) drains in the
+# background. That keeps the bench resources busy rather than idle while
+# the next hash builds.
+
+import datetime
+import json
+import os
+import queue
+import resource
+import subprocess
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+def timestamp():
+    return datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+
+def timestamp_date(ts):
+    # a timestamp() as a codespeed date, or None if ts isn't one
+    try:
+        return datetime.datetime.strptime(ts, '%Y%m%d_%H%M%S').strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return None
+
+class Profiler:
+    # Resource use of the stage runs ('spans') and of the commands run in
+    # them. Commands are measured from their wait4() rusage, which covers
+    # the whole process tree (e.g. make and the compilers it runs); a span
+    # adds up its commands plus the CPU of its own python thread. Peak RSS
+    # is that of the largest process in the tree, which for small commands
+    # is the size of this python process they were forked from.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.trace_file = None
+        self.spans = []
+        self.start = time.time()
+
+    def open_trace(self, fname):
+        self.trace_file = open(fname, 'a')
+
+    def _write(self, record):
+        with self.lock:
+            if self.trace_file:
+                self.trace_file.write(json.dumps(record, sort_keys=True) + '\n')
+                self.trace_file.flush()
+
+    @contextmanager
+    def span(self, h, stage):
+        parent = getattr(self.local, 'span', None)
+        span = {'type': 'stage', 'hash': h, 'stage': stage, 'start': time.time(), 'exit_code': None,
+                'child_cpu_s': 0., 'max_rss_kB': 0, 'written_bytes': 0, 'cmds': 0}
+        self.local.span = span
+        thread_cpu_start = time.thread_time()
+        try:
+            yield span
+        finally:
+            self.local.span = parent
+            span['wall_s'] = time.time() - span['start']
+            span['cpu_s'] = time.thread_time() - thread_cpu_start + span['child_cpu_s']
+            with self.lock:
+                self.spans.append(span)
+            self._write(span)
+
+    def record_cmd(self, cmd, start, rusage, returncode):
+        span = getattr(self.local, 'span', None)
+        record = {
+            'type': 'cmd',
+            'hash': span['hash'] if span else None,
+            'stage': span['stage'] if span else None,
+            'cmd': cmd,
+            'start': start,
+            'wall_s': time.time() - start,
+            'user_s': rusage.ru_utime,
+            'sys_s': rusage.ru_stime,
+            'max_rss_kB': rusage.ru_maxrss,
+            ## NB: the block counts are in 512 byte units
+            'read_bytes': rusage.ru_inblock * 512,
+            'written_bytes': rusage.ru_oublock * 512,
+            'returncode': returncode,
+        }
+        if span:
+            span['child_cpu_s'] += rusage.ru_utime + rusage.ru_stime
+            span['max_rss_kB'] = max(span['max_rss_kB'], rusage.ru_maxrss)
+            span['written_bytes'] += record['written_bytes']
+            span['cmds'] += 1
+        self._write(record)
+
+    def finish(self):
+        # write a record for the whole run and close the trace
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self._write({'type': 'run', 'start': self.start, 'wall_s': time.time() - self.start,
+                     'cpu_s': self_usage.ru_utime + self_usage.ru_stime, 'max_rss_kB': self_usage.ru_maxrss})
+        with self.lock:
+            if self.trace_file:
+                self.trace_file.close()
+                self.trace_file = None
+
+    def print_summary(self):
+        if not self.spans:
+            return
+        print('%-16s %6s %6s %10s %10s %10s %10s %10s %12s'%('stage', 'runs', 'failed', 'total_s', 'mean_s', 'max_s', 'cpu_s', 'max_rss_MB', 'written_MB'))
+        stages = []
+        for span in self.spans:
+            if span['stage'] not in stages:
+                stages.append(span['stage'])
+        for stage in stages:
+            spans = [sp for sp in self.spans if sp['stage'] == stage]
+            secs = [sp['wall_s'] for sp in spans]
+            n_failed = sum(1 for sp in spans if sp['exit_code'] not in (None, 0))
+            print('%-16s %6d %6d %10.1f %10.1f %10.1f %10.1f %10.1f %12.1f'%(stage, len(spans), n_failed, sum(secs), sum(secs)/len(secs), max(secs),
+                sum(sp['cpu_s'] for sp in spans), max(sp['max_rss_kB'] for sp in spans)/1024, sum(sp['written_bytes'] for sp in spans)/1024**2))
+        print('total wall time %.1fs'%(time.time() - self.start))
+
+profiler = Profiler()
+
+def _read_pipes(proc):
+    # read stdout and stderr to EOF like communicate(), leaving the wait to the caller
+    out = {}
+    def read(name):
+        f = getattr(proc, name)
+        if f is not None:
+            out[name] = f.read()
+            f.close()
+    t = threading.Thread(target=read, args=('stderr',))
+    t.start()
+    read('stdout')
+    t.join()
+    return out.get('stdout'), out.get('stderr')
+
+def shell_exec(cmd, verbose=False, check=False, stdout=None, stderr=None, cwd=None):
+    if verbose:
+        print('+ %s'%cmd)
+    start = time.time()
+    proc = subprocess.Popen(cmd, shell=True, stdout=stdout, stderr=stderr, cwd=cwd)
+    out, err = _read_pipes(proc)
+    ## wait4 rather than proc.wait() for the rusage of the command
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    profiler.record_cmd(cmd, start, rusage, proc.returncode)
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, out, err)
+    return subprocess.CompletedProcess(cmd, proc.returncode, out, err)
+
+def shell_exec_redirect(cmd, fname, verbose=False, check=False, cwd=None):
+    if verbose:
+        print('+ %s'%cmd)
+        print('+ with stdout/stderr -> %s'% fname)
+    with open(fname, 'w') as f:
+        return shell_exec(cmd, verbose=False, check=check, stdout=f, stderr=subprocess.STDOUT, cwd=cwd)
+
+def parse_stages(s, known):
+    # 'build,operf' -> ['build', 'operf'], ValueError for stages not in known
+    stages = list(filter(bool, s.split(',')))
+    unknown = [st for st in stages if st not in known]
+    if unknown:
+        raise ValueError('unknown stages %s (known stages: %s)'%(','.join(unknown), ','.join(known)))
+    return stages
+
+class HashContext:
+    # per hash state handed to every stage; front ends add their own attributes
+    def __init__(self, h, resource=None, **kwargs):
+        self.h = h
+        self.resource = resource
+        self.__dict__.update(kwargs)
+
+LANES = ['build', 'bench', 'post']
+
+class Stage:
+    def __init__(self, name, run, depends=(), enabled=None, skip=None, ordered=False, lane='bench'):
+        # run(ctx, record) does the stage, setting record.exit_code and record.artifacts
+        # depends: stages which must not have failed for the hash in this run
+        # enabled(ctx): False leaves the stage out for the hash without recording it
+        # skip(ctx): True if the stage is already done and needn't rerun; by
+        #            default a done stage is skipped with incremental runs
+        # ordered: run after all hashes are through the unordered stages, in hash order
+        # lane: 'build', 'bench' or 'post', where the stage runs with run_pipelined
+        assert lane in LANES, lane
+        self.name = name
+        self.run = run
+        self.depends = depends
+        self.enabled = enabled
+        self.skip = skip
+        self.ordered = ordered
+        self.lane = lane
+
+class Pipeline:
+    def __init__(self, stages, run_stages, manifest, run_timestamp, hash_context, incremental=False, verbose=False):
+        # hash_context(h, resource) -> HashContext for the hash
+        self.stages = [s for s in stages if s.name in run_stages]
+        self.manifest = manifest
+        self.run_timestamp = run_timestamp
+        self.hash_context = hash_context
+        self.incremental = incremental
+        self.verbose = verbose
+        self.lock = threading.Lock()
+
+    def is_complete(self, h):
+        return all(self.manifest.is_done(h, s.name) for s in self.stages)
+
+    def pending(self, hashes, import_legacy=None):
+        # the hashes with stages left to do; import_legacy(h) is called first
+        # for hashes the manifest doesn't know (e.g. outdirs from before it)
+        res = []
+        for h in hashes:
+            if import_legacy and not self.manifest.has_hash(h):
+                import_legacy(h)
+            if self.is_complete(h):
+                if self.verbose: print('Found completed %s for %s skipping rerun'%(','.join(s.name for s in self.stages), h))
+            else:
+                res.append(h)
+        return res
+
+    def _run_stage(self, stage, ctx, failed):
+        # returns False if the stage failed
+        h = ctx.h
+        if stage.enabled and not stage.enabled(ctx):
+            return True
+        blocked = [d for d in stage.depends if d in failed]
+        if blocked:
+            print('Skipping %s for %s as %s failed'%(stage.name, h, ','.join(blocked)))
+            return False
+        if stage.skip is not None:
+            skip = stage.skip(ctx)
+        else:
+            skip = self.incremental and self.manifest.is_done(h, stage.name)
+            if skip: print('Skipping %s for %s as already done'%(stage.name, h))
+        if skip:
+            return True
+
+        exit_code = -1
+        with profiler.span(h, stage.name) as span:
+            try:
+                with self.manifest.stage(h, stage.name, self.run_timestamp) as record:
+                    stage.run(ctx, record)
+                exit_code = record.exit_code
+            except Exception as e:
+                print('ERROR: %s stage for %s failed: %s'%(stage.name, h, e))
+            span['exit_code'] = exit_code
+        if self.verbose: print('%s for %s took %.1fs (exit_code=%s)'%(stage.name, h, span['wall_s'], exit_code))
+        return exit_code == 0
+
+    def _run_stages(self, ctx, failed, ordered=False, lane=None):
+        for stage in self.stages:
+            if stage.ordered != ordered or (lane is not None and stage.lane != lane):
+                continue
+            if not self._run_stage(stage, ctx, failed):
+                failed.add(stage.name)
+
+    def run_hash(self, h, resource=None, ordered=False):
+        ctx = self.hash_context(h, resource)
+        failed = set()
+        self._run_stages(ctx, failed, ordered=ordered)
+        return not failed
+
+    def run(self, hashes, n_parallel=1, resources=None, ordered=True):
+        # run the stages on hashes; each in-flight hash holds one of resources
+        # ordered=False leaves the ordered stages for a later run_ordered()
+        hashes = list(hashes)
+        if resources and n_parallel > len(resources):
+            print('WARN: reducing parallel hashes from %d to the %d resources available'%(n_parallel, len(resources)))
+            n_parallel = len(resources)
+
+        pool = queue.Queue()
+        for r in resources if resources else [None]*n_parallel:
+            pool.put(r)
+
+        def run_on_resource(h):
+            resource = pool.get()
+            try:
+                self.run_hash(h, resource)
+            except Exception as e:
+                print('ERROR: processing %s failed: %s'%(h, e))
+            finally:
+                pool.put(resource)
+
+        if n_parallel == 1:
+            for h in hashes:
+                run_on_resource(h)
+        else:
+            with ThreadPoolExecutor(max_workers=n_parallel) as executor:
+                ## NB: list() to wait on all the hashes
+                list(executor.map(run_on_resource, hashes))
+
+        if ordered:
+            self.run_ordered(hashes)
+
+    def run_ordered(self, hashes):
+        if any(s.ordered for s in self.stages):
+            for h in hashes:
+                try:
+                    self.run_hash(h, ordered=True)
+                except Exception as e:
+                    print('ERROR: processing %s failed: %s'%(h, e))
+
+    def run_pipelined(self, hashes, lookahead=1, n_builds=1, resources=None, n_parallel=1, n_post=1):
+        # run the lanes of hashes overlapped: at most lookahead hashes are
+        # built (or building) ahead of the bench lane, n_builds at a time;
+        # the bench lane runs on n_parallel resources taking hashes in order
+        hashes = list(hashes)
+        if resources and n_parallel > len(resources):
+            print('WARN: reducing parallel hashes from %d to the %d resources available'%(n_parallel, len(resources)))
+            n_parallel = len(resources)
+        lookahead = max(lookahead, 1)
+        ahead = threading.Semaphore(lookahead + n_parallel)
+        built = queue.Queue()
+        pool = queue.Queue()
+        for r in resources if resources else [None]*n_parallel:
+            pool.put(r)
+        bench_busy = [0.]
+
+        def build(h):
+            failed = set()
+            try:
+                ctx = self.hash_context(h, None)
+                self._run_stages(ctx, failed, lane='build')
+            except Exception as e:
+                print('ERROR: processing %s failed: %s'%(h, e))
+                return None, None
+            return ctx, failed
+
+        def produce():
+            ## submit builds in commit order, blocking once lookahead hashes are waiting on the bench lane
+            for h in hashes:
+                ahead.acquire()
+                built.put((h, build_executor.submit(build, h)))
+            for i in range(n_parallel):
+                built.put((None, None))
+
+        def consume():
+            while True:
+                h, future = built.get()
+                if h is None:
+                    return
+                ctx, failed = future.result()
+                if ctx is None:
+                    ahead.release()
+                    continue
+                ctx.resource = pool.get()
+                start = time.time()
+                try:
+                    self._run_stages(ctx, failed, lane='bench')
+                except Exception as e:
+                    print('ERROR: processing %s failed: %s'%(h, e))
+                finally:
+                    with self.lock:
+                        bench_busy[0] += time.time() - start
+                    pool.put(ctx.resource)
+                    ahead.release()
+                post_futures.append(post_executor.submit(self._run_stages, ctx, failed, lane='post'))
+
+        post_futures = []
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=max(n_builds, 1)) as build_executor, ThreadPoolExecutor(max_workers=max(n_post, 1)) as post_executor:
+            producer = threading.Thread(target=produce)
+            producer.start()
+            consumers = [threading.Thread(target=consume) for i in range(n_parallel)]
+            for c in consumers:
+                c.start()
+            for c in consumers:
+                c.join()
+            producer.join()
+            for f in post_futures:
+                try:
+                    f.result()
+                except Exception as e:
+                    print('ERROR: post stages failed: %s'%e)
+        secs = time.time() - start
+        if hashes and secs > 0:
+            print('Pipelined %d hashes in %.1fs, bench lane busy %.0f%% of the time'%(len(hashes), secs, 100*bench_busy[0]/(secs*n_parallel)))
+
+        self.run_ordered(hashes)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+# Re-ingest archived benchmark results into codespeed.
+#
+# Walks archive trees as written by the archive stage of run_sandmark_backfill.py:
+#   <archive_dir>/<environment>/<project>__<branch>/<hash>/<executable>/<timestamp>/
+# and uploads the .orun.bench results found there (and any operf-micro
+# *.summary files that have their build_context.conf/run_context.conf).
+#  - only the latest timestamp of each (environment, project, branch, hash,
+#    executable) is taken, so a run archived to several archive dirs or
+#    rerun later is loaded once
+#  - runs already ingested into the same destination are skipped using a
+#    ledger (and with --codespeed_db, runs the database already has results for)
+#  - parsing runs in a process pool while earlier batches upload
+
+import argparse
+import functools
+import glob
+import os
+import sqlite3
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+
+import codespeed_db
+import codespeed_upload
+import git_hashes
+import load_operf_data
+import machine_preflight
+import orun_bench
+import pipeline
+import run_manifest
+
+SCRIPTDIR = os.path.dirname(os.path.abspath(__file__))
+CODESPEED_URL = 'http://localhost:8000/'
+LEDGER_FNAME = 'reingest_ledger.db'
+LEDGER_STAGE_PREFIX = 'reingest:'
+
+def subdirs(d):
+    return sorted(e.name for e in os.scandir(d) if e.is_dir())
+
+def find_runs(archive_dir, verbose=False):
+    # archived run dicts under archive_dir
+    runs = []
+    for environment in subdirs(archive_dir):
+        for project_branch in subdirs(os.path.join(archive_dir, environment)):
+            if '__' not in project_branch:
+                if verbose: print('WARN: skipping %s as it is not <project>__<branch>'%os.path.join(archive_dir, environment, project_branch))
+                continue
+            project, branch = project_branch.rsplit('__', 1)
+            for h in subdirs(os.path.join(archive_dir, environment, project_branch)):
+                for executable in subdirs(os.path.join(archive_dir, environment, project_branch, h)):
+                    for timestamp in subdirs(os.path.join(archive_dir, environment, project_branch, h, executable)):
+                        runs.append({
+                            'path': os.path.join(archive_dir, environment, project_branch, h, executable, timestamp),
+                            'location': '/'.join([environment, project_branch, h, executable, timestamp]),
+                            'environment': environment,
+                            'project': project,
+                            'branch': branch,
+                            'hash': h,
+                            'executable': executable,
+                            'timestamp': timestamp,
+                            })
+    return runs
+
+def latest_runs(runs):
+    # the latest timestamp per (environment, project, branch, hash, executable), in walk order
+    latest = {}
+    for run in runs:
+        key = (run['environment'], run['project'], run['branch'], run['hash'], run['executable'])
+        if key not in latest or run['timestamp'] > latest[key]['timestamp']:
+            latest[key] = run
+    return list(latest.values())
+
+def parse_run(run, upload_metrics, skip_degraded=False):
+    # (run, results) with the codespeed result dicts of an archived run
+    path = run['path']
+    if skip_degraded and machine_preflight.is_degraded(path):
+        return run, []
+
+    results = []
+    for fname in sorted(glob.glob(os.path.join(path, '*.orun.bench'))):
+        aggregated_data = orun_bench.aggregate_orun_bench(fname, fields=[m[0] for m in upload_metrics])
+        base = {
+            'commitid': run['hash'][:7],
+            'commitid_long': run['hash'],
+            'project': run['project'],
+            'branch': run['branch'],
+            'executable': run['executable'],
+            ## the orun.bench file is named after the sandmark version tag
+            'executable_description': os.path.basename(fname)[:-len('.orun.bench')],
+            'environment': run['environment'],
+            }
+        if pipeline.timestamp_date(run['timestamp']):
+            base['result_date'] = pipeline.timestamp_date(run['timestamp'])
+        results.extend(orun_bench.format_for_upload(aggregated_data, upload_metrics, base, run['location']))
+
+    summaries = sorted(glob.glob(os.path.join(path, load_operf_data.GLOB_PATTERN)))
+    if summaries and os.path.exists(os.path.join(path, 'build_context.conf')) and os.path.exists(os.path.join(path, 'run_context.conf')):
+        context = load_operf_data.get_context(path)
+        for fname in summaries:
+            results.extend(load_operf_data.parse_results(fname, context))
+
+    preflight = machine_preflight.read_preflight(path)
+    if preflight:
+        for r in results:
+            r.setdefault('metadata', {})['environment_fingerprint'] = preflight['fingerprint_id']
+    return run, results
+
+def try_parse_run(run, upload_metrics, skip_degraded=False):
+    # parse_run for the process pool: (run, results or None if the parse failed)
+    try:
+        return parse_run(run, upload_metrics, skip_degraded)
+    except Exception as e:
+        print('ERROR: failed to parse %s: %s'%(run['path'], e))
+        return run, None
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk upload archived benchmark results into codespeed')
+    parser.add_argument('archive_dirs', type=str, nargs='+', help='archive directories to walk')
+    parser.add_argument('--codespeed_url', type=str, help='codespeed URL for upload', default=CODESPEED_URL)
+    parser.add_argument('--codespeed_db', type=str, help='load straight into this codespeed sqlite database instead of the http upload', default=None)
+    parser.add_argument('--upload_metrics', type=str, help='comma seperated orun fields to upload, as field or field:units:units_title; "all" for every known field (default: %s)'%orun_bench.PRIMARY_METRIC, default=orun_bench.PRIMARY_METRIC)
+    parser.add_argument('--repo', type=str, help='ocaml repo to date the commits from (default: %s if there)'%os.path.join(SCRIPTDIR, 'ocaml__ocaml'), default=os.path.join(SCRIPTDIR, 'ocaml__ocaml'))
+    parser.add_argument('--all_timestamps', action='store_true', help='ingest every archived timestamp, not just the latest per commit and executable', default=False)
+    parser.add_argument('--skip_degraded', action='store_true', help='do not ingest results whose preflight found problems', default=False)
+    parser.add_argument('--ledger_dir', type=str, help='where the ledger of ingested runs (%s) is kept (default: .)'%LEDGER_FNAME, default='.')
+    parser.add_argument('--force', action='store_true', help='ingest runs even if the ledger or database already has them', default=False)
+    parser.add_argument('-j', '--jobs', type=int, help='number of processes parsing runs (default: cpu count)', default=os.cpu_count())
+    parser.add_argument('--upload_workers', type=int, help='concurrent http uploads (default: 4)', default=4)
+    parser.add_argument('--batch_size', type=int, help='results per database load or upload batch (default: 5000)', default=5000)
+    parser.add_argument('--spool_dir', type=str, help='where unsent uploads are kept to be replayed by the next run', default=None)
+    parser.add_argument('--dry_run', action='store_true', default=False)
+    parser.add_argument('-v', '--verbose', action='store_true', default=False)
+
+    args = parser.parse_args()
+
+    try:
+        upload_metrics = orun_bench.parse_metrics(args.upload_metrics)
+    except ValueError as e:
+        parser.error(str(e))
+
+    ## walk the archives
+    runs = []
+    for archive_dir in args.archive_dirs:
+        archive_dir = os.path.abspath(archive_dir)
+        if not os.path.isdir(archive_dir):
+            print('ERROR: archive directory %s not found'%archive_dir)
+            sys.exit(1)
+        runs.extend(find_runs(archive_dir, args.verbose))
+    n_found = len(runs)
+    if not args.all_timestamps:
+        runs = latest_runs(runs)
+
+    ## skip what the destination already has
+    destination = 'db:%s'%os.path.abspath(args.codespeed_db) if args.codespeed_db else args.codespeed_url
+    ledger_stage = LEDGER_STAGE_PREFIX + destination
+    ledger = run_manifest.RunManifest(args.ledger_dir, verbose=args.verbose, fname=LEDGER_FNAME)
+    db = codespeed_db.CodespeedDB(args.codespeed_db, verbose=args.verbose) if args.codespeed_db else None
+
+    def already_ingested(run):
+        if ledger.is_done(run['location'], ledger_stage):
+            return True
+        return db is not None and db.has_results(run['project'], run['branch'], run['hash'], run['executable'], run['environment'])
+
+    if not args.force:
+        runs = [run for run in runs if not already_ingested(run)]
+    print('Found %d archived runs, %d to ingest into %s'%(n_found, len(runs), destination))
+
+    ## dates for the revisions, which a direct database load needs
+    version_resolver = git_hashes.get_version_resolver(args.repo) if args.codespeed_db and os.path.isdir(args.repo) else None
+    if args.codespeed_db and version_resolver is None:
+        print('WARN: no ocaml repo at %s, revisions will be dated with the load time'%args.repo)
+
+    def upload(batch_runs, batch_results):
+        # False if the batch wasn't loaded; its runs stay out of the ledger to be retried
+        if args.dry_run:
+            print('DRY_RUN would have loaded %d results from %d runs'%(len(batch_results), len(batch_runs)))
+            return True
+        if db is not None:
+            try:
+                db.load(batch_results)
+            except (ValueError, sqlite3.Error) as e:
+                print('ERROR: failed to load %d results into %s: %s'%(len(batch_results), args.codespeed_db, e))
+                print('ERROR: not loaded, to retry on the next run: %s'%' '.join(run['path'] for run in batch_runs))
+                return False
+            ok = True
+        else:
+            ok = codespeed_upload.post_data_to_server(args.codespeed_url, batch_results, verbose=args.verbose, spool_dir=args.spool_dir, max_workers=args.upload_workers)
+            if not ok:
+                print('WARN: not all results of %d runs reached %s'%(len(batch_runs), args.codespeed_url))
+        ## runs with results left in the spool are retried next time
+        if ok:
+            for run in batch_runs:
+                ledger.mark_done(run['location'], ledger_stage, {'path': run['path'], 'results': run['n_results']})
+        return True
+
+    n_results, n_failed, n_not_loaded = 0, 0, 0
+    batch_runs, batch_results = [], []
+    with ProcessPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        for run, results in executor.map(functools.partial(try_parse_run, upload_metrics=upload_metrics, skip_degraded=args.skip_degraded), runs, chunksize=4):
+            if results is None:
+                n_failed += 1
+                continue
+            if args.verbose: print('parsed %d results from %s'%(len(results), run['path']))
+            if version_resolver is not None:
+                revision_date = version_resolver.commit_date(run['hash'])
+                if revision_date:
+                    for r in results:
+                        r['revision_date'] = revision_date
+            run['n_results'] = len(results)
+            batch_runs.append(run)
+            batch_results.extend(results)
+            if len(batch_results) >= args.batch_size:
+                if upload(batch_runs, batch_results):
+                    n_results += len(batch_results)
+                else:
+                    n_not_loaded += len(batch_runs)
+                batch_runs, batch_results = [], []
+    if batch_runs:
+        if upload(batch_runs, batch_results):
+            n_results += len(batch_results)
+        else:
+            n_not_loaded += len(batch_runs)
+
+    if db is not None:
+        db.close()
+    print('%s %d results from %d runs (%d runs failed to parse, %d failed to load)'%('DRY_RUN would have ingested' if args.dry_run else 'Ingested',
+          n_results, len(runs) - n_failed - n_not_loaded, n_failed, n_not_loaded))
+
+if __name__ == '__main__':
+    main()
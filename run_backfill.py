@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
 
 import argparse
-import datetime
+import functools
 import inspect
 import os
-import subprocess
 import yaml
 
+import build_cache
 import git_hashes
+import github_status
+import machine_preflight
+import pipeline
+import run_manifest
 
 def get_script_dir():
  	return os.path.dirname(inspect.getabsfile(get_script_dir))
@@ -19,6 +23,7 @@ DEFAULT_MAIN_BRANCH = 'trunk'
 OPERF_BINARY = os.path.join(SCRIPTDIR, 'operf-micro/opt/bin/operf-micro')
 CODESPEED_URL = 'http://localhost:8000/'
 ENVIRONMENT = 'macbook'
+GITHUB_STATUS_CACHE = os.path.join(SCRIPTDIR, 'github_status_cache.json')
 
 parser = argparse.ArgumentParser(description='Build ocaml binaries, benchmarks and upload them for a backfill')
 parser.add_argument('outdir', type=str, help='directory of output')
@@ -33,35 +38,39 @@ parser.add_argument('--commit_choice_method', type=str, help='commit choice meth
 parser.add_argument('--commit_after', type=str, help='select commits after the specified date (e.g. 2017-10-02)', default=None)
 parser.add_argument('--commit_before', type=str, help='select commits before the specified date (e.g. 2017-10-02)', default=None)
 parser.add_argument('--github_oauth_token', type=str, help='oauth token for github api', default=None)
+parser.add_argument('--github_api_url', type=str, help='github api location (default: %s)'%github_status.GITHUB_API_URL, default=github_status.GITHUB_API_URL)
+parser.add_argument('--github_status_cache', type=str, help='file caching github commit states that can no longer change (default: %s)'%GITHUB_STATUS_CACHE, default=GITHUB_STATUS_CACHE)
 parser.add_argument('--max_hashes', type=int, help='maximum_number of hashes to process', default=1000)
 parser.add_argument('--run_stages', type=str, help='stages to run (e.g. build,operf,upload,ocaml_cleanup)', default='build,operf,upload')
 parser.add_argument('--executable_spec', type=str, help='name for executable and configure_args for build in "name:configure_args" fmt (e.g. flambda:--enable_flambda)', default='vanilla:')
 parser.add_argument('--use_addr_no_randomize', action='store_true', help='use addr_no_randomize to run the operf benchmarks (Linux only)', default=False)
 parser.add_argument('--rerun_operf', action='store_true', help='regenerate operf results with rerun if already present', default=False)
+parser.add_argument('--operf_bench_cores', type=str, help='pool of isolated cores to run the operf benchmarks on concurrently (e.g. 2-5,8)', default='')
 parser.add_argument('--no_operf_cleanup', action='store_true', help='don\'t cleanup the operf results', default=False)
 parser.add_argument('--environment', type=str, help='environment tag for run (default: %s)'%ENVIRONMENT, default=ENVIRONMENT)
 parser.add_argument('--upload_project_name', type=str, help='specific upload project name (default is ocaml_<branch name>', default=None)
 parser.add_argument('--upload_date_tag', type=str, help='specific date tag to upload', default=None)
 parser.add_argument('--codespeed_url', type=str, help='codespeed URL for upload', default=CODESPEED_URL)
+parser.add_argument('--build_cache_dir', type=str, help='compiler and operf-micro benchmark build cache shared between outdirs, branches and executable variants', default=None)
+parser.add_argument('--build_cache_max_gb', type=float, help='size bound of the compiler build cache in GB', default=None)
+parser.add_argument('--pipeline_lookahead', type=int, help='overlap the hashes: build up to this many hashes ahead (on --build_cores) while operf runs, uploading in the background (default: 0, off)', default=0)
+parser.add_argument('--build_cores', type=str, help='cores to pin the compiler builds to (e.g. 0,1); keep them apart from --operf_bench_cores', default='')
 parser.add_argument('-j', '--jobs', type=int, help='number of concurrent jobs during build', default=1)
+parser.add_argument('--profile_trace', type=str, help='JSONL trace of the time, CPU, peak RSS and bytes written of every stage and command (default: <outdir>/profile_<timestamp>.jsonl)', default=None)
 parser.add_argument('-v', '--verbose', action='store_true', default=False)
 
 args = parser.parse_args()
 args.sandmark_tag_override = None
+if args.commit_choice_method.startswith('bisect='):
+	parser.error('bisect is only supported by run_sandmark_backfill.py')
 
-def shell_exec(cmd, verbose=args.verbose, check=False, stdout=None, stderr=None):
-	if verbose:
-		print('+ %s'%cmd)
-	return subprocess.run(cmd, shell=True, check=check, stdout=stdout, stderr=stderr)
-
-
-def shell_exec_redirect(cmd, fname, verbose=args.verbose, check=False):
-	if verbose:
-		print('+ %s'%cmd)
-		print('+ with stdout/stderr -> %s'% fname)
-	with open(fname, 'w') as f:
-		return shell_exec(cmd, verbose=False, check=check, stdout=f, stderr=subprocess.STDOUT)
+if args.pipeline_lookahead > 0 and not args.build_cores:
+	print('WARN: --pipeline_lookahead without --build_cores, the builds running ahead will compete with the operf benchmarks for cores')
+if set(machine_preflight.parse_cpu_list(args.build_cores)) & set(machine_preflight.parse_cpu_list(args.operf_bench_cores)):
+	print('WARN: --build_cores %s overlaps --operf_bench_cores %s'%(args.build_cores, args.operf_bench_cores))
 
+shell_exec = functools.partial(pipeline.shell_exec, verbose=args.verbose)
+shell_exec_redirect = functools.partial(pipeline.shell_exec_redirect, verbose=args.verbose)
 
 def write_context(context, fname, verbose=args.verbose):
 	s = yaml.dump(context, default_flow_style=False)
@@ -70,102 +79,175 @@ def write_context(context, fname, verbose=args.verbose):
 	print(s, file=open(fname, 'w'))
 
 
-run_timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+run_timestamp = pipeline.timestamp()
 
-run_stages = args.run_stages.split(',')
+try:
+	run_stages = pipeline.parse_stages(args.run_stages, ['build', 'operf', 'ocaml_cleanup', 'upload'])
+except ValueError as e:
+	parser.error(str(e))
 if args.verbose: print('will run stages: %s'%run_stages)
 
 ## setup directory
 outdir = os.path.abspath(args.outdir)
 if args.verbose: print('making directory: %s'%outdir)
 shell_exec('mkdir -p %s'%outdir)
+profile_trace = os.path.abspath(args.profile_trace) if args.profile_trace else os.path.join(outdir, 'profile_%s.jsonl'%run_timestamp)
+pipeline.profiler.open_trace(profile_trace)
 
 ## generate list of hash commits
 repo_path = os.path.abspath(args.repo)
-hashes = git_hashes.get_git_hashes(args)
+with pipeline.profiler.span(None, 'select_hashes'):
+	hashes = git_hashes.get_git_hashes(args)
 hashes = hashes[-args.max_hashes:]
 
 if args.verbose:
 	print('Found %d hashes using %s to do %s on'%(len(hashes), args.commit_choice_method, args.run_stages))
 
+manifest = run_manifest.RunManifest(outdir, verbose=args.verbose)
+
 verbose_args = ' -v' if args.verbose else ''
 os.chdir(outdir)
-for h in hashes:
+
+def hash_context(h, resource):
 	hashdir = os.path.join(outdir, h)
 	if args.verbose: print('processing to %s'%hashdir)
 	shell_exec('mkdir -p %s'%hashdir)
 
-	## run build for commit
 	builddir = os.path.join(hashdir, 'ocaml_build')
-	build_context_fname = os.path.join(builddir, 'build_context.conf')
-	if 'build' in args.run_stages:
-		executable_name, configure_args = args.executable_spec.split(':')
-
-		if os.path.isfile(os.path.join(builddir, 'bin', 'ocaml')):
-			print('Skipping build for %s as already built'%h)
-		else:
-			log_fname = os.path.join(hashdir, 'build_%s.log'%run_timestamp)
-			use_reference_opt = '--use_reference' if args.use_repo_reference else ''
-			completed_proc = shell_exec_redirect('%s/build_ocaml_hash.py --repo %s %s -j %d --configure_args="%s" %s %s %s'%(SCRIPTDIR, repo_path, use_reference_opt, args.jobs, configure_args, verbose_args, h, builddir), log_fname)
-			if completed_proc.returncode != 0:
-				print('ERROR[%d] in build_ocaml_hash for %s (see %s)'%(completed_proc.returncode, h, log_fname))
-				continue
-
-			# output build context
-			build_context = {
-				'commitid': h[:7],
-				'commitid_long': h,
-				'branch': args.branch,
-				'project': args.upload_project_name if args.upload_project_name else 'ocaml_%s'%args.branch,
-				'executable': executable_name,
-				'executable_description': './configure %s'%configure_args,
-			}
-			write_context(build_context, build_context_fname)
-
+	return pipeline.HashContext(h, resource,
+		hashdir=hashdir,
+		builddir=builddir,
+		build_context_fname=os.path.join(builddir, 'build_context.conf'),
+		operf_micro_dir=os.path.join(hashdir, 'operf-micro'))
+
+def skip_build(ctx):
+	built = os.path.isfile(os.path.join(ctx.builddir, 'bin', 'ocaml'))
+	if built and os.path.isfile(ctx.build_context_fname) and manifest.get(ctx.h, 'build') is None:
+		## from a run before the manifest existed
+		manifest.mark_done(ctx.h, 'build', {'builddir': ctx.builddir})
+
+	if built and manifest.is_done(ctx.h, 'build'):
+		print('Skipping build for %s as already built'%ctx.h)
+		return True
+	return False
+
+def build_cache_opts():
+	## the compiler builds and the operf-micro benchmark builds share the cache and its size bound
+	if not args.build_cache_dir:
+		return ''
+	opts = '--cache_dir %s'%os.path.abspath(args.build_cache_dir)
+	if args.build_cache_max_gb:
+		opts += ' --cache_max_gb %f'%args.build_cache_max_gb
+	return opts
+
+def build_stage(ctx, stage):
+	## run build for commit
+	h, builddir = ctx.h, ctx.builddir
+	executable_name, configure_args = args.executable_spec.split(':')
+	if os.path.exists(builddir):
+		print('Removing build directory for %s left by an incomplete build'%h)
+		shell_exec('rm -rf %s'%builddir)
+
+	log_fname = os.path.join(ctx.hashdir, 'build_%s.log'%run_timestamp)
+	use_reference_opt = '--use_reference' if args.use_repo_reference else ''
+	build_cache_opt = build_cache_opts()
+	## keep the build (and everything make runs) off the bench cores
+	taskset_prefix = 'taskset --cpu-list %s '%args.build_cores if args.build_cores else ''
+	completed_proc = shell_exec_redirect('%s%s/build_ocaml_hash.py --repo %s %s %s -j %d --configure_args="%s" %s %s %s'%(taskset_prefix, SCRIPTDIR, repo_path, use_reference_opt, build_cache_opt, args.jobs, configure_args, verbose_args, h, builddir), log_fname)
+	stage.artifacts = {'builddir': builddir, 'log': log_fname}
+	if completed_proc.returncode != 0:
+		print('ERROR[%d] in build_ocaml_hash for %s (see %s)'%(completed_proc.returncode, h, log_fname))
+		stage.exit_code = completed_proc.returncode
+		return
+
+	# output build context
+	build_context = {
+		'commitid': h[:7],
+		'commitid_long': h,
+		'branch': args.branch,
+		'project': args.upload_project_name if args.upload_project_name else 'ocaml_%s'%args.branch,
+		'executable': executable_name,
+		'executable_description': './configure %s'%configure_args,
+	}
+	write_context(build_context, ctx.build_context_fname)
+
+def skip_operf(ctx):
+	h, operf_micro_dir = ctx.h, ctx.operf_micro_dir
+	if manifest.get(h, 'operf') is None and os.path.exists(operf_micro_dir) and os.listdir(operf_micro_dir):
+		## from a run before the manifest existed
+		manifest.mark_done(h, 'operf', {'result_dir': os.path.join(operf_micro_dir, sorted(os.listdir(operf_micro_dir))[-1])})
+
+	if args.rerun_operf or not manifest.is_done(h, 'operf'):
+		return False
+	print('Skipping operf run for %s as already have results %s'%(h, manifest.artifacts(h, 'operf').get('result_dir')))
+	return True
+
+def operf_stage(ctx, stage):
 	## run operf for commit
-	operf_micro_dir = os.path.join(hashdir, 'operf-micro')
-	if 'operf' in args.run_stages:
-		if args.rerun_operf or not os.path.exists(operf_micro_dir) or not os.listdir(operf_micro_dir):
-			log_fname = os.path.join(hashdir, 'operf_%s.log'%run_timestamp)
-			use_addr_no_randomize_opt = '--use_addr_no_randomize' if args.use_addr_no_randomize else ''
-			no_operf_cleanup_opt = '--no_clean' if args.no_operf_cleanup else ''
-			completed_proc = shell_exec_redirect('%s/run_operf_micro.py --make_plots --results_timestamp %s --operf_binary %s %s %s %s %s %s'%(SCRIPTDIR, run_timestamp, OPERF_BINARY, use_addr_no_randomize_opt, no_operf_cleanup_opt, verbose_args, os.path.join(builddir, 'bin'), operf_micro_dir), log_fname)
-			if completed_proc.returncode != 0:
-				print('ERROR[%d] in run_operf_micro for %s (see %s)'%(completed_proc.returncode, h, log_fname))
-				continue
-
-			# output run context
-			run_context = {
-				'environment': args.environment,
-			}
-
-			resultdir = os.path.join(operf_micro_dir, run_timestamp)
-			write_context(run_context, os.path.join(resultdir, 'run_context.conf'))
-			shell_exec('cp %s %s'%(build_context_fname, os.path.join(resultdir, 'build_context.conf')))
-		else:
-			print('Skipping operf run for %s as already have results %s'%(h, os.listdir(operf_micro_dir)))
-
+	h = ctx.h
+	log_fname = os.path.join(ctx.hashdir, 'operf_%s.log'%run_timestamp)
+	use_addr_no_randomize_opt = '--use_addr_no_randomize' if args.use_addr_no_randomize else ''
+	no_operf_cleanup_opt = '--no_clean' if args.no_operf_cleanup else ''
+	bench_cores_opt = '--bench_cores %s'%args.operf_bench_cores if args.operf_bench_cores else ''
+	completed_proc = shell_exec_redirect('%s/run_operf_micro.py --make_plots --results_timestamp %s --operf_binary %s %s %s %s %s %s %s %s'%(SCRIPTDIR, run_timestamp, OPERF_BINARY, use_addr_no_randomize_opt, no_operf_cleanup_opt, bench_cores_opt, build_cache_opts(), verbose_args, os.path.join(ctx.builddir, 'bin'), ctx.operf_micro_dir), log_fname)
+	if completed_proc.returncode != 0:
+		print('ERROR[%d] in run_operf_micro for %s (see %s)'%(completed_proc.returncode, h, log_fname))
+		stage.exit_code = completed_proc.returncode
+		return
+
+	# output run context
+	run_context = {
+		'environment': args.environment,
+	}
+
+	resultdir = os.path.join(ctx.operf_micro_dir, run_timestamp)
+	write_context(run_context, os.path.join(resultdir, 'run_context.conf'))
+	shell_exec('cp %s %s'%(ctx.build_context_fname, os.path.join(resultdir, 'build_context.conf')))
+	stage.artifacts = {'result_dir': resultdir}
+
+def ocaml_cleanup_stage(ctx, stage):
 	## cleanup the ocaml binaries
-	if 'ocaml_cleanup' in args.run_stages:
-		shell_exec('rm -rf %s %s'%(os.path.join(builddir, 'bin'), os.path.join(builddir, 'lib')))
+	shell_exec('rm -rf %s %s'%(os.path.join(ctx.builddir, 'bin'), os.path.join(ctx.builddir, 'lib')))
+	if args.build_cache_dir:
+		build_cache.BuildCache(args.build_cache_dir, verbose=args.verbose).release(ctx.builddir)
 
+def upload_stage(ctx, stage):
 	## upload commit
-	if 'upload' in args.run_stages:
-		log_fname = os.path.join(hashdir, 'upload_%s.log'%run_timestamp)
-
-		if args.upload_date_tag:
-			resultdir = args.upload_date_tag
-		else:
+	h, operf_micro_dir = ctx.h, ctx.operf_micro_dir
+	log_fname = os.path.join(ctx.hashdir, 'upload_%s.log'%run_timestamp)
+
+	if args.upload_date_tag:
+		resultdir = os.path.join(operf_micro_dir, args.upload_date_tag)
+	else:
+		resultdir = manifest.artifacts(h, 'operf').get('result_dir')
+		if resultdir is None:
+			## from a run before the manifest existed
 			result_dirs = sorted(os.listdir(operf_micro_dir)) if os.path.exists(operf_micro_dir) else []
-			resultdir = result_dirs[-1] if result_dirs else None
-
-		if resultdir:
-			resultdir = os.path.join(operf_micro_dir, resultdir)
-			print('uploading results from %s'%resultdir)
-
-			completed_proc = shell_exec_redirect('%s/load_operf_data.py --codespeed_url %s %s %s'%(SCRIPTDIR, args.codespeed_url, verbose_args, resultdir), log_fname)
-			if completed_proc.returncode != 0:
-				print('ERROR[%d] in load_operf_data for %s (see %s)'%(completed_proc.returncode, h, log_fname))
-				continue
-		else:
-			print("ERROR couldn't find any result directories to upload in %s"%operf_micro_dir)
+			resultdir = os.path.join(operf_micro_dir, result_dirs[-1]) if result_dirs else None
+
+	if not resultdir:
+		print("ERROR couldn't find any result directories to upload in %s"%operf_micro_dir)
+		stage.exit_code = 1
+		return
+
+	print('uploading results from %s'%resultdir)
+	completed_proc = shell_exec_redirect('%s/load_operf_data.py --codespeed_url %s --spool_dir %s %s %s'%(SCRIPTDIR, args.codespeed_url, os.path.join(outdir, 'upload_spool'), verbose_args, resultdir), log_fname)
+	stage.artifacts = {'uploaded': resultdir}
+	if completed_proc.returncode != 0:
+		print('ERROR[%d] in load_operf_data for %s (see %s)'%(completed_proc.returncode, h, log_fname))
+		stage.exit_code = completed_proc.returncode
+
+pipeline_stages = [
+	pipeline.Stage('build', build_stage, skip=skip_build, lane='build'),
+	pipeline.Stage('operf', operf_stage, depends=['build'], skip=skip_operf),
+	pipeline.Stage('ocaml_cleanup', ocaml_cleanup_stage, depends=['build', 'operf'], skip=lambda ctx: False, lane='post'),
+	pipeline.Stage('upload', upload_stage, depends=['build', 'operf'], skip=lambda ctx: False, lane='post'),
+]
+hash_pipeline = pipeline.Pipeline(pipeline_stages, run_stages, manifest, run_timestamp, hash_context, verbose=args.verbose)
+if args.pipeline_lookahead > 0:
+	hash_pipeline.run_pipelined(hashes, lookahead=args.pipeline_lookahead)
+else:
+	hash_pipeline.run(hashes)
+pipeline.profiler.print_summary()
+pipeline.profiler.finish()
+print('Profile trace written to %s'%profile_trace)
@@ -0,0 +1,111 @@
+# Python module for a per-outdir manifest of the stages run for each hash
+#
+# The manifest is a sqlite database at <outdir>/manifest.db with a row per
+# (hash, stage) holding its status, start/finish times, exit code and the
+# artifact paths it produced. A stage is only 'done' once it finished
+# cleanly, so a hash directory left behind by a crashed run is not mistaken
+# for a finished one. Rows are read once at startup and then served from
+# memory, so lookups don't touch the filesystem.
+
+import datetime
+import json
+import os
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+
+MANIFEST_FNAME = 'manifest.db'
+
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS stages (
+    hash TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started TEXT,
+    finished TEXT,
+    exit_code INTEGER,
+    run_timestamp TEXT,
+    artifacts TEXT,
+    PRIMARY KEY (hash, stage)
+)
+'''
+
+def now_str():
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+class StageRecord:
+    # filled in by the stage body, see RunManifest.stage
+    def __init__(self):
+        self.exit_code = 0
+        self.artifacts = {}
+
+class RunManifest:
+    def __init__(self, outdir, verbose=False, fname=MANIFEST_FNAME):
+        self.fname = os.path.join(os.path.abspath(outdir), fname)
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.fname, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute(SCHEMA)
+        self.rows = {}
+        self.hashes = set()
+        cur = self.conn.execute('SELECT hash, stage, status, started, finished, exit_code, run_timestamp, artifacts FROM stages')
+        for h, stage, status, started, finished, exit_code, run_timestamp, artifacts in cur:
+            self.rows[(h, stage)] = {
+                'status': status, 'started': started, 'finished': finished, 'exit_code': exit_code,
+                'run_timestamp': run_timestamp, 'artifacts': json.loads(artifacts) if artifacts else {}}
+            self.hashes.add(h)
+
+    def _write(self, h, stage, row):
+        with self.lock:
+            self.rows[(h, stage)] = row
+            self.hashes.add(h)
+            self.conn.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (h, stage, row['status'], row['started'], row['finished'], row['exit_code'], row['run_timestamp'], json.dumps(row['artifacts'])))
+
+    def get(self, h, stage):
+        return self.rows.get((h, stage))
+
+    def has_hash(self, h):
+        return h in self.hashes
+
+    def is_done(self, h, stage):
+        row = self.get(h, stage)
+        return row is not None and row['status'] == STATUS_DONE
+
+    def artifacts(self, h, stage):
+        row = self.get(h, stage)
+        return row['artifacts'] if row else {}
+
+    def start(self, h, stage, run_timestamp=None):
+        self._write(h, stage, {'status': STATUS_RUNNING, 'started': now_str(), 'finished': None,
+                               'exit_code': None, 'run_timestamp': run_timestamp, 'artifacts': {}})
+
+    def finish(self, h, stage, exit_code=0, artifacts=None):
+        row = dict(self.get(h, stage) or {'started': None, 'run_timestamp': None})
+        row.update({'status': STATUS_DONE if exit_code == 0 else STATUS_FAILED, 'finished': now_str(),
+                    'exit_code': exit_code, 'artifacts': artifacts or {}})
+        self._write(h, stage, row)
+        if self.verbose: print('manifest: %s %s %s (exit_code=%s)'%(h, stage, row['status'], exit_code))
+
+    def mark_done(self, h, stage, artifacts=None, run_timestamp=None):
+        # record a stage that ran before there was a manifest
+        self.start(h, stage, run_timestamp)
+        self.finish(h, stage, 0, artifacts)
+
+    @contextmanager
+    def stage(self, h, stage, run_timestamp=None):
+        # records the stage as running, then done or failed from the yielded
+        # StageRecord's exit_code; an exception marks it failed
+        record = StageRecord()
+        self.start(h, stage, run_timestamp)
+        try:
+            yield record
+        except:
+            self.finish(h, stage, -1, record.artifacts)
+            raise
+        self.finish(h, stage, record.exit_code, record.artifacts)
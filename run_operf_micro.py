@@ -2,23 +2,34 @@
 
 import argparse
 import datetime
+import functools
 import glob
+import hashlib
+import heapq
 import os
+import queue
+import shutil
 import subprocess
 
+from concurrent.futures import ThreadPoolExecutor
+
+import build_cache
+import machine_preflight
+import pipeline
+
 OPERF_BINARY = '/Users/ctk21/proj/operf-micro/test/bin/operf-micro'
 BENCHMARKS = [
 	'almabench',
 	'nucleic',
-	'boyer', ## TODO: need a way to tag this as 'long'
-	'kb', ## TODO: need a way to tag this as 'long'
-	'num_analysis', ## TODO: need a way to tag this as 'long'
+	'boyer',
+	'kb',
+	'num_analysis',
 	'bigarray_rev',
 	'fibonnaci',
 	'lens',
 	##'vector_functor', NB: not obvious this one is doing enough to be sensible to run
 	'kahan_sum',
-	'hamming', ## TODO: need a way to tag this as 'long'
+	'hamming',
 	'sieve',
 	'list',
 	'format',
@@ -27,30 +38,62 @@ BENCHMARKS = [
 	'sequence',
 	'nullable_array',
 	]
-DEFAULT_TIME_QUOTA = 5.0
-
-## TODO: make time quotas a lookup for: Short, Long, Longer
-## TODO: make benchmarks a lookup of the type: 'almabench' -> {'Short'}
-## TODO: how to specify these through the command line... almabench:Short,nucleic:Long,...
+## duration classes: each class gets its own operf-micro time quota (in seconds)
+## so the long benchmarks still collect enough samples
+TIME_QUOTAS = {'Short': 5.0, 'Long': 15.0, 'Longer': 30.0}
+DEFAULT_CLASS = 'Short'
+BENCHMARK_CLASSES = {
+	'boyer': 'Long',
+	'kb': 'Long',
+	'num_analysis': 'Long',
+	'hamming': 'Long',
+	}
 
 parser = argparse.ArgumentParser(description='Run operf-micro and collate results')
 parser.add_argument('bindir', type=str, help='binary directory of ocaml compiler to use')
 parser.add_argument('outdir', type=str, help='output directory for results')
 parser.add_argument('--results_timestamp', type=str, help='explicit timestamp to use', default=datetime.datetime.now().strftime('%Y%m%d_%H%M%S'))
-parser.add_argument('--benchmarks', type=str, help='comma seperated list of benchmarks to run', default=','.join(BENCHMARKS))
+parser.add_argument('--benchmarks', type=str, help='comma seperated list of benchmarks to run, each optionally with its duration class (e.g. almabench:Short,nucleic:Long; default class from the built in registry, else %s)'%DEFAULT_CLASS, default=','.join(BENCHMARKS))
 parser.add_argument('--use_addr_no_randomize', action='store_true', help='Use addr_no_randomize option when running the benchmarks (Linux only)', default=False)
-parser.add_argument('--time_quota', help='time_quota for operf-micro (default: %s)'%DEFAULT_TIME_QUOTA, default=DEFAULT_TIME_QUOTA)
+parser.add_argument('--time_quotas', type=str, help='time quota per duration class for operf-micro (default: %s)'%','.join('%s=%s'%kv for kv in TIME_QUOTAS.items()), default='')
+parser.add_argument('--time_quota', type=float, help='one time quota for all benchmarks, overriding the duration classes', default=None)
 parser.add_argument('--operf_binary', type=str, help='operf binary to use', default=OPERF_BINARY)
 parser.add_argument('--make_plots', action='store_true', help='create png plots', default=False)
 parser.add_argument('--no_clean', action='store_true', help='don\'t cleanup the .operf directories after running', default=False)
+parser.add_argument('--cache_dir', type=str, help='build cache for the operf-micro benchmark builds, shared between runs; only benchmarks not in it are built', default=None)
+parser.add_argument('--cache_max_gb', type=float, help='size bound of the build cache in GB, least recently used entries are evicted', default=None)
+parser.add_argument('--bench_cores', type=str, help='pool of isolated cores to run benchmarks on concurrently, one benchmark per core (e.g. 2-5,8)', default='')
 parser.add_argument('-v', '--verbose', action='store_true', default=False)
 
 args = parser.parse_args()
 
-def shell_exec(cmd, verbose=args.verbose, check=True):
-	if verbose:
-		print('+ %s'%cmd)
-	subprocess.run(cmd, shell=True, check=check)
+time_quotas = dict(TIME_QUOTAS)
+for kv in filter(bool, args.time_quotas.split(',')):
+	cls, _, quota = kv.partition('=')
+	if cls not in TIME_QUOTAS:
+		parser.error('unknown duration class %s in --time_quotas (classes: %s)'%(cls, ','.join(TIME_QUOTAS)))
+	try:
+		time_quotas[cls] = float(quota)
+	except ValueError:
+		parser.error('bad time quota "%s" for %s in --time_quotas (give class=seconds, e.g. %s=15)'%(quota, cls, cls))
+
+def parse_benchmarks(s):
+	# 'almabench,nucleic:Long' -> [('almabench', 'Short'), ('nucleic', 'Long')]
+	res = []
+	for spec in filter(bool, s.split(',')):
+		name, _, cls = spec.partition(':')
+		cls = cls if cls else BENCHMARK_CLASSES.get(name, DEFAULT_CLASS)
+		if cls not in time_quotas:
+			parser.error('unknown duration class %s for %s (classes: %s)'%(cls, name, ','.join(time_quotas)))
+		res.append((name, cls))
+	return res
+
+benchmark_classes = parse_benchmarks(args.benchmarks)
+
+def time_quota(cls):
+	return args.time_quota if args.time_quota is not None else time_quotas[cls]
+
+shell_exec = functools.partial(pipeline.shell_exec, verbose=args.verbose, check=True)
 
 # setup the directories
 bindir = os.path.abspath(args.bindir)
@@ -69,9 +112,15 @@ def operf_cmd(s):
 	return '%s %s'%(args.operf_binary, s)
 
 ## NB: can't use the 'operf-micro run' -o option because the result files will
-##     then not be visible to the 'operf-micro results' command that follows
+##     then not be visible to the 'operf-micro results' command that follows.
+##     Instead each benchmark gets a private HOME so its results land in its
+##     own .operf store, which keeps concurrent benchmarks and other
+##     instances on the same account apart.
+def operf_home(benchmark):
+	return os.path.join(resultdir, 'operf_home', benchmark)
+
 def copy_out_results(tag, benchmark, resultdir):
-	operf_results_tag_dir = os.path.join(os.path.expanduser('~'), '.operf', 'micro', tag, '*')
+	operf_results_tag_dir = os.path.join(operf_home(benchmark), '.operf', 'micro', tag, '*')
 	all_run_dirs = sorted(glob.glob(operf_results_tag_dir))
 	if len(all_run_dirs) > 0:
 		run_dir = all_run_dirs[-1]
@@ -79,25 +128,129 @@ def copy_out_results(tag, benchmark, resultdir):
 	else:
 		print('ERROR: failed to find runs in %s'%operf_results_tag_dir)
 
-
-shell_exec(operf_cmd('init --bin-dir %s %s'%(bindir, tag)))
-shell_exec(operf_cmd('build'))
-
-for b in args.benchmarks.split(','):
+def run_benchmark(b, cls, core):
 	try:
-		print('%s: running %s'%(str(datetime.datetime.now()), b))
+		print('%s: running %s (%s, core=%s)'%(str(datetime.datetime.now()), b, cls, core))
+		home = operf_home(b)
+		shell_exec('mkdir -p %s'%home)
+		env_prefix = 'HOME=%s '%home
+		taskset_prefix = 'taskset --cpu-list %d '%core if core is not None else ''
 		no_randomize_prefix = 'setarch `uname -m` --addr-no-randomize ' if args.use_addr_no_randomize else ''
-		shell_exec(no_randomize_prefix+operf_cmd('run --time-quota %s %s'%(args.time_quota, b)))
+		shell_exec(env_prefix+taskset_prefix+no_randomize_prefix+operf_cmd('run --time-quota %s %s'%(time_quota(cls), b)))
 		copy_out_results(tag, b, resultdir)
-		shell_exec(operf_cmd('results %s --selected %s --more-yaml > %s.summary'%(tag, b, os.path.join(resultdir, b))))
-		if args.make_plots:
-			shell_exec(operf_cmd('plot --png %s %s'%(b, tag)))
-			plotdir = os.path.join(resultdir, 'plot')
-			shell_exec('mkdir -p %s && mv %s/.operf/micro/plot/*.png %s'%(plotdir, resultdir, plotdir))
+		shell_exec(env_prefix+operf_cmd('results %s --selected %s --more-yaml > %s.summary'%(tag, b, os.path.join(resultdir, b))))
+		return True
 	except Exception as e:
 		print('ERROR: operf run failed for %s'%b)
 		print(e)
+		return False
+
+## where 'operf-micro build' leaves each benchmark's build, relative to the init directory
+OPERF_BUILD_DIR = os.path.join('.operf', 'micro')
+
+def file_digest(fname):
+	with open(fname, 'rb') as f:
+		return hashlib.sha256(f.read()).hexdigest()
+
+def bindir_identity(bindir):
+	# the compiler's bytes and config (which has its install paths) rather than the bindir path
+	ocamlopt = os.path.join(bindir, 'ocamlopt')
+	config = shell_exec('%s -config'%ocamlopt, check=False, stdout=subprocess.PIPE).stdout.decode('utf-8')
+	return [file_digest(os.path.realpath(ocamlopt)), config]
+
+def operf_version():
+	proc_output = shell_exec(operf_cmd('--version'), check=False, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+	return [file_digest(os.path.realpath(shutil.which(args.operf_binary) or args.operf_binary)), proc_output.stdout.decode('utf-8').strip()]
+
+def build_benchmarks(benchmarks):
+	# build the benchmarks not already in the cache and restore the rest from it
+	if args.cache_dir is None:
+		shell_exec(operf_cmd('build'))
+		return
+	max_bytes = None if args.cache_max_gb is None else int(args.cache_max_gb * 1024**3)
+	cache = build_cache.BuildCache(args.cache_dir, max_bytes=max_bytes, verbose=args.verbose)
+	key_parts = bindir_identity(bindir) + operf_version()
+	keys = {b: cache.key('operf-micro', b, *key_parts) for b in benchmarks}
+
+	to_build = []
+	for b in benchmarks:
+		with cache.lock(keys[b]):
+			entry = cache.lookup(keys[b])
+			if entry is None:
+				to_build.append(b)
+				continue
+			if args.verbose: print('restoring the %s build from %s'%(b, entry))
+			shell_exec('rm -rf %s'%os.path.join(OPERF_BUILD_DIR, b))
+			shutil.copytree(os.path.join(entry, b), os.path.join(OPERF_BUILD_DIR, b), symlinks=True)
+
+	print('%d of %d benchmark builds from the cache, building %s'%(len(benchmarks) - len(to_build), len(benchmarks), ','.join(to_build) if to_build else 'none'))
+	if not to_build:
+		return
+	shell_exec(operf_cmd('build %s'%' '.join(to_build)))
+	for b in to_build:
+		build_dir = os.path.join(OPERF_BUILD_DIR, b)
+		if not os.path.isdir(build_dir):
+			print('WARN: not caching %s as its build is not in %s'%(b, build_dir))
+			continue
+		with cache.lock(keys[b]):
+			if cache.is_complete(keys[b]):
+				## another run published it meanwhile
+				continue
+			entry = cache.prepare(keys[b])
+			shutil.copytree(build_dir, os.path.join(entry, b), symlinks=True)
+			cache.publish(keys[b], info={'benchmark': b, 'bindir': bindir})
+
+shell_exec(operf_cmd('init --bin-dir %s %s'%(bindir, tag)))
+build_benchmarks([b for b, cls in benchmark_classes])
+
+## the benchmarks share the build and each takes a core from the pool while it runs
+bench_cores = machine_preflight.parse_cpu_list(args.bench_cores)
+core_pool = queue.Queue()
+for c in bench_cores if bench_cores else [None]:
+	core_pool.put(c)
+
+def schedule(benchmarks, n_cores):
+	# Longest expected duration first: each core takes the next benchmark as
+	# it frees up, which keeps the long ones from being left to the end of
+	# the sweep on one core (LPT list scheduling). Returns the order and the
+	# expected makespan in seconds. On one core the order doesn't change
+	# the makespan, so the given order is kept.
+	order = sorted(benchmarks, key=lambda bc: -time_quota(bc[1])) if n_cores > 1 else list(benchmarks)
+	cores = [0.]*n_cores
+	for b, cls in order:
+		heapq.heappush(cores, heapq.heappop(cores) + time_quota(cls))
+	return order, max(cores)
+
+def run_benchmark_on_core(bc):
+	core = core_pool.get()
+	try:
+		return run_benchmark(bc[0], bc[1], core)
+	finally:
+		core_pool.put(core)
+
+n_cores = core_pool.qsize()
+schedule_order, makespan = schedule(benchmark_classes, n_cores)
+print('running %d benchmarks on %d cores, expected to take %.0fs of time quota'%(len(schedule_order), n_cores, makespan))
+if args.verbose:
+	for b, cls in schedule_order:
+		print('  %s: %s (time quota %s)'%(b, cls, time_quota(cls)))
+benchmarks = [b for b, cls in schedule_order]
+with ThreadPoolExecutor(max_workers=n_cores) as executor:
+	succeeded = dict(zip(benchmarks, executor.map(run_benchmark_on_core, schedule_order)))
+
+## plots go through the shared .operf/micro/plot directory so are made one at a time
+if args.make_plots:
+	plotdir = os.path.join(resultdir, 'plot')
+	for b in benchmarks:
+		if not succeeded[b]:
+			continue
+		try:
+			shell_exec('HOME=%s %s'%(operf_home(b), operf_cmd('plot --png %s %s'%(b, tag))))
+			shell_exec('mkdir -p %s && mv %s/.operf/micro/plot/*.png %s'%(plotdir, resultdir, plotdir))
+		except Exception as e:
+			print('ERROR: operf plot failed for %s'%b)
+			print(e)
 
 if not args.no_clean:
 	shell_exec(operf_cmd('clean'), check=False)
-	shell_exec('rm -rf %s'%os.path.join(os.path.expanduser('~'), '.operf', 'micro', tag))
+	shell_exec('rm -rf %s'%os.path.join(resultdir, 'operf_home'))
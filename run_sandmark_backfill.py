@@ -2,15 +2,28 @@
 
 import argparse
 import datetime
+import fcntl
+import functools
 import glob
 import inspect
 import json
 import os
-import pandas
+import shutil
 import subprocess
+import sys
 
+from contextlib import contextmanager
+
+import build_cache
 import git_hashes
+import github_status
+import machine_preflight
+import change_detection
+import codespeed_db
 import codespeed_upload
+import orun_bench
+import pipeline
+import run_manifest
 
 def get_script_dir():
     return os.path.dirname(inspect.getabsfile(get_script_dir))
@@ -24,6 +37,7 @@ SANDMARK_COMP_FMT_DEFAULT = 'https://github.com/ocaml/ocaml/archive/{tag}.tar.gz
 SANDMARK_RUN_BENCH_TARGETS_DEFAULT = 'run_orun'
 CODESPEED_URL = 'http://localhost:8000/'
 ENVIRONMENT = 'macbook'
+GITHUB_STATUS_CACHE = os.path.join(SCRIPTDIR, 'github_status_cache.json')
 
 parser = argparse.ArgumentParser(description='Run sandmark benchmarks and upload them for a backfill')
 parser.add_argument('outdir', type=str, help='directory of output')
@@ -34,20 +48,37 @@ parser.add_argument('--repo_pull', action='store_true', help="do a pull on the g
 parser.add_argument('--repo_reset_hard', action='store_true', help="after pulling a branch, reset it hard to the origin. Can need this for remote branches where they have been force pushed", default=False)
 parser.add_argument('--use_repo_reference', action='store_true', help="use reference to clone a local git repo", default=False)
 parser.add_argument('--no_first_parent', action='store_true', help="By default we use first-parent on git logs (to keep date ordering sane); this option turns it off", default=False)
-parser.add_argument('--commit_choice_method', type=str, help='commit choice method (version_tags, status_success, hash=XXX, delay=00:05:00, all)', default='version_tags')
+parser.add_argument('--commit_choice_method', type=str, help='commit choice method (version_tags, status_success, hash=XXX, delay=00:05:00, all, bisect=<good>..<bad>:<benchmark>[:threshold])', default='version_tags')
 parser.add_argument('--commit_after', type=str, help='select commits after the specified date (e.g. 2017-10-02)', default=None)
 parser.add_argument('--commit_before', type=str, help='select commits before the specified date (e.g. 2017-10-02)', default=None)
 parser.add_argument('--github_oauth_token', type=str, help='oauth token for github api', default=None)
+parser.add_argument('--github_api_url', type=str, help='github api location (default: %s)'%github_status.GITHUB_API_URL, default=github_status.GITHUB_API_URL)
+parser.add_argument('--github_status_cache', type=str, help='file caching github commit states that can no longer change (default: %s)'%GITHUB_STATUS_CACHE, default=GITHUB_STATUS_CACHE)
 parser.add_argument('--max_hashes', type=int, help='maximum_number of hashes to process', default=1000)
 parser.add_argument('--incremental_hashes', action='store_true', default=False)
 parser.add_argument('--sandmark_repo', type=str, help='sandmark repo location', default=SANDMARK_REPO)
+parser.add_argument('--sandmark_worktrees', action='store_true', help='set up each hash as a git worktree of --sandmark_repo rather than a clone', default=False)
+parser.add_argument('--sandmark_opam_cache_dir', type=str, help='cache of sandmark opam switches (compiler and benchmark dependencies) keyed by compiler url and configure options, shared between runs', default=None)
+parser.add_argument('--sandmark_opam_cache_max_gb', type=float, help='size bound of the opam switch cache in GB, least recently used entries are evicted', default=None)
+parser.add_argument('--sandmark_dune_cache_dir', type=str, help='share a dune cache between hashes, one per (sandmark revision, OCaml version) under this directory', default=None)
 parser.add_argument('--sandmark_comp_fmt', type=str, help='sandmark location format compiler code', default=SANDMARK_COMP_FMT_DEFAULT)
 parser.add_argument('--sandmark_iter', type=int, help='number of sandmark iterations', default=1)
-parser.add_argument('--sandmark_pre_exec', type=str, help='benchmark pre_exec', default='')
+parser.add_argument('--adaptive_target_ci', type=float, help='rerun the run_orun target per benchmark until the 95%% confidence interval of time_secs is narrower than this fraction of the mean (e.g. 0.01); off by default', default=None)
+parser.add_argument('--adaptive_min_iter', type=int, help='iterations every benchmark gets in adaptive mode (default: 3)', default=3)
+parser.add_argument('--adaptive_max_iter', type=int, help='most iterations a benchmark gets in adaptive mode (default: 30)', default=30)
+parser.add_argument('--adaptive_round_iter', type=int, help='iterations per rerun round in adaptive mode (default: 3)', default=3)
+parser.add_argument('--adaptive_time_budget', type=float, help='stop adaptive reruns of a hash after this many seconds (default: no limit)', default=None)
+parser.add_argument('--sandmark_pre_exec', type=str, help='benchmark pre_exec; any {bench_core} in it is replaced by the isolated core given to the hash (e.g. "taskset --cpu-list {bench_core}")', default='')
+parser.add_argument('--bench_cores', type=str, help='pool of isolated cores to bench on, one per in-flight hash (e.g. 2-5,8)', default='')
+parser.add_argument('--build_cores', type=str, help='cores to pin the sandmark make (and so the compiler build) to (e.g. 0,1)', default='')
+parser.add_argument('--parallel_hashes', type=int, help='number of hashes to process concurrently (default: size of --bench_cores)', default=None)
+parser.add_argument('--pipeline_lookahead', type=int, help='overlap the hashes: build up to this many hashes ahead (setup and build stages, on --build_cores) while the bench stage runs, uploading in the background (default: 0, off)', default=0)
+parser.add_argument('--pipeline_builds', type=int, help='number of hashes built concurrently with --pipeline_lookahead (default: 1)', default=1)
+parser.add_argument('--perf_events', type=str, help='comma seperated perf events to count for each benchmark of the run_orun target, recorded in the results as perf.<event> with ".", ":" and "/" in the event as "_" (e.g. cycles,instructions,idq_uops_not_delivered.core); --upload_metrics takes either spelling', default=None)
 parser.add_argument('--sandmark_no_cleanup', action='store_true', default=False)
 parser.add_argument('--sandmark_tag_override', help='set the sandmark version tag manually (e.g. 4.06.1)', default=None)
 parser.add_argument('--sandmark_run_bench_targets', type=str, help='comma seperated list of RUN_BENCH_TARGET arguments to run in sandmark', default=SANDMARK_RUN_BENCH_TARGETS_DEFAULT)
-parser.add_argument('--run_stages', type=str, help='stages to run (setup,bench,archive,upload)', default='setup,bench,upload')
+parser.add_argument('--run_stages', type=str, help='stages to run (setup,build,bench,archive,upload,detect)', default='setup,bench,upload')
 parser.add_argument('--executable_spec', type=str, help='name for executable and variant for build in "name:variant" fmt (e.g. flambda:flambda)', default='vanilla:')
 parser.add_argument('--environment', type=str, help='environment tag for run (default: %s)'%ENVIRONMENT, default=ENVIRONMENT)
 parser.add_argument('--archive_dir', type=str, help='location to make archive (comma seperated list)', default='')
@@ -55,25 +86,48 @@ parser.add_argument('--upload_project_name', type=str, help='specific upload pro
 parser.add_argument('--upload_date_tag', type=str, help='specific date tag to upload', default=None)
 parser.add_argument('--configure_options', type=str, help='configure options to compiler', default='')
 parser.add_argument('--ocamlrunparam', type=str, help='OCAMLRUNPARAM', default='')
+parser.add_argument('--upload_metrics', type=str, help='comma seperated orun fields to upload, as field or field:units:units_title; "all" for every known field (default: %s)'%orun_bench.PRIMARY_METRIC, default=orun_bench.PRIMARY_METRIC)
 parser.add_argument('--codespeed_url', type=str, help='codespeed URL for upload', default=CODESPEED_URL)
+parser.add_argument('--codespeed_db', type=str, help='bulk load results straight into this codespeed sqlite database instead of uploading over http', default=None)
+parser.add_argument('--upload_spool_dir', type=str, help='where unsent uploads are kept to be replayed by the next run (default: <outdir>/upload_spool)', default=None)
+parser.add_argument('--detect_db', type=str, help='database of the series and state for change detection (default: <outdir>/change_detection.db)', default=None)
+parser.add_argument('--detect_report', type=str, help='file the current detected changes are written to as json lines (default: <outdir>/change_points.jsonl)', default=None)
+parser.add_argument('--detect_threshold', type=float, help='CUSUM threshold for a change, in standard deviations (default: 5)', default=5.0)
+parser.add_argument('--detect_min_rel_change', type=float, help='smallest relative shift in the mean reported as a change (default: 0.02)', default=0.02)
+parser.add_argument('--preflight', choices=['off', 'warn', 'strict'], help='check the machine setup before each bench and record it with the results; strict refuses to bench on a degraded machine (default: warn)', default='warn')
+parser.add_argument('--preflight_max_load', type=float, help='highest 1 minute load average the preflight accepts, on top of the load of the run\'s own concurrent benches and builds (default: 1.0)', default=1.0)
+parser.add_argument('--preflight_max_freq_spread', type=float, help='largest relative move of the bench core clock the preflight accepts (default: 0.02)', default=0.02)
+parser.add_argument('--skip_degraded', action='store_true', help='do not upload or change detect results whose preflight found problems', default=False)
+parser.add_argument('--noise_floors', type=str, help='json from stability_example/noise_calibration.py; a benchmark\'s noise floor is the smallest change in its times that change detection reports', default=None)
+parser.add_argument('--profile_trace', type=str, help='JSONL trace of the time, CPU, peak RSS and bytes written of every stage and command (default: <outdir>/profile_<timestamp>.jsonl)', default=None)
 parser.add_argument('-v', '--verbose', action='store_true', default=False)
 
 args = parser.parse_args()
 
 upload_project_name = args.upload_project_name if args.upload_project_name else 'ocaml_%s'%args.branch
 
-def shell_exec(cmd, verbose=args.verbose, check=False, stdout=None, stderr=None):
-    if verbose:
-        print('+ %s'%cmd)
-    return subprocess.run(cmd, shell=True, check=check, stdout=stdout, stderr=stderr)
+try:
+    upload_metrics = orun_bench.parse_metrics(args.upload_metrics)
+except ValueError as e:
+    parser.error(str(e))
+
+bisect_spec = None
+if args.commit_choice_method.startswith('bisect='):
+    try:
+        bisect_spec = git_hashes.parse_bisect_spec(args.commit_choice_method)
+    except ValueError as e:
+        parser.error(str(e))
+    if 'bench' not in args.run_stages.split(','):
+        parser.error('bisect needs the bench stage in --run_stages')
+
+if '{bench_core}' in args.sandmark_pre_exec and not machine_preflight.parse_cpu_list(args.bench_cores):
+    parser.error('--sandmark_pre_exec uses {bench_core} but no --bench_cores are given')
 
+if args.adaptive_target_ci is not None and not (2 <= args.adaptive_min_iter <= args.adaptive_max_iter):
+    parser.error('adaptive mode needs 2 <= --adaptive_min_iter <= --adaptive_max_iter')
 
-def shell_exec_redirect(cmd, fname, verbose=args.verbose, check=False):
-    if verbose:
-        print('+ %s'%cmd)
-        print('+ with stdout/stderr -> %s'% fname)
-    with open(fname, 'w') as f:
-        return shell_exec(cmd, verbose=False, check=check, stdout=f, stderr=subprocess.STDOUT)
+shell_exec = functools.partial(pipeline.shell_exec, verbose=args.verbose)
+shell_exec_redirect = functools.partial(pipeline.shell_exec_redirect, verbose=args.verbose)
 
 def use_bench_result_dirs_to_determine_timestamp(resultdir):
     resultdir_candidates = sorted(glob.glob(os.path.join(resultdir, '[0-9]'*8+'_'+'[0-9]'*6)))
@@ -87,72 +141,332 @@ def use_bench_result_dirs_to_determine_timestamp(resultdir):
 
     return d, os.path.basename(d.rstrip('/'))
 
-def parse_and_format_results_for_upload(fname, artifacts_timestamp):
-    bench_data = []
-    with open(fname) as f:
-        for l in f:
-            raw_data = json.loads(l)
-            bench_data.append({
-                'name': raw_data['name'],
-                'time_secs': raw_data['time_secs'],
-                'user_time_secs': raw_data['user_time_secs'],
-                'gc.minor_collections': raw_data['gc']['minor_collections'],
-                'gc.major_collections': raw_data['gc']['major_collections'],
-                'gc.compactions': raw_data['gc'].get('compactions', 0),
-                })
-    if not bench_data:
+def find_bench_result_dir(h, resultdir):
+    ## the manifest knows where the last bench of this hash put its results
+    result_dir = manifest.artifacts(h, 'bench').get('result_dir')
+    if result_dir and os.path.isdir(result_dir):
+        return result_dir, os.path.basename(result_dir.rstrip('/'))
+    return use_bench_result_dirs_to_determine_timestamp(resultdir)
+
+def import_pre_manifest_results(h):
+    ## results from runs before the manifest existed count as done if a bench result is there
+    resultdir = os.path.join(outdir, h, 'results')
+    if not os.path.isdir(resultdir):
+        return
+    result_dirs = sorted(glob.glob(os.path.join(resultdir, '[0-9]'*8+'_'+'[0-9]'*6)))
+    if result_dirs and glob.glob(os.path.join(result_dirs[-1], '*', '*.orun.bench')):
+        if args.verbose: print('importing results from before the manifest for %s'%h)
+        for stage in run_stages:
+            manifest.mark_done(h, stage, {'result_dir': result_dirs[-1]} if stage == 'bench' else {})
+
+def format_pre_exec(bench_core):
+    if bench_core is None:
+        return args.sandmark_pre_exec
+    return args.sandmark_pre_exec.replace('{bench_core}', str(bench_core))
+
+def select_run_config(run_config, bench_names):
+    # the run_config.json entries which produce any of bench_names
+    #   orun records are named '<config name>.<params>' (or just '<config name>')
+    def wanted(name):
+        return any(b == name or b.startswith(name + '.') for b in bench_names)
+    selected = dict(run_config)
+    selected['benchmarks'] = [b for b in run_config['benchmarks'] if wanted(b['name'])]
+    return selected
+
+def wrap_run_config_with_perf(run_config, target, log_fname):
+    # run the target's wrapper (e.g. orun for run_orun) under perf_stat_wrapper.py
+    wrapper_name = target[len('run_'):] if target.startswith('run_') else target
+    wrapped = dict(run_config)
+    wrapped['wrappers'] = []
+    for w in run_config.get('wrappers', []):
+        if w['name'] == wrapper_name:
+            tokens = w['command'].split()
+            orun_output = tokens[tokens.index('-o') + 1] if '-o' in tokens[:-1] else None
+            w = dict(w)
+            w['command'] = '%s %s --events %s --log %s%s -- %s'%(
+                sys.executable, os.path.join(SCRIPTDIR, 'perf_stat_wrapper.py'), args.perf_events, log_fname,
+                ' --orun_output %s'%orun_output if orun_output else '', w['command'])
+        wrapped['wrappers'].append(w)
+    return wrapped
+
+def write_run_config(sandmark_dir, target, fname, bench_names=None, perf_log_fname=None):
+    # a copy of sandmark's run_config.json limited to bench_names and with the
+    # perf wrapper; returns the make argument to use it or None without a run_config.json
+    run_config_fname = os.path.join(sandmark_dir, 'run_config.json')
+    if not os.path.exists(run_config_fname):
+        return None
+    with open(run_config_fname) as f:
+        run_config = json.load(f)
+    if bench_names is not None:
+        run_config = select_run_config(run_config, bench_names)
+    if args.perf_events:
+        run_config = wrap_run_config_with_perf(run_config, target, perf_log_fname)
+    with open(os.path.join(sandmark_dir, fname), 'w') as f:
+        json.dump(run_config, f, indent=2)
+    return ' RUN_CONFIG_JSON=%s'%fname
+
+def perf_run_config_arg(sandmark_dir, target, perf_log_fname):
+    # make argument for counting --perf_events on the target's runs, logging the counters to perf_log_fname
+    if not args.perf_events or target != 'run_orun':
+        return ''
+    config_arg = write_run_config(sandmark_dir, target, 'run_config_perf.json', perf_log_fname=perf_log_fname)
+    if config_arg is None:
+        print('WARN: no run_config.json in %s so can not count perf events'%sandmark_dir)
+        return ''
+    return config_arg
+
+def run_adaptive_bench(h, sandmark_dir, version_tag, full_branch_tag, make_prefix, make_args, bench_core, target, log_fname, perf_log_fname):
+    # Run the bench target in rounds, rerunning only the benchmarks whose
+    # time_secs confidence interval is still wider than --adaptive_target_ci.
+    # The samples of all rounds end up in the usual .orun.bench file, with
+    # a summary of the stopping decisions in adaptive.json next to it.
+    # Returns (returncode, [logfiles]).
+    results_dir = os.path.join(sandmark_dir, '_results', full_branch_tag)
+    results_fname = os.path.join(results_dir, '%s.orun.bench'%full_branch_tag)
+    samples_fname = os.path.join(sandmark_dir, 'adaptive_samples.orun.bench')
+    if os.path.exists(samples_fname):
+        os.remove(samples_fname)
+
+    start = datetime.datetime.now()
+    stats = {}
+    logs = []
+    returncode = 0
+    n_round = 0
+    stop_reason = None
+    while True:
+        n_round += 1
+        if n_round == 1:
+            ## everything gets the minimum number of iterations
+            n_iter = args.adaptive_min_iter
+            config_arg = perf_run_config_arg(sandmark_dir, target, perf_log_fname)
+            round_log_fname = log_fname
+        else:
+            n_iter = args.adaptive_round_iter
+            config_arg = write_run_config(sandmark_dir, target, 'run_config_adaptive.json', bench_names=pending, perf_log_fname=perf_log_fname)
+            round_log_fname = '%s_round%d.log'%(os.path.splitext(log_fname)[0], n_round)
+        logs.append(round_log_fname)
+
+        if os.path.exists(results_fname):
+            os.remove(results_fname)
+        completed_proc = shell_exec_redirect('cd %s; %smake %s.bench ITER=%i PRE_BENCH_EXEC=%s RUN_BENCH_TARGET=%s%s%s'%(sandmark_dir, make_prefix, version_tag, n_iter, format_pre_exec(bench_core), target, make_args, config_arg), round_log_fname)
+        if completed_proc.returncode != 0:
+            print('ERROR[%d] in sandmark adaptive bench round %d for %s (see %s)'%(completed_proc.returncode, n_round, h, round_log_fname))
+            returncode = completed_proc.returncode
+
+        ## keep this round's samples and fold them into the running statistics
+        n_samples = sum(st.count for st in stats.values())
+        if os.path.exists(results_fname):
+            with open(results_fname) as f_in, open(samples_fname, 'a') as f_out:
+                for l in f_in:
+                    if not l.strip():
+                        continue
+                    f_out.write(l if l.endswith('\n') else l + '\n')
+                    record = json.loads(l)
+                    if record.get('time_secs') is not None:
+                        stats.setdefault(record['name'], orun_bench.RunningStats()).add(record['time_secs'])
+
+        pending = [b for b, st in stats.items()
+                   if st.relative_ci_width() > args.adaptive_target_ci and st.count < args.adaptive_max_iter]
+        elapsed = (datetime.datetime.now() - start).total_seconds()
+        if args.verbose:
+            print('adaptive round %d for %s: %d benchmarks, %d still above target (%.0fs)'%(n_round, h, len(stats), len(pending), elapsed))
+
+        if returncode != 0:
+            stop_reason = 'error'
+        elif sum(st.count for st in stats.values()) == n_samples:
+            print('WARN: adaptive round %d for %s gave no new samples, stopping adaptive rounds'%(n_round, h))
+            stop_reason = 'no_samples'
+        elif not pending:
+            stop_reason = 'converged' if all(st.relative_ci_width() <= args.adaptive_target_ci for st in stats.values()) else 'max_iter'
+        elif args.adaptive_time_budget is not None and elapsed >= args.adaptive_time_budget:
+            stop_reason = 'time_budget'
+        elif not os.path.exists(os.path.join(sandmark_dir, 'run_config.json')):
+            print('WARN: no run_config.json in %s so can not rerun single benchmarks, stopping adaptive rounds'%sandmark_dir)
+            stop_reason = 'no_run_config'
+        if stop_reason:
+            break
+
+    ## the upload and archive stages see the samples of every round
+    shell_exec('mkdir -p %s'%results_dir)
+    if os.path.exists(samples_fname):
+        os.replace(samples_fname, results_fname)
+
+    summary = {
+        'target_ci': args.adaptive_target_ci,
+        'rounds': n_round,
+        'elapsed_secs': elapsed,
+        'stop_reason': stop_reason,
+        'benchmarks': {b: {'count': st.count, 'mean': st.mean, 'relative_ci_width': st.relative_ci_width(),
+                           'converged': st.relative_ci_width() <= args.adaptive_target_ci}
+                       for b, st in sorted(stats.items())},
+    }
+    with open(os.path.join(results_dir, 'adaptive.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    print('Adaptive bench of %s stopped after %d rounds (%s), %d/%d benchmarks within %g'%(
+        h, n_round, stop_reason, sum(b['converged'] for b in summary['benchmarks'].values()), len(stats), args.adaptive_target_ci))
+
+    return returncode, logs
+
+def parse_and_format_results_for_upload(fname, artifacts_timestamp, h, executable_name, full_branch_tag):
+    aggregated_data = orun_bench.aggregate_orun_bench(fname, fields=[m[0] for m in upload_metrics])
+    if not aggregated_data:
         print('WARN: Failed to find any data in %s'%fname)
         return []
 
-    bench_data = pandas.DataFrame(bench_data)
-    aggregated_data = bench_data.groupby('name').apply(lambda x: x.describe().T)
-    aggregated_data.index.set_names(['bench_name', 'bench_metric'], inplace=True)
-
-    upload_data = []
-    for bench_name in aggregated_data.index.levels[0]:
-        # TODO: how to make this configurable
-        metric_name, metric_units, metric_units_title = ('time_secs', 'seconds', 'Time')
-
-        results = aggregated_data.loc[(bench_name, 'time_secs')]
-        upload_data.append({
-            'commitid': h[:7],
-            'commitid_long': h,
-            'project': upload_project_name,
-            'branch': args.branch,
-            'executable': executable_name,
-            'executable_description': full_branch_tag,
-            'environment': args.environment,
-            'benchmark': bench_name,
-            'units': metric_units,
-            'units_title': metric_units_title,
-            'result_value': results['mean'],
-            'min': results['min'],
-            'max': results['max'],
-            'std_dev': results['std'],
-            'metadata': {'artifacts_location': '%s/%s__%s/%s/%s/%s/%s/'%(args.environment, upload_project_name, args.branch, h, executable_name, artifacts_timestamp, bench_name)},
-            })
+    ## the http upload leaves the revision date to codespeed, a direct load needs it given
+    revision_date = find_ocaml_commit_date(args, h) if args.codespeed_db else None
+    preflight = machine_preflight.read_preflight(os.path.dirname(os.path.dirname(fname)))
+
+    base = {
+        'commitid': h[:7],
+        'commitid_long': h,
+        'project': upload_project_name,
+        'branch': args.branch,
+        'executable': executable_name,
+        'executable_description': full_branch_tag,
+        'environment': args.environment,
+        }
+    if revision_date:
+        base['revision_date'] = revision_date
+    ## results are dated with the bench run rather than when they were loaded
+    if pipeline.timestamp_date(artifacts_timestamp):
+        base['result_date'] = pipeline.timestamp_date(artifacts_timestamp)
+    artifacts_location = '%s/%s__%s/%s/%s/%s'%(args.environment, upload_project_name, args.branch, h, executable_name, artifacts_timestamp)
+    upload_data = orun_bench.format_for_upload(aggregated_data, upload_metrics, base, artifacts_location, verbose=args.verbose)
+    if preflight:
+        for r in upload_data:
+            r['metadata']['environment_fingerprint'] = preflight['fingerprint_id']
 
     return upload_data
 
-def find_ocaml_version(args, h):
-    old_cwd = os.getcwd()
+def find_results_for_upload(h, resultsdir, full_branch_tag):
+    # (orun.bench file, artifacts timestamp) to upload for h, or None
+    if args.upload_date_tag:
+        upload_timestamp = args.upload_date_tag
+        upload_dir = os.path.join(resultsdir, upload_timestamp)
+    else:
+        ## figure the upload timestamp
+        upload_result = find_bench_result_dir(h, resultsdir)
+        if upload_result is None:
+            return None
+        upload_dir, upload_timestamp = upload_result
+
+    fname = os.path.join(upload_dir, full_branch_tag, '%s.orun.bench'%full_branch_tag)
+    if not os.path.exists(fname):
+        print('ERROR: could not find %s'%fname)
+        return None
+    return fname, upload_timestamp
+
+def get_sandmark_revision():
+    proc = shell_exec('git -C %s rev-parse HEAD'%args.sandmark_repo, stdout=subprocess.PIPE)
+    return proc.stdout.decode('utf-8').strip()
+
+@contextmanager
+def sandmark_repo_lock():
+    # git worktree add/prune edit the repo's shared worktree list, so serialise
+    # them across threads and concurrent runs
+    proc = shell_exec('git -C %s rev-parse --git-common-dir'%args.sandmark_repo, stdout=subprocess.PIPE)
+    git_dir = os.path.join(os.path.abspath(args.sandmark_repo), proc.stdout.decode('utf-8').strip())
+    with open(os.path.join(git_dir, 'ocaml_bench_scripts_worktree.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+def add_sandmark_worktree(sandmark_dir):
+    with sandmark_repo_lock():
+        ## forget worktrees whose directories were removed (e.g. an incomplete setup)
+        shell_exec('git -C %s worktree prune'%args.sandmark_repo)
+        return shell_exec('git -C %s worktree add --detach %s %s'%(args.sandmark_repo, sandmark_dir, sandmark_revision))
+
+def sandmark_make_env(full_branch_tag):
+    # environment settings for sandmark's make
+    if not args.sandmark_dune_cache_dir:
+        return ''
+    ## the benchmark dependency builds are shared by every hash of the same
+    ## sandmark revision and OCaml version; dune's cache is keyed on content
+    ## so hashes with a different compiler never pick up each other's builds
+    cache_root = os.path.join(os.path.abspath(args.sandmark_dune_cache_dir), '%s_%s'%(sandmark_revision[:12], full_branch_tag))
+    shell_exec('mkdir -p %s'%cache_root)
+    ## NB: DUNE_CACHE_ROOT is for dune >= 3, older dune puts its cache under XDG_CACHE_HOME
+    return 'DUNE_CACHE=enabled DUNE_CACHE_ROOT=%s XDG_CACHE_HOME=%s '%(cache_root, cache_root)
+
+@contextmanager
+def sandmark_opam_switch(sandmark_dir, version_tag, full_branch_tag):
+    # While inside, <sandmark_dir>/_opam links to an opam root in the switch
+    # cache and the yielded make arguments point sandmark's OPAMROOT at it, so
+    # the paths baked into the switch are the cache entry's. On a miss the
+    # switch is built there by the make and published if it was created.
+    if opam_cache is None:
+        yield ''
+        return
+
+    with open(os.path.join(sandmark_dir, '%s.json'%version_tag)) as f:
+        comp = json.load(f)
+    ## NB: runparams are left out as they don't change the build
+    key = opam_cache.key(comp['url'], comp.get('configure', ''), sandmark_revision, full_branch_tag, opam_cache_toolchain)
+    opam_link = os.path.join(sandmark_dir, '_opam')
+
+    ## held for the whole bench so the entry can't be evicted while in use
+    with opam_cache.lock(key):
+        entry = opam_cache.lookup(key)
+        hit = entry is not None
+        if not hit:
+            print('Building opam switch for %s into cache entry %s'%(full_branch_tag, key))
+            entry = opam_cache.prepare(key)
+        opamroot = os.path.join(entry, '_opam')
+        os.makedirs(opamroot, exist_ok=True)
+
+        if os.path.islink(opam_link):
+            os.unlink(opam_link)
+        elif os.path.exists(opam_link):
+            shutil.rmtree(opam_link)
+        os.symlink(opamroot, opam_link)
+        if hit:
+            print('Using cached opam switch for %s from %s'%(full_branch_tag, entry))
+            ## the switch must look newer than the freshly written ocaml-versions/<tag>.json to make
+            os.utime(os.path.join(opamroot, full_branch_tag))
+
+        try:
+            yield ' OPAMROOT=%s'%opamroot
+        finally:
+            ## so make clean can't reach into the cache
+            os.unlink(opam_link)
+
+        if not hit:
+            if os.path.exists(os.path.join(opamroot, full_branch_tag, 'bin', 'ocaml')):
+                opam_cache.publish(key, info={'url': comp['url'], 'configure': comp.get('configure', ''),
+                                              'sandmark_revision': sandmark_revision, 'tag': full_branch_tag})
+            else:
+                print('WARN: not caching the opam switch for %s as it was not built'%full_branch_tag)
+                opam_cache.discard(key)
+
+def ocaml_source_dir(args):
     repo_url = args.sandmark_comp_fmt.split('/')
     user_repo = repo_url[3] + '__' +  repo_url[4] # ocaml__ocaml
-    source_dir = os.path.join(os.path.abspath(SCRIPTDIR), user_repo)
-    os.chdir(source_dir)
-    proc_output = shell_exec('git show %s:VERSION | head -1' % (h), stdout=subprocess.PIPE)
-    os.chdir(old_cwd)
-    return proc_output.stdout.decode('utf-8').split('\n')[0]
+    return os.path.join(os.path.abspath(SCRIPTDIR), user_repo)
+
+def find_ocaml_version(args, h):
+    return git_hashes.get_version_resolver(ocaml_source_dir(args)).version(h)
+
+def find_ocaml_commit_date(args, h):
+    return git_hashes.get_version_resolver(ocaml_source_dir(args)).commit_date(h)
 
-run_timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+run_timestamp = pipeline.timestamp()
 
-run_stages = args.run_stages.split(',')
+try:
+    run_stages = pipeline.parse_stages(args.run_stages, ['setup', 'build', 'bench', 'archive', 'upload', 'detect'])
+except ValueError as e:
+    parser.error(str(e))
 if args.verbose: print('will run stages: %s'%run_stages)
+if args.pipeline_lookahead > 0 and 'build' not in run_stages:
+    print('WARN: --pipeline_lookahead without the build stage leaves the compiler build in the bench stage')
 
 ## setup directory
 outdir = os.path.abspath(args.outdir)
 if args.verbose: print('making directory: %s'%outdir)
 shell_exec('mkdir -p %s'%outdir)
+profile_trace = os.path.abspath(args.profile_trace) if args.profile_trace else os.path.join(outdir, 'profile_%s.jsonl'%run_timestamp)
+pipeline.profiler.open_trace(profile_trace)
+upload_spool_dir = os.path.abspath(args.upload_spool_dir) if args.upload_spool_dir else os.path.join(outdir, 'upload_spool')
 
 archive_dirs = [] if args.archive_dir == '' else args.archive_dir.split(',')
 archive_dirs = [os.path.abspath(f) for f in archive_dirs]
@@ -162,32 +476,29 @@ def check_archive_dir(d):
         return False
     return True
 archive_dirs = [f for f in archive_dirs if check_archive_dir(f)]
+if 'archive' in run_stages and len(archive_dirs) == 0:
+    print('WARN: no archive_dirs to run on (is the --archive_dir argument set?)')
+if 'upload' in run_stages and not 'run_orun' in args.sandmark_run_bench_targets.split(','):
+    print('WARN: not running upload as run_orun not found in sandmark_run_bench_targets')
 
 ## generate list of hash commits
-hashes = git_hashes.get_git_hashes(args)
-
-if args.incremental_hashes:
-    def check_hash_new(h):
-        hash_dir = os.path.join(outdir, h)
-        hash_already_run = os.path.exists(hash_dir)
-        if args.verbose and hash_already_run:
-            print('Found results at %s skipping rerun'%hash_dir)
-        return not hash_already_run
+with pipeline.profiler.span(None, 'select_hashes'):
+    hashes = git_hashes.get_git_hashes(args)
+    sandmark_revision = get_sandmark_revision()
 
-    hashes = [h for h in hashes if check_hash_new(h)]
+opam_cache = None
+if args.sandmark_opam_cache_dir:
+    max_bytes = None if args.sandmark_opam_cache_max_gb is None else int(args.sandmark_opam_cache_max_gb * 1024**3)
+    opam_cache = build_cache.BuildCache(args.sandmark_opam_cache_dir, max_bytes=max_bytes, verbose=args.verbose)
+    opam_cache_toolchain = build_cache.toolchain_fingerprint()
 
-hashes = hashes[-args.max_hashes:]
-
-if args.verbose:
-    print('Found %d hashes using %s to do %s on'%(len(hashes), args.commit_choice_method, args.run_stages))
+manifest = run_manifest.RunManifest(outdir, verbose=args.verbose)
 
 verbose_args = ' -v' if args.verbose else ''
 os.chdir(outdir)
-for h in hashes:
-    hashdir = os.path.join(outdir, h)
-    if args.verbose: print('processing to %s'%hashdir)
-    shell_exec('mkdir -p %s'%hashdir)
 
+def hash_tags(h):
+    # (executable name, sandmark version tag) for h
     executable_name, executable_variant = args.executable_spec.split(':')
 
     if args.sandmark_tag_override:
@@ -196,104 +507,370 @@ for h in hashes:
         full_branch_tag = find_ocaml_version(args, h)
     if executable_variant:
         full_branch_tag += '+' + executable_variant
-    version_tag = os.path.join('ocaml-versions', full_branch_tag)
-    sandmark_dir = os.path.join(hashdir, 'sandmark')
-    sandmark_results_dir = os.path.join(sandmark_dir, '_results')
-    resultsdir = os.path.join(hashdir, 'results')
+    return executable_name, full_branch_tag
 
-    if 'setup' in args.run_stages:
-        if os.path.exists(sandmark_dir):
-            print('Skipping sandmark setup for %s as directory there'%h)
-        else:
-            ## setup sandmark (make a clone and change the hash)
-            shell_exec('git clone --reference %s %s %s'%(args.sandmark_repo, args.sandmark_repo, sandmark_dir))
-            comp_file = os.path.join(sandmark_dir, '%s.json'%version_tag)
-            json_contents = {
-                'url': args.sandmark_comp_fmt.format(**{'tag': h}),
-                'configure': args.configure_options,
-                'runparams' : args.ocamlrunparam }
-            if args.verbose:
-                print('writing hash information to: %s'%comp_file)
-            with open(comp_file, 'w') as f:
-                json.dump(json_contents, f)
+def hash_context(h, bench_core):
+    hashdir = os.path.join(outdir, h)
+    if args.verbose: print('processing to %s (bench_core=%s)'%(hashdir, bench_core))
+    shell_exec('mkdir -p %s'%hashdir)
 
-    if 'bench' in args.run_stages:
-        ## run bench
-        src_dir = os.path.join(sandmark_results_dir, full_branch_tag)
-        dest_dir = os.path.join(resultsdir, run_timestamp)
-        shell_exec('mkdir -p %s'%dest_dir)
+    executable_name, full_branch_tag = hash_tags(h)
+    version_tag = os.path.join('ocaml-versions', full_branch_tag)
+    sandmark_dir = os.path.join(hashdir, 'sandmark')
+    return pipeline.HashContext(h, bench_core,
+        hashdir=hashdir,
+        executable_name=executable_name,
+        full_branch_tag=full_branch_tag,
+        version_tag=version_tag,
+        sandmark_dir=sandmark_dir,
+        sandmark_results_dir=os.path.join(sandmark_dir, '_results'),
+        resultsdir=os.path.join(hashdir, 'results'))
+
+def skip_setup(ctx):
+    if os.path.exists(ctx.sandmark_dir) and not manifest.has_hash(ctx.h):
+        ## from a run before the manifest existed
+        manifest.mark_done(ctx.h, 'setup', {'sandmark_dir': ctx.sandmark_dir})
+    if manifest.is_done(ctx.h, 'setup') and os.path.exists(ctx.sandmark_dir):
+        print('Skipping sandmark setup for %s as directory there'%ctx.h)
+        return True
+    return False
+
+def setup_stage(ctx, stage):
+    h, sandmark_dir = ctx.h, ctx.sandmark_dir
+    if os.path.exists(sandmark_dir):
+        print('Removing sandmark directory for %s left by an incomplete setup'%h)
+        shell_exec('rm -rf %s'%sandmark_dir)
+
+    ## setup sandmark (make a clone and change the hash)
+    if args.sandmark_worktrees:
+        stage.exit_code = add_sandmark_worktree(sandmark_dir).returncode
+    else:
+        stage.exit_code = shell_exec('git clone --reference %s %s %s'%(args.sandmark_repo, args.sandmark_repo, sandmark_dir)).returncode
+    comp_file = os.path.join(sandmark_dir, '%s.json'%ctx.version_tag)
+    json_contents = {
+        'url': args.sandmark_comp_fmt.format(**{'tag': h}),
+        'configure': args.configure_options,
+        'runparams' : args.ocamlrunparam }
+    if args.verbose:
+        print('writing hash information to: %s'%comp_file)
+    with open(comp_file, 'w') as f:
+        json.dump(json_contents, f)
+    stage.artifacts = {'sandmark_dir': sandmark_dir, 'comp_file': comp_file}
+
+def sandmark_supports_build_only(sandmark_dir):
+    # BUILD_ONLY=1 stops 'make <tag>.bench' after the build; older sandmarks ignore it and run the benchmarks
+    try:
+        with open(os.path.join(sandmark_dir, 'Makefile')) as f:
+            return 'BUILD_ONLY' in f.read()
+    except OSError:
+        return False
 
-        targets = args.sandmark_run_bench_targets.split(',')
+def build_stage(ctx, stage):
+    ## build the compiler switch and benchmarks only, so the bench stage just runs them
+    if not sandmark_supports_build_only(ctx.sandmark_dir):
+        print('WARN: the sandmark Makefile in %s has no BUILD_ONLY, leaving the build to the bench stage'%ctx.sandmark_dir)
+        stage.artifacts = {'skipped': 'no BUILD_ONLY in sandmark'}
+        return
+    log_fname = os.path.join(ctx.hashdir, '%s_build.log'%run_timestamp)
+    make_prefix = sandmark_make_env(ctx.full_branch_tag) + ('taskset --cpu-list %s '%args.build_cores if args.build_cores else '')
+    with sandmark_opam_switch(ctx.sandmark_dir, ctx.version_tag, ctx.full_branch_tag) as make_args:
+        completed_proc = shell_exec_redirect('cd %s; %smake %s.bench BUILD_ONLY=1%s'%(ctx.sandmark_dir, make_prefix, ctx.version_tag, make_args), log_fname)
+    stage.artifacts = {'log': log_fname}
+    if completed_proc.returncode != 0:
+        print('ERROR[%d] in sandmark build for %s (see %s)'%(completed_proc.returncode, ctx.h, log_fname))
+        stage.exit_code = completed_proc.returncode
+
+def bench_stage(ctx, stage):
+    h, bench_core, sandmark_dir = ctx.h, ctx.resource, ctx.sandmark_dir
+    version_tag, full_branch_tag = ctx.version_tag, ctx.full_branch_tag
+
+    ## run bench
+    src_dir = os.path.join(ctx.sandmark_results_dir, full_branch_tag)
+    dest_dir = os.path.join(ctx.resultsdir, run_timestamp)
+    shell_exec('mkdir -p %s'%dest_dir)
+    stage.artifacts = {'result_dir': dest_dir}
+
+    if args.preflight != 'off':
+        preflight = machine_preflight.run_preflight(bench_core, format_pre_exec(bench_core), max_load=preflight_max_load, max_freq_spread=args.preflight_max_freq_spread)
+        machine_preflight.write_preflight(dest_dir, preflight)
+        for problem in preflight['problems']:
+            print('WARN: preflight for %s: %s'%(h, problem))
+        if preflight['degraded'] and args.preflight == 'strict':
+            print('ERROR: not benching %s as the preflight found problems (see %s)'%(h, os.path.join(dest_dir, machine_preflight.PREFLIGHT_FNAME)))
+            stage.exit_code = 1
+            return
+
+    ## the make builds the compiler and benchmarks on the build cores, only the
+    ## PRE_BENCH_EXEC moves the benchmark runs themselves onto the bench core
+    make_prefix = sandmark_make_env(full_branch_tag) + ('taskset --cpu-list %s '%args.build_cores if args.build_cores else '')
+    targets = args.sandmark_run_bench_targets.split(',')
+    failed_targets = {}
+    with sandmark_opam_switch(sandmark_dir, version_tag, full_branch_tag) as make_args:
         for target in targets:
             if args.verbose:
                 print('Running bench target %s'%target)
 
-            log_fname = os.path.join(hashdir, '%s_%s.log'%(run_timestamp, target))
-            completed_proc = shell_exec_redirect('cd %s; make %s.bench ITER=%i PRE_BENCH_EXEC=%s RUN_BENCH_TARGET=%s'%(sandmark_dir, version_tag, args.sandmark_iter, args.sandmark_pre_exec, target), log_fname)
-            if completed_proc.returncode != 0:
-                print('ERROR[%d] in sandmark bench run for %s (see %s)'%(completed_proc.returncode, h, log_fname))
-                ## TODO: the error isn't fatal, just that something failed in there...
-                #continue
-
-            ## put the logfile into the right result directory
-            shell_exec('cp %s %s/'%(log_fname, dest_dir))
+            log_fname = os.path.join(ctx.hashdir, '%s_%s.log'%(run_timestamp, target))
+            perf_log_fname = os.path.splitext(log_fname)[0] + '_perf.jsonl'
+            if args.adaptive_target_ci is not None and target == 'run_orun':
+                returncode, log_fnames = run_adaptive_bench(h, sandmark_dir, version_tag, full_branch_tag, make_prefix, make_args, bench_core, target, log_fname, perf_log_fname)
+            else:
+                config_arg = perf_run_config_arg(sandmark_dir, target, perf_log_fname)
+                completed_proc = shell_exec_redirect('cd %s; %smake %s.bench ITER=%i PRE_BENCH_EXEC=%s RUN_BENCH_TARGET=%s%s%s'%(sandmark_dir, make_prefix, version_tag, args.sandmark_iter, format_pre_exec(bench_core), target, make_args, config_arg), log_fname)
+                returncode, log_fnames = completed_proc.returncode, [log_fname]
+            if os.path.exists(perf_log_fname):
+                log_fnames.append(perf_log_fname)
+            if returncode != 0:
+                print('ERROR[%d] in sandmark bench run for %s (see %s)'%(returncode, h, log_fname))
+                ## the error isn't fatal, just that something failed in there; see below
+                failed_targets[target] = returncode
+
+            ## put the logfiles into the right result directory
+            for f in log_fnames:
+                shell_exec('cp %s %s/'%(f, dest_dir))
+
+    ## copy all result artifacts
+    shell_exec('cp -r %s/ %s/'%(src_dir, dest_dir))
+
+    ## a benchmark failing in a target still leaves the others' results to archive and upload,
+    ## so the bench only fails if the targets produced no results at all
+    if failed_targets:
+        if glob.glob(os.path.join(dest_dir, full_branch_tag, '*.bench')):
+            print('WARN: %s benched with failures in %s, keeping the partial results'%(h, ','.join(sorted(failed_targets))))
+            stage.artifacts['failed_targets'] = failed_targets
+        else:
+            stage.exit_code = list(failed_targets.values())[0]
+
+    ## cleanup sandmark directory
+    if not args.sandmark_no_cleanup:
+        shell_exec('cd %s; make clean'%sandmark_dir)
+
+def archive_stage(ctx, stage):
+    h = ctx.h
+    ## figure the archive timestamp
+    archive_result = find_bench_result_dir(h, ctx.resultsdir)
+    if archive_result is None:
+        stage.exit_code = 1
+        return
+    archive_logdir, archive_timestamp = archive_result
+
+    archive_paths = []
+    for archive_dir in archive_dirs:
+        archive_path = os.path.join(
+            archive_dir,
+            args.environment, ## environment (often hostname)
+            upload_project_name + '__' + args.branch, ## project name and branch (identifies github repo)
+            h, ## commit hash
+            ctx.executable_name, ## name of the executable variant (e.g. vanilla, flambda)
+            archive_timestamp ## timestamp fo the run
+            )
+
+        if args.verbose:
+            print('writing archive to: %s'%archive_path)
+
+        ## archive the data
+        shell_exec('mkdir -p %s'%archive_path)
+        shell_exec('cp -r %s/*.log %s'%(archive_logdir, archive_path))
+        shell_exec('cp -r %s/* %s'%(os.path.join(archive_logdir, ctx.full_branch_tag), archive_path))
+        if os.path.exists(os.path.join(archive_logdir, machine_preflight.PREFLIGHT_FNAME)):
+            shell_exec('cp %s %s'%(os.path.join(archive_logdir, machine_preflight.PREFLIGHT_FNAME), archive_path))
+        archive_paths.append(archive_path)
+    stage.artifacts = {'archive_paths': archive_paths}
+
+def upload_stage(ctx, stage):
+    h = ctx.h
+    ## upload
+    upload_result = find_results_for_upload(h, ctx.resultsdir, ctx.full_branch_tag)
+    if upload_result is None:
+        print('ERROR: could not upload %s as no results found'%h)
+        stage.exit_code = 1
+        return
+    fname, upload_timestamp = upload_result
+
+    if args.skip_degraded and machine_preflight.is_degraded(os.path.dirname(os.path.dirname(fname))):
+        print('WARN: not uploading %s as its preflight found problems'%fname)
+        stage.artifacts = {'skipped_degraded': fname}
+        return
+
+    print('Uploading data from %s'%fname)
+    stage.artifacts = {'uploaded': fname}
+
+    upload_data = parse_and_format_results_for_upload(fname, upload_timestamp, h, ctx.executable_name, ctx.full_branch_tag)
+
+    ## upload this stuff into the codespeed server
+    ##  NB: anything the http upload can't send now stays in the spool for the next run
+    if upload_data and args.codespeed_db:
+        codespeed_db.load_data_to_db(args.codespeed_db, upload_data, verbose=args.verbose)
+    elif upload_data:
+        if not codespeed_upload.post_data_to_server(args.codespeed_url, upload_data, verbose=args.verbose, spool_dir=upload_spool_dir):
+            print('WARN: not all results for %s reached %s'%(h, args.codespeed_url))
+
+detector = None
+detected_changes = []
+
+def detect_enabled(ctx):
+    if not manifest.is_done(ctx.h, 'bench'):
+        print('WARN: skipping change detection for %s as it has no finished bench'%ctx.h)
+        return False
+    return True
 
-        ## copy all result artifacts
-        shell_exec('cp -r %s/ %s/'%(src_dir, dest_dir))
+def detect_stage(ctx, stage):
+    # feed the results of h into the change detection series
+    h = ctx.h
+    upload_result = find_results_for_upload(h, ctx.resultsdir, ctx.full_branch_tag)
+    if upload_result is None:
+        print('ERROR: could not run change detection on %s as no results found'%h)
+        stage.exit_code = 1
+        return
+    fname, upload_timestamp = upload_result
+
+    if args.skip_degraded and machine_preflight.is_degraded(os.path.dirname(os.path.dirname(fname))):
+        print('WARN: leaving %s out of change detection as its preflight found problems'%fname)
+        stage.artifacts = {'skipped_degraded': fname}
+        return
+
+    ## series are kept in commit date order; without the date fall back to arrival order
+    order_key = find_ocaml_commit_date(args, h) or run_manifest.now_str()
+    results = parse_and_format_results_for_upload(fname, upload_timestamp, h, ctx.executable_name, ctx.full_branch_tag)
+    changes = detector.add(results, order_key)
+    detected_changes.extend(changes)
+    stage.artifacts = {'detected': fname, 'changes': [c['commitid'] for c in changes]}
+
+pipeline_stages = [
+    pipeline.Stage('setup', setup_stage, skip=skip_setup, lane='build'),
+    pipeline.Stage('build', build_stage, depends=['setup'], lane='build'),
+    pipeline.Stage('bench', bench_stage, depends=['setup', 'build']),
+    pipeline.Stage('archive', archive_stage, depends=['bench'], enabled=lambda ctx: len(archive_dirs) > 0, lane='post'),
+    pipeline.Stage('upload', upload_stage, depends=['bench'], enabled=lambda ctx: 'run_orun' in args.sandmark_run_bench_targets.split(','), lane='post'),
+    ## change detection runs after all hashes are done so series see the commits in order
+    pipeline.Stage('detect', detect_stage, enabled=detect_enabled, ordered=True),
+]
+hash_pipeline = pipeline.Pipeline(pipeline_stages, run_stages, manifest, run_timestamp, hash_context,
+                                  incremental=args.incremental_hashes, verbose=args.verbose)
+
+if args.incremental_hashes and bisect_spec is None:
+    hashes = hash_pipeline.pending(hashes, import_pre_manifest_results)
+
+if bisect_spec is None:
+    hashes = hashes[-args.max_hashes:]
 
-        ## cleanup sandmark directory
-        if not args.sandmark_no_cleanup:
-            shell_exec('cd %s; make clean'%sandmark_dir)
+if args.verbose:
+    print('Found %d hashes using %s to do %s on'%(len(hashes), args.commit_choice_method, args.run_stages))
 
-    if 'archive' in args.run_stages:
-        if len(archive_dirs) == 0:
-            print('WARN: no archive_dirs to run on (is the --archive_dir argument set?)')
-        else:
-            for archive_dir in archive_dirs:
-                ## figure the archive timestamp
-                archive_logdir, archive_timestamp = use_bench_result_dirs_to_determine_timestamp(resultsdir)
-
-                archive_path = os.path.join(
-                    archive_dir,
-                    args.environment, ## environment (often hostname)
-                    upload_project_name + '__' + args.branch, ## project name and branch (identifies github repo)
-                    h, ## commit hash
-                    executable_name, ## name of the executable variant (e.g. vanilla, flambda)
-                    archive_timestamp ## timestamp fo the run
-                    )
-
-                if args.verbose:
-                    print('writing archive to: %s'%archive_path)
-
-                ## archive the data
-                shell_exec('mkdir -p %s'%archive_path)
-                shell_exec('cp -r %s/*.log %s'%(archive_logdir, archive_path))
-                shell_exec('cp -r %s/* %s'%(os.path.join(archive_logdir, full_branch_tag), archive_path))
-
-    if 'upload' in args.run_stages:
-        if not 'run_orun' in args.sandmark_run_bench_targets.split(','):
-            print('WARN: not running upload as run_orun not found in sandmark_run_bench_targets')
-            continue
+## each in-flight hash takes an isolated core from the pool and gives it back when done
+bench_cores = machine_preflight.parse_cpu_list(args.bench_cores)
+n_parallel = args.parallel_hashes if args.parallel_hashes else max(len(bench_cores), 1)
 
-        ## upload
-        resultdir = os.path.join(hashdir, 'results')
-        if args.upload_date_tag:
-            upload_timestamp = args.upload_date_tag
-            upload_dir = os.path.join(resultsdir, upload_timestamp)
-        else:
-            ## figure the upload timestamp
-            upload_dir, upload_timestamp = use_bench_result_dirs_to_determine_timestamp(resultsdir)
-
-        fname = os.path.join(upload_dir, full_branch_tag, '%s.orun.bench'%full_branch_tag)
-        if not os.path.exists(fname):
-            print('ERROR: could not upload as could not find %s'%fname)
-            continue
+if args.verbose:
+    print('processing hashes %d at a time on bench cores %s'%(n_parallel, bench_cores))
+
+## the load average counts this run's own work: the other hashes' benches and,
+## when hashes overlap, their builds on the build cores (or any core not benching)
+preflight_own_load = n_parallel - 1
+if n_parallel > 1 or args.pipeline_lookahead > 0:
+    preflight_own_load += len(machine_preflight.parse_cpu_list(args.build_cores)) or max(os.cpu_count() - len(bench_cores), 1)
+preflight_max_load = args.preflight_max_load + preflight_own_load
+if args.verbose and args.preflight != 'off':
+    print('preflight accepts a load average up to %.1f (%.1f plus %d for this run\'s own benches and builds)'%(preflight_max_load, args.preflight_max_load, preflight_own_load))
+
+def bisect_measure(h, benchmark):
+    # mean of the bisect benchmark for h, benching h unless the outdir already has it
+    if not (manifest.is_done(h, 'bench') and find_bench_result_dir(h, os.path.join(outdir, h, 'results'))):
+        hash_pipeline.run([h], resources=bench_cores[:1], ordered=False)
+    if not manifest.is_done(h, 'bench'):
+        return None
+    executable_name, full_branch_tag = hash_tags(h)
+    upload_result = find_results_for_upload(h, os.path.join(outdir, h, 'results'), full_branch_tag)
+    if upload_result is None:
+        return None
 
-        print('Uploading data from %s'%fname)
+    ## 'name/field' picks a metric other than the primary one, as in the uploaded names
+    bench_name, field = benchmark, orun_bench.PRIMARY_METRIC
+    if '/' in benchmark and orun_bench.is_metric_field(benchmark.rsplit('/', 1)[1]):
+        bench_name, field = benchmark.rsplit('/', 1)
+        field = orun_bench.metric_field(field)
+    stats = orun_bench.aggregate_orun_bench(upload_result[0], fields=[field]).get(bench_name)
+    if stats is None or stats[field].count == 0:
+        print('ERROR: no %s results for %s in %s'%(benchmark, h, upload_result[0]))
+        return None
+    if args.verbose: print('bisect: %s %s = %g'%(h, benchmark, stats[field].mean))
+    return stats[field].mean
+
+def run_bisect(candidates):
+    # Find the first commit in candidates (good commit first, bad commit
+    # last) whose benchmark value is closer to the bad commit's than the
+    # good commit's. Commits that fail to bench are skipped, like 'git bisect skip'.
+    good, bad, benchmark, threshold = bisect_spec
+    candidates = list(candidates)
+    if len(candidates) < 2:
+        print('ERROR: bisect needs %s to be a first parent ancestor of %s'%(good, bad))
+        return None
 
-        upload_data = parse_and_format_results_for_upload(fname, upload_timestamp)
+    values = {}
+    def measure(h):
+        if h not in values:
+            values[h] = bisect_measure(h, benchmark)
+        return values[h]
 
-        ## upload this stuff into the codespeed server
-        if upload_data:
-            codespeed_upload.post_data_to_server(args.codespeed_url, upload_data, verbose=args.verbose)
+    good_value, bad_value = measure(candidates[0]), measure(candidates[-1])
+    if good_value is None or bad_value is None:
+        print('ERROR: could not bench the bisect end points %s and %s'%(good, bad))
+        return None
+    rel_change = (bad_value - good_value) / good_value
+    if abs(rel_change) < threshold:
+        print('WARN: %s only changes by %.1f%% between %s and %s (threshold %.1f%%), nothing to bisect'%(benchmark, 100*rel_change, good, bad, 100*threshold))
+        return None
 
+    lo, hi = 0, len(candidates) - 1
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        print('Bisecting %s: %d commits left, trying %s'%(benchmark, hi - lo - 1, candidates[mid]))
+        v = measure(candidates[mid])
+        if v is None:
+            print('WARN: skipping %s in bisect as it could not be benched'%candidates[mid])
+            del candidates[mid]
+            hi -= 1
+            continue
+        if abs(v - bad_value) < abs(v - good_value):
+            hi = mid
+        else:
+            lo = mid
+
+    first_bad = candidates[hi]
+    print('Bisect: %s changed by %.1f%% at %s (last good %s)'%(benchmark, 100*rel_change, first_bad, candidates[lo]))
+    report = {
+        'benchmark': benchmark,
+        'good': candidates[0],
+        'bad': candidates[-1],
+        'first_bad': first_bad,
+        'last_good': candidates[lo],
+        'rel_change': rel_change,
+        'benched': {h: values[h] for h in candidates if h in values},
+    }
+    with open(os.path.join(outdir, 'bisect_%s.json'%run_timestamp), 'w') as f:
+        json.dump(report, f, indent=2)
+    return first_bad
+
+if 'detect' in run_stages:
+    detect_db = os.path.abspath(args.detect_db) if args.detect_db else os.path.join(outdir, 'change_detection.db')
+    detect_report = os.path.abspath(args.detect_report) if args.detect_report else os.path.join(outdir, 'change_points.jsonl')
+    noise_floors, default_noise_floor = change_detection.load_noise_floors(args.noise_floors) if args.noise_floors else ({}, 0.)
+    detector = change_detection.ChangeDetector(detect_db, threshold=args.detect_threshold, min_rel_change=args.detect_min_rel_change,
+                                               noise_floors=noise_floors, default_noise_floor=default_noise_floor, verbose=args.verbose)
+
+if bisect_spec:
+    run_bisect(hashes)
+    hash_pipeline.run_ordered(hashes)
+elif args.pipeline_lookahead > 0:
+    hash_pipeline.run_pipelined(hashes, lookahead=args.pipeline_lookahead, n_builds=args.pipeline_builds, resources=bench_cores, n_parallel=n_parallel)
+else:
+    hash_pipeline.run(hashes, n_parallel, bench_cores)
+
+if detector is not None:
+    detector.write_report(detect_report)
+    detector.close()
+    print('Change detection found %d new changes (report: %s)'%(len(detected_changes), detect_report))
+
+pipeline.profiler.print_summary()
+pipeline.profiler.finish()
+print('Profile trace written to %s'%profile_trace)
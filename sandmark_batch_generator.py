@@ -45,7 +45,8 @@ SCRIPTDIR={scriptdir}
 SCRATCHDIR={scratchdir}
 
 BENCH_TARGETS={bench_targets}
-BENCH_CORE={bench_core}
+BENCH_CORES={bench_cores}
+BUILD_CORES={build_cores}
 ENVIRONMENT={environment}
 EXEC_SPEC={exec_spec}
 CODESPEED_URL={codespeed_url}
@@ -77,6 +78,13 @@ eval $(opam config env | grep ^PATH=)
 
 mkdir -p ${ARCHIVE_DIR}
 
+## only pin the benchmarks to a core when there is a pool to take it from
+if [ -n "${BENCH_CORES}" ]; then
+	PRE_EXEC="taskset --cpu-list {bench_core} setarch `uname -m` --addr-no-randomize"
+else
+	PRE_EXEC="setarch `uname -m` --addr-no-randomize"
+fi
+
 ## STAGES:
 ##  - get local copy of git repo
 ##  - setup target codespeed db to see project
@@ -95,7 +103,7 @@ fi
 sqlite3 ${CODESPEED_DB} "INSERT INTO codespeed_project (name,repo_type,repo_path,repo_user,repo_pass,commit_browsing_url,track,default_branch) SELECT '${CODESPEED_NAME}', 'G', 'https://github.com/${GITHUB_USER}/${GITHUB_REPO}', '${GITHUB_USER}', '', 'https://github.com/${GITHUB_USER}/${GITHUB_REPO}/commit/{commitid}',1,'${BRANCH}' WHERE NOT EXISTS(SELECT 1 FROM codespeed_project WHERE name = '${CODESPEED_NAME}')"
 
 ## run backfill script
-./run_sandmark_backfill.py --run_stages ${RUN_STAGES} --branch ${BRANCH} --main_branch ${BRANCH} --repo ${REPO} --repo_pull --repo_reset_hard --use_repo_reference --max_hashes ${MAX_HASHES} --incremental_hashes --commit_choice_method from_hash=${FIRST_COMMIT} --executable_spec=${EXEC_SPEC} --environment ${ENVIRONMENT} --sandmark_comp_fmt https://github.com/${GITHUB_USER}/${GITHUB_REPO}/archive/{tag}.tar.gz --sandmark_tag_override ${OCAML_VERSION} --sandmark_iter 1 --sandmark_pre_exec="'taskset --cpu-list "${BENCH_CORE}" setarch `uname -m` --addr-no-randomize'" --sandmark_run_bench_targets ${BENCH_TARGETS} --archive_dir ${ARCHIVE_DIR} --codespeed_url ${CODESPEED_URL} --configure_options="${CONFIGURE_OPTIONS}" --ocamlrunparam="${OCAMLRUNPARAM}" --upload_project_name ${CODESPEED_NAME} -v ${RUNDIR}
+./run_sandmark_backfill.py --run_stages ${RUN_STAGES} --branch ${BRANCH} --main_branch ${BRANCH} --repo ${REPO} --repo_pull --repo_reset_hard --use_repo_reference --max_hashes ${MAX_HASHES} --incremental_hashes --commit_choice_method from_hash=${FIRST_COMMIT} --executable_spec=${EXEC_SPEC} --environment ${ENVIRONMENT} --sandmark_comp_fmt https://github.com/${GITHUB_USER}/${GITHUB_REPO}/archive/{tag}.tar.gz --sandmark_tag_override ${OCAML_VERSION} --sandmark_iter 1 --bench_cores "${BENCH_CORES}" --build_cores "${BUILD_CORES}" --sandmark_pre_exec="'${PRE_EXEC}'" --sandmark_run_bench_targets ${BENCH_TARGETS} --archive_dir ${ARCHIVE_DIR} --codespeed_url ${CODESPEED_URL} --configure_options="${CONFIGURE_OPTIONS}" --ocamlrunparam="${OCAMLRUNPARAM}" --upload_project_name ${CODESPEED_NAME} -v ${RUNDIR}
 
 '''
 
@@ -126,7 +134,11 @@ for run_conf in conf['tracked_branches']:
 	fname = os.path.join(outdir, '%s.sh'%run_conf['codespeed_name'])
 	with open(fname, 'w') as outfile:
 		outfile.write(SCRIPT_PREAMBLE)
-		conf_str = SCRIPT_PARAMS.format_map(SafeDict(**{**global_conf, **conf, **run_conf}))
+		run_params = {**global_conf, **conf, **run_conf}
+		# older configs give a single bench_core rather than a pool of bench_cores
+		if 'bench_cores' not in run_params and 'bench_core' in run_params:
+			run_params['bench_cores'] = run_params['bench_core']
+		conf_str = SCRIPT_PARAMS.format_map(SafeDict(**run_params))
 		outfile.write(conf_str)
 		outfile.write(SCRIPT_BODY)
 	shell_exec('chmod +x %s'%fname)
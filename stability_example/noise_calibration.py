@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# Measure the run-to-run and code layout noise of a set of benchmarks.
+#
+# Each benchmark source is compiled into layout perturbed variants, with the
+# same tricks as stability_example.sh: padding dummy globals and statements
+# in at the '(**** global dummy ****)' and '(**** function pad ****)'
+# markers, and copies of the source under other file names. Every variant is
+# run --iter times under --pre_exec (use the same taskset/setarch as the
+# benchmark runs). The spread of the variant means is the noise floor: a
+# shift smaller than it could come from layout alone. The resulting json can
+# be given to run_sandmark_backfill.py --noise_floors.
+
+import argparse
+import datetime
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+
+SCRIPTDIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BENCHMARKS = 'fold_left_while_test=%s'%os.path.join(SCRIPTDIR, 'fold_left_while_test.ml')
+GLOBAL_DUMMY_MARKER = '(**** global dummy ****)'
+FUNCTION_PAD_MARKER = '(**** function pad ****)'
+
+parser = argparse.ArgumentParser(description='Measure per benchmark noise floors from code layout perturbed variants')
+parser.add_argument('--benchmarks', type=str, help='comma seperated list of name=source.ml, name being the benchmark name the floor is for (default: %s)'%DEFAULT_BENCHMARKS, default=DEFAULT_BENCHMARKS)
+parser.add_argument('--ocamlopt', type=str, help='ocamlopt to build the variants with', default='ocamlopt')
+parser.add_argument('--ocamlopt_flags', type=str, help='extra flags for ocamlopt', default='')
+parser.add_argument('--n_pad', type=int, help='number of padded variants (default: 7)', default=7)
+parser.add_argument('--rename_prefixes', type=str, help='comma seperated file name prefixes for renamed variants (default: aaa,zzz)', default='aaa,zzz')
+parser.add_argument('--iter', type=int, help='runs of each variant (default: 5)', default=5)
+parser.add_argument('--pre_exec', type=str, help='prefix for each run (e.g. "taskset --cpu-list 5 setarch `uname -m` --addr-no-randomize")', default='')
+parser.add_argument('--builddir', type=str, help='where to build the variants (default: build)', default='build')
+parser.add_argument('--output', type=str, help='noise floor json to write (default: noise_floors.json)', default='noise_floors.json')
+parser.add_argument('-v', '--verbose', action='store_true', default=False)
+
+args = parser.parse_args()
+
+def shell_exec(cmd, verbose=args.verbose, check=False, stdout=None, stderr=None):
+    if verbose:
+        print('+ %s'%cmd)
+    return subprocess.run(cmd, shell=True, check=check, stdout=stdout, stderr=stderr)
+
+def pad_source(src, n):
+    # add n dummy refs at the global dummy marker, each set at the function pad marker
+    if GLOBAL_DUMMY_MARKER not in src:
+        ## no markers, so only the data layout moves
+        return ''.join('let _pad_r%d = ref false\n'%i for i in range(1, n+1)) + src
+    globals_pad = ''.join('\nlet r%d = ref false'%i for i in range(1, n+1))
+    function_pad = ''.join('\n  r%d := false;'%i for i in range(1, n+1))
+    src = src.replace(GLOBAL_DUMMY_MARKER, GLOBAL_DUMMY_MARKER + globals_pad)
+    return src.replace(FUNCTION_PAD_MARKER, FUNCTION_PAD_MARKER + function_pad)
+
+def layout_variants(fname):
+    # [(variant name, source file name, source)]
+    with open(fname) as f:
+        src = f.read()
+    base = os.path.basename(fname)
+    variants = [('r%d'%i, 'r%d_%s'%(i, base), pad_source(src, i) if i else src) for i in range(args.n_pad + 1)]
+    if GLOBAL_DUMMY_MARKER not in src and args.n_pad:
+        print('WARN: no "%s" marker in %s, padding only adds globals'%(GLOBAL_DUMMY_MARKER, fname))
+    for prefix in filter(bool, args.rename_prefixes.split(',')):
+        variants.append((prefix, '%s_%s'%(prefix, base), src))
+    return variants
+
+def mean_std(xs):
+    m = sum(xs) / len(xs)
+    if len(xs) < 2:
+        return m, math.nan
+    return m, math.sqrt(sum((x - m)**2 for x in xs) / (len(xs) - 1))
+
+def calibrate(name, fname):
+    builddir = os.path.join(os.path.abspath(args.builddir), name)
+    shell_exec('mkdir -p %s'%builddir)
+
+    variant_times = {}
+    for variant, src_name, src in layout_variants(fname):
+        src_fname = os.path.join(builddir, src_name)
+        exe = os.path.splitext(src_fname)[0]
+        with open(src_fname, 'w') as f:
+            f.write(src)
+        completed_proc = shell_exec('cd %s; %s %s %s -o %s'%(builddir, args.ocamlopt, args.ocamlopt_flags, src_name, exe))
+        if completed_proc.returncode != 0:
+            print('ERROR[%d] compiling %s variant %s'%(completed_proc.returncode, name, variant))
+            continue
+
+        times = []
+        for i in range(args.iter):
+            start = time.perf_counter()
+            completed_proc = shell_exec('%s %s'%(args.pre_exec, exe), stdout=subprocess.DEVNULL)
+            elapsed = time.perf_counter() - start
+            if completed_proc.returncode != 0:
+                print('ERROR[%d] running %s variant %s'%(completed_proc.returncode, name, variant))
+                break
+            times.append(elapsed)
+        if times:
+            variant_times[variant] = times
+            if args.verbose: print('%s %s: mean %.4fs over %d runs'%(name, variant, sum(times)/len(times), len(times)))
+
+    if not variant_times:
+        return None
+
+    means = {v: mean_std(ts)[0] for v, ts in variant_times.items()}
+    grand_mean = sum(means.values()) / len(means)
+    ## pooled run-to-run std within each variant
+    run_var = [mean_std(ts)[1]**2 for ts in variant_times.values() if len(ts) > 1]
+    run_rel_std = math.sqrt(sum(run_var) / len(run_var)) / grand_mean if run_var else math.nan
+    layout_rel_std = mean_std(list(means.values()))[1] / grand_mean
+    layout_rel_range = (max(means.values()) - min(means.values())) / grand_mean
+
+    return {
+        'source': os.path.abspath(fname),
+        'variant_means': means,
+        'mean': grand_mean,
+        'run_rel_std': run_rel_std,
+        'layout_rel_std': layout_rel_std,
+        'layout_rel_range': layout_rel_range,
+        ## a shift within the layout spread is not significant
+        'noise_floor': layout_rel_range,
+    }
+
+benchmarks = {}
+for spec in filter(bool, args.benchmarks.split(',')):
+    if '=' not in spec:
+        print('ERROR: benchmark "%s" needs to be given as name=source.ml'%spec)
+        sys.exit(1)
+    name, fname = spec.split('=', 1)
+    print('Calibrating noise for %s from %s'%(name, fname))
+    result = calibrate(name, fname)
+    if result is None:
+        print('ERROR: no variants of %s could be run'%name)
+        continue
+    benchmarks[name] = result
+    print('%s: run-to-run %.2f%%, layout %.2f%% (range %.2f%%)'%(name, 100*result['run_rel_std'], 100*result['layout_rel_std'], 100*result['layout_rel_range']))
+
+noise_floors = {
+    'created': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+    'pre_exec': args.pre_exec,
+    'ocamlopt': args.ocamlopt,
+    'iter': args.iter,
+    ## for benchmarks without their own calibration
+    'default_noise_floor': max([b['noise_floor'] for b in benchmarks.values()], default=0.),
+    'benchmarks': benchmarks,
+}
+with open(args.output, 'w') as f:
+    json.dump(noise_floors, f, indent=2, sort_keys=True)
+print('Wrote noise floors for %d benchmarks to %s'%(len(benchmarks), args.output))
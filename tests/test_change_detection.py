@@ -0,0 +1,87 @@
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import change_detection
+
+def result(value, i):
+    return {'project': 'ocaml', 'branch': 'trunk', 'executable': 'vanilla', 'environment': 'bench_env',
+            'benchmark': 'fib', 'commitid': 'c%03d'%i, 'result_value': value, 'units': 'seconds'}
+
+def series(n=60, seed=1):
+    # noisy series with a step up at 15 and a smaller one down at 30
+    rnd = random.Random(seed)
+    level = lambda i: 1.0 if i < 15 else (1.2 if i < 30 else 1.1)
+    return [level(i) * (1 + rnd.gauss(0, 0.01)) for i in range(n)]
+
+def changes(detector):
+    return [(c['commitid'], round(c['before_mean'], 9), round(c['after_mean'], 9)) for c in detector.report_records()]
+
+def test_replay_matches_incremental(tmp_path):
+    values = series()
+    incremental = change_detection.ChangeDetector(str(tmp_path / 'incremental.db'))
+    for i, v in enumerate(values):
+        incremental.add([result(v, i)], order_key='%03d'%i)
+
+    ## the first commit arrives last, so the series is replayed with every point known
+    replayed = change_detection.ChangeDetector(str(tmp_path / 'replayed.db'))
+    for i, v in list(enumerate(values))[1:] + [(0, values[0])]:
+        replayed.add([result(v, i)], order_key='%03d'%i)
+
+    assert changes(incremental)
+    assert changes(replayed) == changes(incremental)
+    state = lambda d: json.loads(d.conn.execute('SELECT state FROM series').fetchone()[0])
+    assert state(replayed) == state(incremental)
+
+def test_noise_floor_only_for_times(tmp_path):
+    ## a 25% floor hides the step up in the times but not in a count
+    detector = change_detection.ChangeDetector(str(tmp_path / 'detect.db'), default_noise_floor=0.25)
+    for i, v in enumerate(series()):
+        detector.add([result(v, i), dict(result(v * 1000, i), benchmark='fib/gc.minor_collections', units='collections')], order_key='%03d'%i)
+    assert set(r['benchmark'] for r in detector.report_records()) == {'fib/gc.minor_collections'}
+
+def test_report_follows_replay(tmp_path):
+    values = series()
+    detector = change_detection.ChangeDetector(str(tmp_path / 'detect.db'))
+    report = str(tmp_path / 'change_points.jsonl')
+    for i, v in enumerate(values):
+        detector.add([result(v, i)], order_key='%03d'%i)
+    detector.write_report(report)
+
+    ## rerunning the step commit at the old level withdraws the change there
+    step = changes(detector)[0][0]
+    detector.add([result(1.0, int(step[1:]))], order_key=step[1:])
+    detector.write_report(report)
+    with open(report) as f:
+        records = [json.loads(l) for l in f]
+    assert [r['commitid'] for r in records] == [c[0] for c in changes(detector)]
+    assert step not in [r['commitid'] for r in records]
+
+def test_rerun_redoes_the_series_from_the_point(tmp_path, monkeypatch):
+    values = series()
+    detector = change_detection.ChangeDetector(str(tmp_path / 'detect.db'))
+    for i, v in enumerate(values):
+        detector.add([result(v, i)], order_key='%03d'%i)
+
+    steps = []
+    step = change_detection.ChangeDetector._step
+    monkeypatch.setattr(change_detection.ChangeDetector, '_step', lambda self, *a: steps.append(a[2]) or step(self, *a))
+    state = lambda d: json.loads(d.conn.execute('SELECT state FROM series').fetchone()[0])
+
+    ## reruns of the last commit, one after the step and one in the middle of the first segment
+    for i, v, max_steps in [(59, 1.3, 1), (59, 1.1, 1), (40, 1.15, 30), (16, 1.0, 50), (3, 1.01, 60)]:
+        values[i] = v
+        del steps[:]
+        detector.add([result(v, i)], order_key='%03d'%i)
+        assert len(steps) <= max_steps
+
+        ## the same as if the series had been detected with the new value from the start
+        fresh = change_detection.ChangeDetector(str(tmp_path / ('fresh%d.db'%len(values))))
+        for j, w in enumerate(values):
+            fresh.add([result(w, j)], order_key='%03d'%j)
+        assert changes(detector) == changes(fresh)
+        assert state(detector) == state(fresh)
+        fresh.close()
+        os.remove(str(tmp_path / ('fresh%d.db'%len(values))))
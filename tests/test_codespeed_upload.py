@@ -0,0 +1,101 @@
+import glob
+import http.server
+import json
+import os
+import socket
+import sys
+import threading
+import urllib.parse
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import codespeed_upload
+
+class FakeCodespeed(http.server.BaseHTTPRequestHandler):
+    # result/add/json/ that keeps what it accepts:
+    #   fail_first: answer the first n posts with 503
+    #   bad_benchmarks: answer 400 to any post containing one of these
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        form = urllib.parse.parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('ascii'))
+        results = json.loads(form['json'][0])
+        with self.server.lock:
+            self.server.posts += 1
+            if self.server.posts <= self.server.fail_first:
+                status = 503
+            elif any(r['benchmark'] in self.server.bad_benchmarks for r in results):
+                status = 400
+            else:
+                status = 202
+                self.server.received.extend(results)
+        body = b'ok' if status == 202 else b'nope'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_codespeed(port=0, fail_first=0, bad_benchmarks=()):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), FakeCodespeed)
+    server.lock = threading.Lock()
+    server.posts, server.received = 0, []
+    server.fail_first, server.bad_benchmarks = fail_first, set(bad_benchmarks)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+@pytest.fixture
+def servers():
+    started = []
+    yield started
+    for server in started:
+        server.shutdown()
+        server.server_close()
+
+def url(port):
+    return 'http://127.0.0.1:%d/'%port
+
+def results(n):
+    return [{'benchmark': 'bench%d'%i, 'result_value': float(i)} for i in range(n)]
+
+def uploader(port, **kwargs):
+    return codespeed_upload.CodespeedUploader(url(port), max_retries=2, backoff_secs=0.01, **kwargs)
+
+def test_retries_503s(servers):
+    server = start_codespeed(fail_first=3)
+    servers.append(server)
+    assert uploader(server.server_address[1], max_workers=1).upload(results(20))
+    assert sorted(r['result_value'] for r in server.received) == list(range(20))
+
+def test_spools_while_down_and_replays(servers, tmp_path):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    spool_dir = str(tmp_path / 'spool')
+    assert not uploader(port, spool_dir=spool_dir).upload(results(10))
+    spooled = glob.glob(os.path.join(spool_dir, '*.json'))
+    assert len(spooled) == 1
+    with open(spooled[0]) as f:
+        assert sorted(r['result_value'] for r in json.load(f)) == list(range(10))
+
+    ## codespeed is back: the next upload replays the spool along with its own results
+    server = start_codespeed(port)
+    servers.append(server)
+    assert uploader(port, spool_dir=spool_dir).upload(results(12)[10:])
+    assert sorted(r['result_value'] for r in server.received) == list(range(12))
+    assert os.listdir(spool_dir) == []
+
+def test_400_isolates_the_bad_result(servers, tmp_path):
+    server = start_codespeed(bad_benchmarks=['bench37'])
+    servers.append(server)
+    spool_dir = str(tmp_path / 'spool')
+    assert not uploader(server.server_address[1], spool_dir=spool_dir, initial_chunk=64).upload(results(64))
+    assert sorted(r['result_value'] for r in server.received) == [i for i in range(64) if i != 37]
+    rejected = glob.glob(os.path.join(spool_dir, '*.rejected'))
+    assert len(rejected) == 1
+    with open(rejected[0]) as f:
+        assert json.load(f) == [{'benchmark': 'bench37', 'result_value': 37.}]
+    assert glob.glob(os.path.join(spool_dir, '*.json')) == []
@@ -0,0 +1,87 @@
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import github_status
+
+class StubGithub(http.server.BaseHTTPRequestHandler):
+    # /repos/<repo>/commits/<hash>/status answered from the server's responses:
+    #   hash -> list of (status, headers, body), the last one repeating
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        h = self.path.split('/')[-2]
+        self.server.requests.append(h)
+        responses = self.server.responses.get(h, [(404, {}, {'message': 'Not Found'})])
+        n = self.server.requests.count(h) - 1
+        status, headers, body = responses[min(n, len(responses) - 1)]
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def github():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubGithub)
+    server.requests, server.responses = [], {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def fetcher(server, **kwargs):
+    return github_status.StatusFetcher(api_url='http://127.0.0.1:%d/'%server.server_address[1], backoff_secs=0.01,
+                                       max_rate_limit_wait_secs=0.5, **kwargs)
+
+def test_found_and_not_found(github):
+    github.responses['aaa'] = [(200, {}, {'state': 'success'})]
+    f = fetcher(github)
+    assert f.fetch_state('aaa') == 'success'
+    assert f.fetch_state('bbb') is None
+    assert github.requests == ['aaa', 'bbb']
+
+def test_rate_limit_403_waits_for_reset(github):
+    github.responses['aaa'] = [
+        (403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(int(time.time()))}, {'message': 'API rate limit exceeded'}),
+        (200, {}, {'state': 'failure'}),
+        ]
+    f = fetcher(github)
+    assert f.fetch_state('aaa') == 'failure'
+    assert github.requests == ['aaa', 'aaa']
+    assert f.resume_at > 0
+
+def test_plain_403_fails_at_once(github, capsys):
+    for h in ['aaa', 'bbb', 'ccc']:
+        github.responses[h] = [(403, {}, {'message': 'Bad credentials'})]
+    f = fetcher(github, max_workers=1)
+    assert f.states(['aaa', 'bbb', 'ccc']) == {'aaa': None, 'bbb': None, 'ccc': None}
+    assert github.requests == ['aaa']
+    assert capsys.readouterr().out.count('ERROR') == 1
+
+def test_cache_keeps_terminal_states(github, tmp_path):
+    github.responses['aaa'] = [(200, {}, {'state': 'success'})]
+    github.responses['bbb'] = [(200, {}, {'state': 'failure'})]
+    github.responses['ccc'] = [(200, {}, {'state': 'pending'})]
+    cache_file = str(tmp_path / 'cache.json')
+    states = {'aaa': 'success', 'bbb': 'failure', 'ccc': 'pending', 'ddd': None}
+    assert fetcher(github, cache_file=cache_file).states(list(states)) == states
+    with open(cache_file) as f:
+        assert json.load(f) == {'aaa': 'success', 'bbb': 'failure'}
+
+    ## a rerun only asks again for the commits whose state could still change
+    github.requests.clear()
+    assert fetcher(github, cache_file=cache_file).states(list(states)) == states
+    assert sorted(github.requests) == ['ccc', 'ddd']
@@ -0,0 +1,101 @@
+import json
+import math
+import os
+import statistics
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import orun_bench
+
+SCRIPTDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+FAKE_PERF = '''#!/usr/bin/env python3
+# perf stat stand-in: counts 1000 of each event in -x, csv, refusing any 'bogus' event
+import subprocess, sys
+a = sys.argv[1:]
+events = a[a.index('-e') + 1].split(',')
+if 'bogus' in events:
+    sys.exit('event syntax error: bogus')
+cmd = a[a.index('--') + 1:]
+if '-o' in a:
+    with open(a[a.index('-o') + 1], 'w') as f:
+        for e in events:
+            f.write('1000,,%s,100.00,,\\n'%e)
+sys.exit(subprocess.run(cmd).returncode)
+'''
+
+def interleaved_records():
+    # two benchmarks interleaved as orun writes them, the older orun records without gc.compactions
+    records = []
+    for i in range(7):
+        records.append({'name': 'b', 'time_secs': 2. + 0.1 * i, 'gc': {'minor_words': 10. * i, 'compactions': 1}})
+        records.append({'name': 'a', 'time_secs': 1. + 0.01 * i * i, 'gc': {'minor_words': 5.}})
+    return records
+
+def check_against_describe(aggregated, records, fields):
+    # the mean/min/max/std (ddof=1) that pandas describe() gave for the old upload path
+    assert list(aggregated) == ['a', 'b']
+    for name in aggregated:
+        for f in fields:
+            xs = [orun_bench.get_field(r, f) for r in records if r['name'] == name]
+            stats = aggregated[name][f]
+            assert stats.count == len(xs)
+            assert math.isclose(stats.mean, statistics.mean(xs))
+            assert math.isclose(stats.std, statistics.stdev(xs), abs_tol=1e-12)
+            assert (stats.min, stats.max) == (min(xs), max(xs))
+
+def test_aggregate_records_matches_describe(monkeypatch):
+    records = interleaved_records()
+    fields = ['time_secs', 'gc.minor_words', 'gc.compactions']
+    aggregated = orun_bench.aggregate_records(records, fields)
+    check_against_describe(aggregated, records, fields)
+    assert aggregated['a']['gc.compactions'].mean == 0 and aggregated['a']['gc.compactions'].count == 7
+
+    ## folding chunks together gives the same statistics as one pass
+    monkeypatch.setattr(orun_bench, 'CHUNK_RECORDS', 3)
+    check_against_describe(orun_bench.aggregate_records(records, fields), records, fields)
+
+def test_aggregate_orun_bench_file(tmp_path, monkeypatch):
+    records = interleaved_records()
+    fname = tmp_path / 'x.orun.bench'
+    fname.write_text(''.join(json.dumps(r) + '\n' + ('\n' if i % 5 == 0 else '') for i, r in enumerate(records)))
+    monkeypatch.setattr(orun_bench, 'CHUNK_RECORDS', 4)
+    check_against_describe(orun_bench.aggregate_orun_bench(str(fname), fields=['time_secs']), records, ['time_secs'])
+
+    ## a single iteration has no std, as in describe()
+    aggregated = orun_bench.aggregate_records(records[:2])
+    assert aggregated['a']['time_secs'].count == 1 and math.isnan(aggregated['a']['time_secs'].std)
+
+def test_perf_event_round_trip(tmp_path):
+    perf = tmp_path / 'perf'
+    perf.write_text(FAKE_PERF)
+    perf.chmod(0o755)
+    orun_output = tmp_path / 'fib.orun.bench'
+    record = json.dumps({'name': 'fib', 'time_secs': 1.0})
+    events = 'cycles,idq_uops_not_delivered.core'
+    subprocess.run([sys.executable, os.path.join(SCRIPTDIR, 'perf_stat_wrapper.py'), '--perf', str(perf), '--events', events,
+                    '--orun_output', str(orun_output), '--', 'sh', '-c', "echo '%s' > %s"%(record, orun_output)], check=True)
+
+    ## the metrics as a user names them find the counters as the wrapper recorded them
+    metrics = orun_bench.parse_metrics('perf.cycles,perf.idq_uops_not_delivered.core')
+    stats = orun_bench.aggregate_orun_bench(str(orun_output), fields=[m[0] for m in metrics])['fib']
+    for field, units, units_title in metrics:
+        assert stats[field].count == 1 and stats[field].mean == 1000.
+    assert orun_bench.metric_field('perf.idq_uops_not_delivered.core') in stats
+
+    uploads = orun_bench.format_for_upload({'fib': stats}, metrics, {}, 'env/p__b/h/exe/ts')
+    assert [u['benchmark'] for u in uploads] == ['fib/perf.cycles', 'fib/perf.idq_uops_not_delivered_core']
+
+def test_unsupported_perf_event_is_dropped(tmp_path):
+    perf = tmp_path / 'perf'
+    perf.write_text(FAKE_PERF)
+    perf.chmod(0o755)
+    orun_output = tmp_path / 'fib.orun.bench'
+    record = json.dumps({'name': 'fib', 'time_secs': 1.0})
+    proc = subprocess.run([sys.executable, os.path.join(SCRIPTDIR, 'perf_stat_wrapper.py'), '--perf', str(perf), '--events', 'cycles,bogus,instructions',
+                           '--orun_output', str(orun_output), '--', 'sh', '-c', "echo '%s' > %s"%(record, orun_output)],
+                          check=True, stderr=subprocess.PIPE, universal_newlines=True)
+    assert proc.stderr.count('WARN') == 1 and 'bogus' in proc.stderr
+    with open(orun_output) as f:
+        assert json.loads(f.read())['perf'] == {'cycles': 1000., 'bogus': None, 'instructions': 1000.}